@@ -1,12 +1,22 @@
+import os
 from src.data_quality_tester import DataQualityTester
 from src.postgres_connector import PostgresConnector
+from src.arrow_cache import ArrowTableCache, CachedTableReader, DEFAULT_MAX_BYTES
+
+# point this at a local directory to keep the tables between runs instead of reading them from Postgres every time
+ARROW_CACHE_DIR = os.environ.get("ARROW_CACHE_DIR")
+ARROW_CACHE_MAX_BYTES = int(os.environ.get("ARROW_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
 
 
 if __name__ == "__main__":
     #get breadcrumb and trip dataframes
     connector = PostgresConnector()
-    breadcrumb_df = connector.get_breadcrumb()
-    trip_df = connector.get_trip()
+    if ARROW_CACHE_DIR:
+        reader = CachedTableReader(connector, ArrowTableCache(ARROW_CACHE_DIR, ARROW_CACHE_MAX_BYTES))
+    else:
+        reader = connector
+    breadcrumb_df = reader.get_breadcrumb()
+    trip_df = reader.get_trip()
 
     #initialize the data quality tester
     tester = DataQualityTester()
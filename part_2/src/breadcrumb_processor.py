@@ -1,6 +1,7 @@
 import os
 import datetime as dt
 import pandas as pd
+from src.date_cache import opd_date_cache
 
 
 class BreadCrumbProcessor:
@@ -86,7 +87,7 @@ class BreadCrumbProcessor:
         """
         dt_str = row["OPD_DATE"]
         time_delta = row["ACT_TIME"]
-        date = dt.datetime.strptime(dt_str, "%d%b%Y:%H:%M:%S")
+        date = opd_date_cache.parse(dt_str)
         time_delta = dt.timedelta(seconds=time_delta)
         return date + time_delta
 
@@ -1,6 +1,6 @@
 from enum import Enum
 import pandas as pd
-import datetime as dt
+from src.date_cache import opd_date_cache
 class TestOutcome(Enum):
     PASSED = 1
     FAILED = 0
@@ -97,11 +97,7 @@ class DataQualityTester:
         res = None
 
         def try_parse_date(date_str: str) -> bool:
-            try:
-                dt.datetime.strptime(date_str, "%d%b%Y:%H:%M:%S")
-                return True
-            except ValueError:
-                return False
+            return opd_date_cache.try_parse(date_str) is not None
 
         try:
             count = len(df[~df["OPD_DATE"].apply(try_parse_date)])
@@ -0,0 +1,94 @@
+import datetime as dt
+import threading
+from collections import OrderedDict
+
+OPD_DATE_FORMAT = "%d%b%Y:%H:%M:%S"
+_MONTHS = {"JAN": 1, "FEB": 2, "MAR": 3, "APR": 4, "MAY": 5, "JUN": 6, "JUL": 7, "AUG": 8, "SEP": 9, "OCT": 10,
+           "NOV": 11, "DEC": 12}
+_PARSE_FAILED = object()
+
+
+def parse_opd_date(value: str) -> dt.datetime:
+    """
+    Parse an OPD_DATE like 08DEC2022:00:00:00 without going through strptime. strptime compiles a regex per format,
+    looks up the locale's month names and builds a time tuple before it gets to the datetime, which is a lot of work
+    for a format that never changes. Anything that isn't exactly the 18 character form is handed to strptime so the
+    accepted inputs (and the ValueError/TypeError on bad ones) are the same as before.
+    :param value: str the OPD_DATE from the breadcrumb
+    :return: dt.datetime
+    """
+    if isinstance(value, str) and len(value) == 18 and value[9] == ":" and value[12] == ":" and value[15] == ":":
+        month = _MONTHS.get(value[2:5].upper())
+        digits = value[0:2] + value[5:9] + value[10:12] + value[13:15] + value[16:18]
+        if month is not None and digits.isascii() and digits.isdigit():
+            return dt.datetime(int(value[5:9]), month, int(value[0:2]), int(value[10:12]), int(value[13:15]),
+                               int(value[16:18]))
+    return dt.datetime.strptime(value, OPD_DATE_FORMAT)
+
+
+class OpdDateCache:
+    """
+    Bounded LRU cache of OPD_DATE string to parsed datetime. A day's feed only has one or a few distinct OPD_DATE values
+    but we used to parse it again for every row, both when building timestamps and when checking for malformed dates.
+    Failed parses are cached too, so a bad date costs one parse instead of one per row. hits and misses are kept so we
+    can see the cache is doing its job. It is shared between threads so the Pub/Sub callbacks can all use it.
+    """
+
+    def __init__(self, maxsize: int = 128, parser=parse_opd_date):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._parser = parser
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def try_parse(self, value) -> dt.datetime | None:
+        """
+        :param value: the OPD_DATE value, normally a str
+        :return: the parsed datetime or None if it can't be parsed
+        """
+        with self._lock:
+            try:
+                parsed = self._entries.get(value)
+            except TypeError:
+                # unhashable, can't be cached and can't be a date either
+                self.misses += 1
+                return None
+            if parsed is not None:
+                self.hits += 1
+                self._entries.move_to_end(value)
+                return None if parsed is _PARSE_FAILED else parsed
+            self.misses += 1
+
+        try:
+            parsed = self._parser(value)
+        except (TypeError, ValueError):
+            parsed = _PARSE_FAILED
+
+        with self._lock:
+            self._entries[value] = parsed
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return None if parsed is _PARSE_FAILED else parsed
+
+    def parse(self, value) -> dt.datetime:
+        """
+        Same as try_parse but raises ValueError for a date that can't be parsed, like strptime would.
+        """
+        parsed = self.try_parse(value)
+        if parsed is None:
+            raise ValueError(f"time data {value!r} does not match format {OPD_DATE_FORMAT!r}")
+        return parsed
+
+    def info(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "maxsize": self.maxsize}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+opd_date_cache = OpdDateCache()
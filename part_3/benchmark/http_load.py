@@ -0,0 +1,121 @@
+"""
+Load test the map server. Every client is a thread with its own keep-alive connection that requests the given paths
+round robin, and the report has requests per second, bytes and latency percentiles per status. Start the server and
+run from the part_3 directory:
+
+    python server.py --quiet --precompress &
+    PYTHONPATH=. python -m benchmark.http_load --clients 50 --requests 200 / /data.geojson /tiles/12/650/1464.mvt
+
+--gzip asks for compressed responses like a browser does, --revalidate sends back the ETag of the first response so
+the rest are 304s like a browser with a warm cache, and --slow-clients opens connections that send half a request and
+then sit there, which used to hang the single threaded server for everyone.
+"""
+import argparse
+import http.client
+import json
+import socket
+import threading
+import time
+from src.instrumentation import Histogram
+
+
+def run_client(host: str, port: int, paths: list[str], requests: int, headers: dict, revalidate: bool,
+               results: dict, lock: threading.Lock) -> None:
+    connection = http.client.HTTPConnection(host, port, timeout=60)
+    etags = {}
+    latencies = {}
+    received = 0
+    errors = 0
+    for i in range(requests):
+        path = paths[i % len(paths)]
+        request_headers = dict(headers)
+        if revalidate and path in etags:
+            request_headers["If-None-Match"] = etags[path]
+        start = time.perf_counter()
+        try:
+            connection.request("GET", path, headers=request_headers)
+            response = connection.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            connection.close()
+            connection = http.client.HTTPConnection(host, port, timeout=60)
+            continue
+        latencies.setdefault(response.status, Histogram()).observe(time.perf_counter() - start)
+        received += len(body)
+        if response.getheader("ETag"):
+            etags[path] = response.getheader("ETag")
+    connection.close()
+
+    with lock:
+        results["bytes"] += received
+        results["errors"] += errors
+        for status, histogram in latencies.items():
+            results["latency"].setdefault(status, []).append(histogram)
+
+
+def hold_slow_client(host: str, port: int, stop: threading.Event) -> None:
+    with socket.create_connection((host, port)) as sock:
+        sock.sendall(b"GET / HTTP/1.1\r\nHost: ")
+        stop.wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load test the map server")
+    parser.add_argument("paths", nargs="+", help="paths to request, round robin")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=100, help="requests per client")
+    parser.add_argument("--gzip", action="store_true", help="send Accept-Encoding: gzip, br")
+    parser.add_argument("--revalidate", action="store_true", help="send If-None-Match with the last ETag")
+    parser.add_argument("--slow-clients", type=int, default=0)
+    parser.add_argument("--output", help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    headers = {"Accept-Encoding": "gzip, br"} if args.gzip else {}
+    stop = threading.Event()
+    slow = [threading.Thread(target=hold_slow_client, args=(args.host, args.port, stop), daemon=True)
+            for _ in range(args.slow_clients)]
+    for thread in slow:
+        thread.start()
+
+    results = {"bytes": 0, "errors": 0, "latency": {}}
+    lock = threading.Lock()
+    clients = [threading.Thread(target=run_client, args=(args.host, args.port, args.paths, args.requests, headers,
+                                                         args.revalidate, results, lock))
+               for _ in range(args.clients)]
+    start = time.perf_counter()
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+
+    by_status = {}
+    total = 0
+    for status, histograms in sorted(results["latency"].items()):
+        merged = Histogram()
+        for histogram in histograms:
+            merged.merge(histogram)
+        by_status[status] = merged.snapshot()
+        total += merged.count
+    report = {
+        "clients": args.clients,
+        "slow_clients": args.slow_clients,
+        "requests": total,
+        "errors": results["errors"],
+        "elapsed_s": elapsed,
+        "requests_per_second": total / elapsed if elapsed else 0.0,
+        "megabytes": results["bytes"] / 1e6,
+        "latency_by_status": by_status,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
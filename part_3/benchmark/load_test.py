@@ -0,0 +1,60 @@
+"""
+Load test the breadcrumb subscriber without GCP. Messages come from a ReplayMessageSource (an NDJSON archive or
+synthetic breadcrumbs) and go through Subscriber.message_parser and the flush into whatever Postgres the usual
+environment variables point at, so point them at a local database. Run from the part_3 directory:
+
+    PYTHONPATH=.:../part_1 python -m benchmark.load_test --synthetic 200000 --rate 5000
+    PYTHONPATH=.:../part_1 python -m benchmark.load_test --ndjson /home/sarah/breadcrumb_data/20240415.ndjson
+
+Use --null-db to leave the database out and measure only the in process part. --spill-dir turns on the spill log, stop
+the database in the middle of a run to see ingest carry on while it's down and the log drain when it's back.
+"""
+import argparse
+import json
+import time
+from src.message_source import ReplayMessageSource
+from src.postgres_connector import PostgresConnector
+from subscriber.subscriber import Subscriber
+from benchmark.run_benchmark import _NullConnector, _NullLogger
+from benchmark.synthetic import generate_breadcrumbs
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay breadcrumbs through the subscriber at a controlled rate")
+    source_group = parser.add_mutually_exclusive_group(required=True)
+    source_group.add_argument("--ndjson", help="replay this NDJSON archive")
+    source_group.add_argument("--synthetic", type=int, help="replay this many synthetic breadcrumbs")
+    parser.add_argument("--rate", type=float, help="messages per second, default is as fast as possible")
+    parser.add_argument("--bad-row-rate", type=float, default=0.01)
+    parser.add_argument("--workers", type=int, default=10, help="callback threads")
+    parser.add_argument("--max-outstanding", type=int, default=1000)
+    parser.add_argument("--null-db", action="store_true", help="don't write to Postgres")
+    parser.add_argument("--spill-dir", help="spill batches here while the database is down")
+    parser.add_argument("--output", help="write the stats to this JSON file")
+    args = parser.parse_args()
+
+    options = {"rate": args.rate, "max_workers": args.workers, "max_outstanding": args.max_outstanding}
+    if args.ndjson:
+        source = ReplayMessageSource.from_ndjson(args.ndjson, **options)
+    else:
+        source = ReplayMessageSource.from_dicts(generate_breadcrumbs(args.synthetic, args.bad_row_rate), **options)
+
+    connector = _NullConnector() if args.null_db else PostgresConnector()
+    subscriber = Subscriber(_NullLogger(), None, connector, spill_dir=args.spill_dir)
+
+    subscriber.sub(None, None, source=source)
+    flush_start = time.perf_counter()
+    subscriber.clean_up()
+    flush_seconds = time.perf_counter() - flush_start
+
+    stats = source.stats()
+    stats["final_flush_s"] = flush_seconds
+    stats["end_to_end_per_second"] = stats["acked"] / (stats["elapsed_s"] + flush_seconds)
+    print(json.dumps(stats, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(stats, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+"""
+End to end benchmark for the breadcrumb pipeline. Run it from the part_3 directory (the subscriber needs logger.py from
+part_1 on the path):
+
+    PYTHONPATH=.:../part_1 python -m benchmark.run_benchmark --sizes 10000,1000000,10000000 --output bench.json
+
+and compare a later run against a saved one with --compare bench.json. Every run writes one JSON document with the
+environment and a result per (benchmark, size) so two runs can be diffed by a script instead of by eye.
+"""
+import argparse
+import contextlib
+import datetime as dt
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+import pandas as pd
+from src.breadcrumb_processor import BreadCrumbProcessor
+from src.schema import RAW_SCHEMA, BREADCRUMB_SCHEMA, apply_schema, bytes_per_row
+from benchmark.synthetic import generate_breadcrumbs, generate_raw_frame, generate_breadcrumb_frame, \
+    generate_stop_event_html, generate_stop_events
+
+DEFAULT_SIZES = [10_000, 1_000_000, 10_000_000]
+# per message benchmarks are timed on at most this many rows and reported per row, 10M calls to process_individual
+# would take hours
+DEFAULT_MAX_MESSAGES = 100_000
+DEFAULT_MAX_TRIPS = 2_000
+
+
+class _NullLogger:
+    def info(self, message):
+        pass
+
+    def error(self, message):
+        pass
+
+    def send(self):
+        pass
+
+
+class _NullConnection:
+    def commit(self):
+        pass
+
+
+class _NullConnector:
+    """
+    Stands in for PostgresConnector so the callback benchmark measures our code and not the database.
+    """
+
+    def __init__(self):
+        self.connection = _NullConnection()
+        self.rows = 0
+
+    def append_to_raw(self, df):
+        self.rows += len(df)
+
+
+class _BenchmarkMessage:
+    __slots__ = ("data",)
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def ack(self):
+        pass
+
+    def nack(self):
+        pass
+
+
+def _time(fn, *args) -> float:
+    gc.collect()
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def _quiet_time(fn, *args) -> float:
+    """
+    _time with stdout going to /dev/null, for code that prints per row (process_individual_part3 prints three row
+    counts for every stop event). Otherwise we'd be timing the terminal.
+    """
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        return _time(fn, *args)
+
+
+def _result(name: str, rows: int, measured_rows: int, seconds: float) -> dict:
+    return {
+        "benchmark": name,
+        "rows": rows,
+        "measured_rows": measured_rows,
+        "seconds": seconds,
+        "rows_per_second": measured_rows / seconds if seconds > 0 else None,
+        "us_per_row": seconds / measured_rows * 1_000_000 if measured_rows else None,
+    }
+
+
+def bench_process_individual(size: int, args) -> dict:
+    measured = min(size, args.max_messages)
+    breadcrumbs = list(generate_breadcrumbs(measured, args.bad_row_rate, seed=args.seed))
+
+    def run():
+        for breadcrumb in breadcrumbs:
+            BreadCrumbProcessor.process_individual(breadcrumb)
+
+    return _result("process_individual", size, measured, _time(run))
+
+
+def bench_process_individual_fast(size: int, args) -> dict:
+    measured = min(size, args.max_messages)
+    breadcrumbs = list(generate_breadcrumbs(measured, args.bad_row_rate, seed=args.seed))
+
+    def run():
+        for breadcrumb in breadcrumbs:
+            BreadCrumbProcessor.process_individual_fast(breadcrumb)
+
+    return _result("process_individual_fast", size, measured, _time(run))
+
+
+def bench_add_timestamp(size: int, args) -> dict:
+    df = generate_breadcrumb_frame(size, seed=args.seed)
+    return _result("add_timestamp", size, size, _time(BreadCrumbProcessor.add_timestamp, df))
+
+
+def bench_add_speed(size: int, args) -> dict:
+    df = generate_raw_frame(size, seed=args.seed)
+    return _result("add_speed", size, size, _time(BreadCrumbProcessor.add_speed, df))
+
+
+def bench_filter_implausible(size: int, args) -> dict:
+    df = BreadCrumbProcessor.add_speed(generate_raw_frame(size, seed=args.seed))
+    return _result("filter_implausible", size, size,
+                   _time(lambda: BreadCrumbProcessor.filter_implausible(df, smooth=True)))
+
+
+def bench_trip_state(size: int, args) -> dict:
+    from src.trip_state import TripStateStore
+    measured = min(size, args.max_messages)
+    records = [BreadCrumbProcessor.process_individual_fast(breadcrumb)
+               for breadcrumb in generate_breadcrumbs(measured, 0, seed=args.seed)]
+    # roughly the order they come off the subscription in, by time with a few seconds of jitter
+    rng = np.random.default_rng(args.seed)
+    jitter = rng.uniform(0, 10, len(records))
+    records = [records[i] for i in np.argsort([r.timestamp.timestamp() for r in records] + jitter)]
+
+    def run():
+        store = TripStateStore()
+        for record in records:
+            store.add(record)
+        store.flush()
+
+    return _result("trip_state", size, measured, _time(run))
+
+
+def bench_raw_table_to_processed_tables(size: int, args) -> dict:
+    df = generate_raw_frame(size, seed=args.seed)
+    return _result("raw_table_to_processed_tables", size, size,
+                   _time(BreadCrumbProcessor.raw_table_to_processed_tables, df))
+
+
+def bench_seen_set(size: int, args) -> dict:
+    import tempfile
+    from src.seen_set import SeenSet
+    measured = min(size, args.max_messages)
+    breadcrumbs = list(generate_breadcrumbs(measured, args.bad_row_rate, seed=args.seed))
+
+    def run():
+        with tempfile.TemporaryDirectory() as directory:
+            seen = SeenSet(directory)
+            for breadcrumb in breadcrumbs:
+                seen.add(breadcrumb)
+
+    return _result("seen_set", size, measured, _time(run))
+
+
+def bench_html_to_breadcrumb(size: int, args) -> dict:
+    # imported here because the publisher module pulls in bs4 and the Pub/Sub client
+    from publisher.part3_publisher import html_to_breadcrumb
+    trips = min(size, args.max_trips)
+    html = generate_stop_event_html(trips, seed=args.seed)
+    return _result("html_to_breadcrumb", size, trips, _time(html_to_breadcrumb, html))
+
+
+def bench_process_individual_part3(size: int, args) -> dict:
+    measured = min(size, args.max_messages)
+    events = generate_stop_events(measured, seed=args.seed)
+
+    def run():
+        for event in events:
+            BreadCrumbProcessor.process_individual_part3(event)
+
+    return _result("process_individual_part3", size, measured, _quiet_time(run))
+
+
+def bench_subscriber_callback(size: int, args) -> dict:
+    from subscriber.subscriber import Subscriber
+    measured = min(size, args.max_messages)
+    messages = [_BenchmarkMessage(json.dumps(breadcrumb).encode("utf-8"))
+                for breadcrumb in generate_breadcrumbs(measured, args.bad_row_rate, seed=args.seed)]
+    subscriber = Subscriber(_NullLogger(), None, _NullConnector(), spill_dir=None)
+
+    def run():
+        for message in messages:
+            subscriber.message_parser(message)
+        subscriber.clean_up()
+
+    return _result("subscriber_callback", size, measured, _quiet_time(run))
+
+
+def bench_schema_memory(size: int, args) -> dict:
+    """
+    Not a timing, this reports how much memory a raw and a breadcrumb frame take with pandas' default types and with
+    the declared schema. seconds is the time apply_schema takes on the raw frame.
+    """
+    raw_df = generate_raw_frame(size, seed=args.seed)
+    seconds = _time(apply_schema, raw_df, RAW_SCHEMA)
+    compact_raw_df = apply_schema(raw_df, RAW_SCHEMA)
+    breadcrumb_df = pd.DataFrame({"tstamp": raw_df["timestamp"], "latitude": raw_df["GPS_LATITUDE"],
+                                  "longitude": raw_df["GPS_LONGITUDE"], "speed": raw_df["METERS"] / 5.0,
+                                  "trip_id": raw_df["EVENT_NO_TRIP"]})
+    result = _result("schema_memory", size, size, seconds)
+    result["raw_bytes_per_row"] = bytes_per_row(raw_df)
+    result["raw_compact_bytes_per_row"] = bytes_per_row(compact_raw_df)
+    result["breadcrumb_bytes_per_row"] = bytes_per_row(breadcrumb_df)
+    result["breadcrumb_compact_bytes_per_row"] = bytes_per_row(apply_schema(breadcrumb_df, BREADCRUMB_SCHEMA))
+    return result
+
+
+BENCHMARKS = {
+    "process_individual": bench_process_individual,
+    "process_individual_fast": bench_process_individual_fast,
+    "add_timestamp": bench_add_timestamp,
+    "add_speed": bench_add_speed,
+    "filter_implausible": bench_filter_implausible,
+    "trip_state": bench_trip_state,
+    "raw_table_to_processed_tables": bench_raw_table_to_processed_tables,
+    "seen_set": bench_seen_set,
+    "html_to_breadcrumb": bench_html_to_breadcrumb,
+    "process_individual_part3": bench_process_individual_part3,
+    "subscriber_callback": bench_subscriber_callback,
+    "schema_memory": bench_schema_memory,
+}
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "timestamp": dt.datetime.now().isoformat(timespec="seconds"),
+        "git_commit": commit,
+        "python": sys.version.split()[0],
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+    }
+
+
+def compare(results: list[dict], baseline_path: str, threshold: float) -> list[str]:
+    """
+    :return: a line for every benchmark that is more than threshold (a fraction) slower per row than the baseline
+    """
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {(r["benchmark"], r["rows"]): r for r in json.load(f)["results"]}
+
+    regressions = []
+    for result in results:
+        old = baseline.get((result["benchmark"], result["rows"]))
+        if old is None or not old.get("us_per_row") or not result.get("us_per_row"):
+            continue
+        change = result["us_per_row"] / old["us_per_row"] - 1
+        line = f"{result['benchmark']} @ {result['rows']}: {old['us_per_row']:.3f} -> {result['us_per_row']:.3f} " \
+               f"us/row ({change:+.1%})"
+        print(line)
+        if change > threshold:
+            regressions.append(line)
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the breadcrumb pipeline on synthetic data")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in DEFAULT_SIZES),
+                        help="comma separated row counts")
+    parser.add_argument("--benchmarks", default=",".join(BENCHMARKS), help="comma separated benchmark names")
+    parser.add_argument("--bad-row-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-messages", type=int, default=DEFAULT_MAX_MESSAGES)
+    parser.add_argument("--max-trips", type=int, default=DEFAULT_MAX_TRIPS)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file from an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="fraction slower than the baseline that counts as a regression")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    results = []
+    for name in args.benchmarks.split(","):
+        for size in sizes:
+            result = BENCHMARKS[name](size, args)
+            print(f"{name} @ {size}: {result['seconds']:.3f}s for {result['measured_rows']} rows "
+                  f"({result['us_per_row']:.3f} us/row)")
+            results.append(result)
+
+    document = {"environment": environment(), "parameters": vars(args), "results": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(document, f, indent=2)
+    else:
+        print(json.dumps(document, indent=2))
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) over {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+import datetime as dt
+import numpy as np
+import pandas as pd
+
+# roughly downtown Portland, same center as index.html
+CENTER_LATITUDE = 45.511212
+CENTER_LONGITUDE = -122.683083
+FIX_INTERVAL = 5
+FIXES_PER_TRIP = 400
+FIRST_TRIP_ID = 230_000_000
+FIRST_VEHICLE_ID = 3000
+BAD_ROW_KINDS = ["null", "hdop", "negative_meters", "missing_column", "bad_date"]
+
+
+def opd_date(service_date: dt.date) -> str:
+    """
+    Format a date the way the busdata api does it, e.g. 08DEC2022:00:00:00
+    """
+    return service_date.strftime("%d%b%Y:00:00:00").upper()
+
+
+def generate_breadcrumb_frame(n_rows: int, n_vehicles: int = 150, seed: int = 0,
+                              service_date: dt.date = dt.date(2022, 12, 8), shuffle: bool = True) -> pd.DataFrame:
+    """
+    Build n_rows of clean breadcrumbs in the same shape as the api response. Every trip is FIXES_PER_TRIP fixes long,
+    one every FIX_INTERVAL seconds, with the odometer (METERS) and the position moving forward a little with each fix.
+    The rows are shuffled by default because that is what the raw table looks like after a day of Pub/Sub deliveries.
+    Everything is built with numpy so that 10 million rows only takes a few seconds.
+    :param n_rows: number of breadcrumbs
+    :param n_vehicles: number of distinct vehicles the trips are spread across
+    :param seed: random seed, the same seed always gives the same frame
+    :param service_date: the OPD_DATE of every breadcrumb
+    :param shuffle: shuffle the rows instead of leaving them in trip order
+    :return: pd.DataFrame with the api columns
+    """
+    rng = np.random.default_rng(seed)
+    row = np.arange(n_rows)
+    trip = row // FIXES_PER_TRIP
+    position = row % FIXES_PER_TRIP
+    n_trips = int(trip[-1]) + 1 if n_rows else 0
+    trip_start_row = np.arange(n_trips) * FIXES_PER_TRIP
+
+    trip_start_time = rng.integers(4 * 3600, 22 * 3600, n_trips)
+    act_time = trip_start_time[trip] + position * FIX_INTERVAL
+
+    # cumulative sums per trip: take the global running total and subtract the total at the start of each trip
+    meters_step = rng.integers(0, 80, n_rows)
+    meters_step[trip_start_row] = 0
+    meters = np.cumsum(meters_step)
+    meters = meters - meters[trip_start_row][trip]
+
+    lat_step = rng.normal(0, 0.0003, n_rows)
+    lon_step = rng.normal(0, 0.0003, n_rows)
+    lat_step[trip_start_row] = rng.normal(0, 0.05, n_trips)
+    lon_step[trip_start_row] = rng.normal(0, 0.08, n_trips)
+    latitude = np.cumsum(lat_step)
+    longitude = np.cumsum(lon_step)
+    latitude = CENTER_LATITUDE + latitude - latitude[trip_start_row][trip] + lat_step[trip_start_row][trip]
+    longitude = CENTER_LONGITUDE + longitude - longitude[trip_start_row][trip] + lon_step[trip_start_row][trip]
+
+    df = pd.DataFrame({
+        "EVENT_NO_TRIP": FIRST_TRIP_ID + trip,
+        "EVENT_NO_STOP": FIRST_TRIP_ID + trip * 10 + position // 40,
+        "OPD_DATE": opd_date(service_date),
+        "VEHICLE_ID": FIRST_VEHICLE_ID + trip % n_vehicles,
+        "METERS": meters,
+        "ACT_TIME": act_time,
+        "GPS_LONGITUDE": longitude.round(6),
+        "GPS_LATITUDE": latitude.round(6),
+        "GPS_HDOP": rng.uniform(0.5, 3.0, n_rows).round(1),
+        "GPS_SATELLITES": rng.integers(4, 13, n_rows),
+    })
+    if shuffle:
+        df = df.iloc[rng.permutation(n_rows)].reset_index(drop=True)
+    return df
+
+
+def generate_raw_frame(n_rows: int, n_vehicles: int = 150, seed: int = 0,
+                       service_date: dt.date = dt.date(2022, 12, 8)) -> pd.DataFrame:
+    """
+    Same breadcrumbs as generate_breadcrumb_frame but in the shape of the raw table, i.e. what process_individual
+    produces and get_raw reads back: timestamp instead of OPD_DATE/ACT_TIME, plus processed_date and is_in_final_table.
+    The timestamps are computed with numpy so building the frame doesn't depend on the code being benchmarked.
+    """
+    df = generate_breadcrumb_frame(n_rows, n_vehicles, seed, service_date)
+    base = np.datetime64(service_date.isoformat(), "s")
+    df["processed_date"] = dt.date.today()
+    df["is_in_final_table"] = False
+    df["timestamp"] = base + df["ACT_TIME"].to_numpy().astype("timedelta64[s]")
+    return df.drop(["EVENT_NO_STOP", "GPS_HDOP", "GPS_SATELLITES", "OPD_DATE", "ACT_TIME"], axis=1)
+
+
+def generate_breadcrumbs(n_rows: int, bad_row_rate: float = 0.01, n_vehicles: int = 150, seed: int = 0,
+                         service_date: dt.date = dt.date(2022, 12, 8), chunk_size: int = 100_000):
+    """
+    Yield breadcrumb dicts exactly like the ones the publisher puts on the topic. A bad_row_rate fraction of them are
+    broken in one of the ways process_individual is supposed to reject (a null, GPS_HDOP over 20, negative METERS, a
+    missing column or a date strptime can't parse). The dicts are produced a chunk at a time so that 10 million of them
+    never have to be in memory at once.
+    """
+    rng = np.random.default_rng(seed + 1)
+    for chunk_start in range(0, n_rows, chunk_size):
+        chunk_rows = min(chunk_size, n_rows - chunk_start)
+        chunk = generate_breadcrumb_frame(chunk_rows, n_vehicles, seed + chunk_start, service_date)
+        chunk["EVENT_NO_TRIP"] += chunk_start
+        bad = rng.random(chunk_rows) < bad_row_rate
+        kinds = rng.integers(0, len(BAD_ROW_KINDS), chunk_rows)
+        for i, breadcrumb in enumerate(chunk.to_dict("records")):
+            if bad[i]:
+                corrupt_breadcrumb(breadcrumb, BAD_ROW_KINDS[kinds[i]])
+            yield breadcrumb
+
+
+def corrupt_breadcrumb(breadcrumb: dict, kind: str) -> dict:
+    if kind == "null":
+        breadcrumb["GPS_LATITUDE"] = None
+    elif kind == "hdop":
+        breadcrumb["GPS_HDOP"] = 25.0
+    elif kind == "negative_meters":
+        breadcrumb["METERS"] = -1
+    elif kind == "missing_column":
+        del breadcrumb["GPS_SATELLITES"]
+    elif kind == "bad_date":
+        breadcrumb["OPD_DATE"] = "31FOO2022:00:00:00"
+    return breadcrumb
+
+
+def generate_stop_events(n_rows: int, n_vehicles: int = 150, seed: int = 0) -> list[dict]:
+    """
+    Stop event dicts in the shape html_to_breadcrumb produces (the first row of each trip's table plus trip_id).
+    """
+    rng = np.random.default_rng(seed)
+    routes = rng.integers(1, 100, n_rows)
+    directions = rng.integers(0, 2, n_rows)
+    service_keys = rng.choice(["W", "S", "U"], n_rows, p=[0.8, 0.1, 0.1])
+    events = []
+    for i in range(n_rows):
+        events.append({
+            "vehicle_number": FIRST_VEHICLE_ID + i % n_vehicles,
+            "leave_time": int(rng.integers(4 * 3600, 22 * 3600)),
+            "train": int(rng.integers(1000, 9999)),
+            "route_number": int(routes[i]),
+            "direction": int(directions[i]),
+            "service_key": str(service_keys[i]),
+            "trip_number": int(rng.integers(100, 999)),
+            "stop_time": int(rng.integers(4 * 3600, 22 * 3600)),
+            "arrive_time": int(rng.integers(4 * 3600, 22 * 3600)),
+            "dwell": int(rng.integers(0, 60)),
+            "location_id": int(rng.integers(1, 14000)),
+            "door": 0,
+            "lift": 0,
+            "ons": int(rng.integers(0, 10)),
+            "offs": int(rng.integers(0, 10)),
+            "estimated_load": int(rng.integers(0, 40)),
+            "maximum_speed": int(rng.integers(0, 50)),
+            "train_mileage": float(rng.uniform(0, 40)),
+            "pattern_distance": float(rng.uniform(0, 40000)),
+            "location_distance": float(rng.uniform(0, 100)),
+            "x_coordinate": float(rng.uniform(7.6e6, 7.7e6)),
+            "y_coordinate": float(rng.uniform(6.8e5, 7.0e5)),
+            "data_source": 0,
+            "schedule_status": 0,
+            "trip_id": str(FIRST_TRIP_ID + i),
+        })
+    return events
+
+
+def generate_stop_event_html(n_trips: int, rows_per_trip: int = 5, seed: int = 0) -> str:
+    """
+    An html page laid out like the getStopEvents response: an h2 header with the trip id followed by a table of stop
+    events for every trip.
+    """
+    events = generate_stop_events(n_trips * rows_per_trip, seed=seed)
+    columns = [key for key in events[0] if key != "trip_id"] if events else []
+    header = "".join(f"<th>{column}</th>" for column in columns)
+    parts = ["<html><body><h1>Trimet CAD/AVL stop data</h1>"]
+    for trip in range(n_trips):
+        trip_events = events[trip * rows_per_trip:(trip + 1) * rows_per_trip]
+        parts.append(f"<h2>Stop events for PDX_TRIP {FIRST_TRIP_ID + trip}</h2>")
+        parts.append(f"<table><tr>{header}</tr>")
+        for event in trip_events:
+            parts.append("<tr>" + "".join(f"<td>{event[column]}</td>" for column in columns) + "</tr>")
+        parts.append("</table>")
+    parts.append("</body></html>")
+    return "".join(parts)
@@ -0,0 +1,15 @@
+import argparse
+import glob
+import os
+from src.columnar_archive import convert_ndjson
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert NDJSON breadcrumb archives into the columnar archive")
+    parser.add_argument("pattern", help="glob of .ndjson files, e.g. '/home/sarah/breadcrumb_data/*.ndjson'")
+    parser.add_argument("archive", help="archive directory to write into")
+    parser.add_argument("--chunksize", type=int, default=500_000)
+    args = parser.parse_args()
+
+    for path in sorted(glob.glob(args.pattern)):
+        rows = convert_ndjson(path, args.archive, args.chunksize)
+        print(f"Converted {rows} rows from {path} ({os.path.getsize(path) / 1e6:.1f} MB of NDJSON)")
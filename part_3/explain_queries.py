@@ -0,0 +1,137 @@
+import argparse
+import datetime as dt
+import json
+from sqlalchemy import text
+from sqlalchemy.exc import ProgrammingError
+from src.geojson_export import breadcrumb_query
+from src.postgres_connector import PostgresConnector
+from src.schema import BREADCRUMB_SCHEMA, RAW_SCHEMA, column_list
+
+RUNS = 3
+
+
+def _values(connector: PostgresConnector, sql: str) -> list:
+    """
+    :return: the first column of what sql returns, or nothing if the table isn't there yet (before the migrations)
+    """
+    try:
+        with connector.engine.connect() as connection:
+            return [value for value in connection.execute(text(sql)).scalars() if value is not None]
+    except ProgrammingError:
+        return []
+
+
+def pipeline_queries(connector: PostgresConnector) -> list[tuple]:
+    """
+    The queries the pipeline actually runs, with parameters picked from what is in the tables.
+    :return: list of (name, sql, params)
+    """
+    trip_ids = _values(connector, f"SELECT DISTINCT trip_id FROM {connector.breadcrumb_table} "
+                                  f"ORDER BY trip_id LIMIT 50")
+    newest = _values(connector, f"SELECT max(tstamp) FROM {connector.breadcrumb_table}")
+    last_id = connector.last_breadcrumb_id() or 0
+    route_id = _values(connector, f"SELECT route_id FROM {connector.trip_table} WHERE route_id IS NOT NULL LIMIT 1")
+    route_id = route_id[0] if route_id else None
+    trip_ids = trip_ids or [0]
+    newest = newest[0] if newest else dt.datetime.now()
+    day = dt.datetime.combine(newest.date(), dt.time())
+    unprocessed = "NOT is_in_final_table"
+
+    queries = [
+        ("raw_to_processed read", f"SELECT {column_list(RAW_SCHEMA)} FROM {connector.raw_table} WHERE {unprocessed}",
+         {}),
+        ("raw_to_processed read, shard 0/4",
+         f'SELECT {column_list(RAW_SCHEMA)} FROM {connector.raw_table} WHERE {unprocessed} AND '
+         f'(hashtext("EVENT_NO_TRIP"::text || \'|\' || "VEHICLE_ID"::text) & 2147483647) % 4 = 0', {}),
+        ("raw_to_processed mark", f"UPDATE {connector.raw_table} SET is_in_final_table = 't' WHERE {unprocessed}", {}),
+        # the inner query of SummaryMaterializer.refresh
+        ("summaries, 50 trips",
+         f"SELECT trip_id, tstamp, speed, latitude, longitude, EXTRACT(EPOCH FROM tstamp - lag(tstamp) OVER "
+         f"(PARTITION BY trip_id ORDER BY tstamp)) AS step_s FROM {connector.breadcrumb_table} "
+         f"WHERE trip_id = ANY(:trip_ids)", {"trip_ids": list(trip_ids)}),
+        ("geojson, one trip", *breadcrumb_query(connector, trip_id=trip_ids[0])),
+        ("arrow cache, one day",
+         f"SELECT {column_list(BREADCRUMB_SCHEMA)} FROM {connector.breadcrumb_table} "
+         f"WHERE tstamp >= :start AND tstamp < :end", {"start": day, "end": day + dt.timedelta(days=1)}),
+        ("tile server poll, last 1000 rows",
+         f"SELECT breadcrumb_id, {column_list(BREADCRUMB_SCHEMA)} FROM {connector.breadcrumb_table} "
+         f"WHERE breadcrumb_id > :since ORDER BY breadcrumb_id", {"since": last_id - 1000}),
+    ]
+    if route_id is not None:
+        queries.append(("geojson, one route", *breadcrumb_query(connector, route_id=route_id)))
+    return queries
+
+
+def _indexes(plan: dict) -> list[str]:
+    found = [plan["Index Name"]] if "Index Name" in plan else []
+    for child in plan.get("Plans", []):
+        found.extend(_indexes(child))
+    return found
+
+
+def explain(connector: PostgresConnector, queries: list[tuple]) -> dict:
+    """
+    EXPLAIN ANALYZE every query RUNS times, in a transaction that is rolled back so the UPDATE doesn't change anything.
+    A query on a table or column that the migrations haven't created yet (breadcrumb_id, or every table on a new
+    database) is skipped with the reason instead of failing the whole run.
+    :return: name -> best execution ms, planning ms, top plan node and the indexes the plan used, or skipped -> why
+    """
+    results = {}
+    for name, sql, params in queries:
+        best = None
+        for _ in range(RUNS):
+            with connector.engine.connect() as connection:
+                transaction = connection.begin()
+                try:
+                    plan = connection.execute(text(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}"),
+                                              params).scalar()
+                except ProgrammingError as e:
+                    best = str(e.orig).splitlines()[0]
+                    break
+                finally:
+                    transaction.rollback()
+            plan = plan[0] if isinstance(plan, list) else json.loads(plan)[0]
+            if best is None or plan["Execution Time"] < best["Execution Time"]:
+                best = plan
+        if isinstance(best, str):
+            results[name] = {"skipped": best}
+            continue
+        results[name] = {"execution_ms": round(best["Execution Time"], 2),
+                         "planning_ms": round(best["Planning Time"], 2), "node": best["Plan"]["Node Type"],
+                         "indexes": sorted(set(_indexes(best["Plan"])))}
+    return results
+
+
+def _describe(result: dict | None) -> str:
+    if result is None or "skipped" in result:
+        return f"{'skipped':>13}  {result['skipped'] if result else 'not run'}"
+    indexes = f" ({', '.join(result['indexes'])})" if result["indexes"] else ""
+    return f"{result['execution_ms']:>10.1f} ms  {result['node']}{indexes}"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the pipeline's queries with EXPLAIN ANALYZE. With --migrate "
+                                                 "they are timed, the schema migrations are applied and they are "
+                                                 "timed again")
+    parser.add_argument("--migrate", action="store_true", help="apply the migrations between two runs")
+    parser.add_argument("--output", help="write the timings to this JSON file")
+    args = parser.parse_args()
+
+    connector = PostgresConnector(migrate=False)
+    queries = pipeline_queries(connector)
+    before = explain(connector, queries)
+    timings = {"before": before}
+    if args.migrate:
+        print(f"Applied migrations {connector.migrate()}")
+        # the parameters are picked again in case the tables were only created now
+        after = explain(connector, pipeline_queries(connector))
+        timings["after"] = after
+        # the route query is only there once a trip has a route, which may only be the case after
+        for name in dict.fromkeys([*before, *after]):
+            print(f"{name:<36}{_describe(before.get(name))}\n{'':<36}{_describe(after.get(name))}")
+    else:
+        for name, result in before.items():
+            print(f"{name:<36}{_describe(result)}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(timings, f, indent=2)
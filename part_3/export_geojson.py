@@ -0,0 +1,38 @@
+import argparse
+import datetime as dt
+import gzip
+import os
+import sys
+import time
+from src.geojson_export import DEFAULT_PRECISION, DEFAULT_SPEED_PRECISION, export_geojson
+from src.postgres_connector import PostgresConnector
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the breadcrumb table as GeoJSON for the speed map")
+    parser.add_argument("output", help="file to write, - for stdout. Gzipped if it ends in .gz")
+    parser.add_argument("--trip", type=int, help="only this trip_id")
+    parser.add_argument("--route", help="only this route_id")
+    parser.add_argument("--vehicle", type=int, help="only this vehicle_id")
+    parser.add_argument("--start", type=dt.datetime.fromisoformat,
+                        help="only breadcrumbs at or after, e.g. 2024-04-15T06:00")
+    parser.add_argument("--end", type=dt.datetime.fromisoformat, help="only breadcrumbs before")
+    parser.add_argument("--precision", type=int, default=DEFAULT_PRECISION, help="decimal places of the coordinates")
+    parser.add_argument("--speed-precision", type=int, default=DEFAULT_SPEED_PRECISION)
+    parser.add_argument("--gzip", action="store_true", help="gzip even if the name doesn't end in .gz")
+    args = parser.parse_args()
+
+    if args.output == "-":
+        out = gzip.GzipFile(fileobj=sys.stdout.buffer, mode="wb") if args.gzip else sys.stdout.buffer
+    elif args.gzip or args.output.endswith(".gz"):
+        out = gzip.open(args.output, "wb", compresslevel=6)
+    else:
+        out = open(args.output, "wb")
+
+    start = time.perf_counter()
+    with out:
+        features = export_geojson(PostgresConnector(), out, precision=args.precision,
+                                  speed_precision=args.speed_precision, trip_id=args.trip, route_id=args.route,
+                                  vehicle_id=args.vehicle, start=args.start, end=args.end)
+    if args.output != "-":
+        print(f"Wrote {features} features to {args.output} ({os.path.getsize(args.output) / 1e6:.1f} MB) "
+              f"in {time.perf_counter() - start:.1f}s", file=sys.stderr)
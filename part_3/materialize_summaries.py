@@ -0,0 +1,14 @@
+import argparse
+import time
+from src.postgres_connector import PostgresConnector
+from src.summaries import SummaryMaterializer
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rebuild trip_summary and route_day_summary from the breadcrumb table")
+    parser.add_argument("--trip", type=int, nargs="*", help="only these trip ids, default is every trip")
+    args = parser.parse_args()
+
+    materializer = SummaryMaterializer(PostgresConnector())
+    start = time.perf_counter()
+    refreshed = materializer.refresh(args.trip) if args.trip else materializer.refresh_all()
+    print(f"Refreshed the summaries of {refreshed} trips in {time.perf_counter() - start:.1f}s")
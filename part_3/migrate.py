@@ -0,0 +1,24 @@
+import argparse
+import time
+from src.postgres_connector import PostgresConnector
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Apply the schema migrations in src/migrations.py. The first one "
+                                                 "on an existing database rewrites raw and breadcrumb and locks them "
+                                                 "while it does, so stop the subscribers or run it when nothing is "
+                                                 "coming in")
+    parser.add_argument("--status", action="store_true", help="only show which migrations are applied")
+    args = parser.parse_args()
+
+    connector = PostgresConnector(migrate=False)
+    applied, pending = connector.migration_status()
+    for version, description in applied:
+        print(f"applied  {version}: {description}")
+    for version, description in pending:
+        print(f"pending  {version}: {description}")
+    if args.status or not pending:
+        exit(0)
+
+    start = time.perf_counter()
+    versions = connector.migrate()
+    print(f"Applied migrations {versions} in {time.perf_counter() - start:.1f}s")
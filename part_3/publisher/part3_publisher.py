@@ -1,4 +1,5 @@
 from google.cloud import pubsub_v1
+from concurrent import futures
 import json
 import requests
 import os
@@ -6,15 +7,21 @@ from io import StringIO
 import re
 from bs4 import BeautifulSoup
 import pandas as pd
+from src.response_cache import RESPONSE_CACHE_DIR, ResponseCache
 # pip command to install google cloud pubsub: pip install google-cloud-pubsub
 
 project_id = os.environ.get("PROJECT_ID")
 topic_id = os.environ.get("PART3_TOPIC_ID")
+# YYYY-MM-DD to publish that day's cached responses again instead of calling the api
+replay_date = os.environ.get("REPLAY_DATE")
+STOP_EVENT_API = "https://busdata.cs.pdx.edu/api/getStopEvents"
 
 class Breadcrumb_publisher:
     def __init__(self, project_id, topic_id):
         self.client = pubsub_v1.PublisherClient()
         self.topic_path = self.client.topic_path(project_id, topic_id)
+        # publish futures since the last wait_for_publishes, only waited on when the response cache is on
+        self._futures = []
 
     def read_file_and_convert_to_ints(self, filename) -> list[int]:
         """
@@ -71,8 +78,20 @@ class Breadcrumb_publisher:
         data = json.dumps(some_json, indent=4).encode("utf-8")
         future = self.client.publish(self.topic_path, data)
         future.add_done_callback(self.future_callback)
+        self._futures.append(future)
 
         return 1
+
+    def wait_for_publishes(self) -> int:
+        """
+        Wait for everything published since the last call to go out.
+        :return: number of messages that failed to publish
+        """
+        pending, self._futures = self._futures, []
+        if not pending:
+            return 0
+        futures.wait(pending)
+        return sum(1 for future in pending if future.exception() is not None)
     
 def html_to_breadcrumb(html: str) -> list[dict]:
     """
@@ -109,11 +128,24 @@ if __name__ == '__main__':
         print("No vehicle ids found in file")
         exit(1)
 
+    cache = None
+    if RESPONSE_CACHE_DIR:
+        cache = ResponseCache(RESPONSE_CACHE_DIR, day=replay_date, offline=replay_date is not None)
+    elif replay_date:
+        print("REPLAY_DATE needs RESPONSE_CACHE_DIR")
+        exit(1)
+
     for vehicle_id in vehicle_ids:
-        api = f"https://busdata.cs.pdx.edu/api/getStopEvents?vehicle_num={vehicle_id}"
-        r = requests.get(api)
+        if cache is not None:
+            r = cache.fetch(STOP_EVENT_API, "getStopEvents", vehicle_id, params={"vehicle_num": vehicle_id})
+        else:
+            r = requests.get(f"{STOP_EVENT_API}?vehicle_num={vehicle_id}")
         if not r.ok:
-            print(f"Failed to get breadcrumbs for vehicle id: {vehicle_id}")
+            if cache is None or not cache.offline:
+                print(f"Failed to get breadcrumbs for vehicle id: {vehicle_id}")
+            continue
+        if cache is not None and not r.changed:
+            print(f"Stop events for vehicle id: {vehicle_id} haven't changed since they were published, skipping")
             continue
 
         try:
@@ -124,6 +156,16 @@ if __name__ == '__main__':
         except Exception as e:
             print(f"Error processing breadcrumbs for vehicle id: {vehicle_id}")
             continue
+        # the response only counts as published once every message is out, otherwise the next run has to send it again
+        if cache is not None:
+            failed = publisher.wait_for_publishes()
+            if failed:
+                print(f"{failed} messages failed to publish for vehicle id: {vehicle_id}")
+            else:
+                cache.mark_published("getStopEvents", vehicle_id, r)
 
         print(f"Published {successful_messages} messages for vehicle id: {vehicle_id}")
 
+    if cache is not None:
+        print(f"Response cache: {cache.report()}")
+
@@ -1,11 +1,20 @@
 from google.cloud import pubsub_v1
+from concurrent import futures
 import json
 import requests
 import os
+import time
+from src.response_cache import RESPONSE_CACHE_DIR, ResponseCache
+from src.seen_set import SEEN_SET_DIR, SeenSet
 # pip command to install google cloud pubsub: pip install google-cloud-pubsub
 
 project_id = os.environ.get("PROJECT_ID")
 topic_id = os.environ.get("TOPIC_ID")
+# YYYY-MM-DD to publish that day's cached responses again instead of calling the api
+replay_date = os.environ.get("REPLAY_DATE")
+BREADCRUMB_API = "https://busdata.cs.pdx.edu/api/getBreadCrumbs"
+# writing the seen-set is ~12 MB per day, so it's saved every so often instead of after every vehicle
+SEEN_SET_SAVE_SECONDS = 60
 
 
 class Discord_logger:
@@ -68,6 +77,7 @@ class Breadcrumb_publisher:
         self.logger = logger
         self.client = pubsub_v1.PublisherClient()
         self.topic_path = self.client.topic_path(project_id, topic_id)
+        self._futures = []
 
     def read_file_and_convert_to_ints(self, filename) -> list[int]:
         """
@@ -123,9 +133,21 @@ class Breadcrumb_publisher:
         data = json.dumps(some_json, indent=4).encode("utf-8")
         future = self.client.publish(self.topic_path, data)
         future.add_done_callback(self.future_callback)
+        self._futures.append(future)
 
         return 1
 
+    def wait_for_publishes(self) -> int:
+        """
+        Wait for everything published since the last call to go out.
+        :return: number of messages that failed to publish
+        """
+        pending, self._futures = self._futures, []
+        if not pending:
+            return 0
+        futures.wait(pending)
+        return sum(1 for future in pending if future.exception() is not None)
+
 if __name__ == '__main__':
     logger = Discord_logger("https://discord.com/api/webhooks/1226677851843989657/tiieQtc6oXsgkkZQb8bc7BT___vgH8H-gHEOiiV_6wPdKlB-wseYFTnupQ4_sb4DefcY")
     publisher = Breadcrumb_publisher(logger, project_id, topic_id)
@@ -135,19 +157,67 @@ if __name__ == '__main__':
         logger.send()
         exit(1)
 
+    # the cache makes a rerun after a crash only fetch (and publish) what it hadn't done yet, see src/response_cache.py
+    cache = None
+    if RESPONSE_CACHE_DIR:
+        cache = ResponseCache(RESPONSE_CACHE_DIR, day=replay_date, offline=replay_date is not None)
+    elif replay_date:
+        logger.error("REPLAY_DATE needs RESPONSE_CACHE_DIR")
+        logger.send()
+        exit(1)
+    # breadcrumbs that were published by an earlier run (or an earlier fetch in this one) are skipped, except when
+    # replaying a day on purpose
+    seen = SeenSet(SEEN_SET_DIR) if SEEN_SET_DIR and not replay_date else None
+    # the seen-set is only written while every publish so far went through, otherwise a failed message would be
+    # skipped on the rerun
+    publish_failures = 0
+    last_save = time.monotonic()
+
     for vehicle_id in vehicle_ids:
-        api = f"https://busdata.cs.pdx.edu/api/getBreadCrumbs?vehicle_id={vehicle_id}"
-        r = requests.get(api)
+        if cache is not None:
+            r = cache.fetch(BREADCRUMB_API, "getBreadCrumbs", vehicle_id, params={"vehicle_id": vehicle_id})
+        else:
+            r = requests.get(f"{BREADCRUMB_API}?vehicle_id={vehicle_id}")
         if not r.ok:
-            logger.error(f"Error getting breadcrumbs for vehicle id: {vehicle_id}")
+            if cache is None or not cache.offline:
+                logger.error(f"Error getting breadcrumbs for vehicle id: {vehicle_id}")
+            continue
+        if cache is not None and not r.changed:
+            logger.info(f"Breadcrumbs for vehicle id: {vehicle_id} haven't changed since they were published, skipping")
             continue
 
         breadcrumbs = r.json()
         successful_messages = 0
+        skipped = 0
         for breadcrumb in breadcrumbs:
+            if seen is not None and not seen.add(breadcrumb):
+                skipped += 1
+                continue
             successful_messages += 1 if publisher.publish_json_breadcrumb(breadcrumb) == 1 else 0
 
-        logger.info(f"Published {successful_messages} messages for vehicle id: {vehicle_id}")
+        failed = publisher.wait_for_publishes() if seen is not None or cache is not None else 0
+        if failed:
+            publish_failures += failed
+            logger.error(f"{failed} messages failed to publish for vehicle id: {vehicle_id}")
+        elif cache is not None:
+            cache.mark_published("getBreadCrumbs", vehicle_id, r)
+        if seen is not None and not publish_failures and time.monotonic() - last_save > SEEN_SET_SAVE_SECONDS:
+            seen.save()
+            last_save = time.monotonic()
+
+        logger.info(f"Published {successful_messages} messages for vehicle id: {vehicle_id}"
+                    + (f", skipped {skipped} that were already published" if skipped else ""))
 
         logger.send()
 
+    if seen is not None:
+        if publish_failures:
+            logger.error(f"{publish_failures} messages failed to publish, not saving the seen-set so a rerun sends them")
+        else:
+            seen.save()
+        logger.info(f"Seen-set: {seen.report()}")
+    if cache is not None:
+        logger.info(f"Response cache: {cache.report()}")
+    if seen is not None or cache is not None:
+        logger.send()
+
@@ -0,0 +1,27 @@
+import argparse
+import os
+import time
+from src.postgres_connector import PostgresConnector
+from src.spill_log import SPILL_DIR, SpillingWriter, SpillLog
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write the batches in the spill log(s) to Postgres. Don't run it on a "
+                                                 "directory a running subscriber is writing to")
+    parser.add_argument("directory", nargs="?", default=SPILL_DIR,
+                        help="spill directory, the worker and stop event logs under it are replayed too")
+    parser.add_argument("--status", action="store_true", help="only show what is in the logs")
+    args = parser.parse_args()
+
+    directories = [root for root, _, files in os.walk(args.directory) if any(f.endswith(".spill") for f in files)]
+    connector = None if args.status else PostgresConnector()
+    for directory in sorted(directories):
+        log = SpillLog(directory)
+        segments = log.segments()
+        print(f"{directory}: {len(segments)} segments, {log.size() / 1e6:.1f} MB")
+        if args.status:
+            continue
+        start = time.perf_counter()
+        writer = SpillingWriter(connector, log)
+        replayed = writer.replay()
+        log.close()
+        print(f"Replayed {replayed} batches from {directory} in {time.perf_counter() - start:.1f}s")
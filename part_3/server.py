@@ -1,9 +1,354 @@
+import argparse
+import datetime as dt
+import gzip
 import http.server
-import socketserver
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+import pandas as pd
+from src.geojson_export import export_geojson
+from src.spatial_index import GridIndex, points_to_geojson
+from src.static_files import StaticFiles, precompress
+from src.vector_tiles import SpeedTiles, TileCache
 
 PORT = 8000
-Handler = http.server.SimpleHTTPRequestHandler
+MAX_POINTS = 20000
+TILE_CACHE_DIR = os.environ.get("TILE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "speed_map_tiles"))
+TILE_PATH = re.compile(r"^/tiles/(\d+)/(\d+)/(\d+)\.mvt$")
+RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+# how long an idle keep-alive connection holds on to its thread
+KEEP_ALIVE_TIMEOUT = 30
+COPY_BUFFER = 256 * 1024
 
-with socketserver.TCPServer(("", PORT), Handler) as http:
-    print("serving at port", PORT)
-    http.serve_forever()
+
+def load_geojson(path: str) -> pd.DataFrame:
+    """
+    Read a FeatureCollection of speed points like data.geojson into the same columns as the breadcrumb table.
+    """
+    with open(path, encoding="utf-8") as f:
+        # raw_decode stops at the end of the object, data.geojson has a shell prompt pasted after it
+        features = json.JSONDecoder().raw_decode(f.read())[0]["features"]
+    return pd.DataFrame({
+        "longitude": [feature["geometry"]["coordinates"][0] for feature in features],
+        "latitude": [feature["geometry"]["coordinates"][1] for feature in features],
+        "speed": [feature["properties"].get("speed") for feature in features],
+    })
+
+
+def parse_range(header: str, length: int):
+    """
+    :return: (first, last) byte of a single Range header, None to ignore it (not bytes, several ranges, or a last byte
+    before the first, which the RFC says is invalid and not unsatisfiable), or (None, None) if it can't be satisfied
+    """
+    match = RANGE.match(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if first and last and int(last) < int(first):
+        return None
+    if not first:
+        # bytes=-500 is the last 500 bytes
+        first, last = max(length - int(last), 0), length - 1
+    else:
+        first, last = int(first), min(int(last), length - 1) if last else length - 1
+    if first >= length:
+        return None, None
+    return first, last
+
+
+class _ChunkedWriter:
+    """
+    Chunked transfer encoding around the wfile, for responses whose length isn't known up front on a keep-alive
+    connection.
+    """
+
+    def __init__(self, wfile):
+        self._wfile = wfile
+
+    def write(self, data: bytes) -> int:
+        if data:
+            self._wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        return len(data)
+
+    def flush(self) -> None:
+        self._wfile.flush()
+
+    def close(self) -> None:
+        self._wfile.write(b"0\r\n\r\n")
+
+
+def parse_time(value: str) -> int | None:
+    """
+    Accepts seconds since the epoch or an ISO date/time.
+    """
+    if value is None:
+        return None
+    try:
+        return int(float(value))
+    except ValueError:
+        return int(dt.datetime.fromisoformat(value).replace(tzinfo=dt.timezone.utc).timestamp())
+
+
+class MapRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serves the static files (index.html) like before plus /api/points, which returns only the breadcrumbs inside the
+    requested bounding box and time window, thinned out for the zoom level:
+
+        /api/points?bbox=west,south,east,north&zoom=12&start=2024-04-15T06:00&end=2024-04-15T09:00
+
+    and the speeds layer as vector tiles, which is what the map uses:
+
+        /tiles/12/650/1464.mvt
+
+    With --postgres, /api/export.geojson streams the breadcrumb table as GeoJSON straight from a server side cursor,
+    filtered by trip_id, route_id, vehicle_id, start and end, and gzipped if the client accepts it.
+
+    It speaks HTTP/1.1 so browsers keep the connection open between requests, and static files go through
+    StaticFiles, which keeps them in memory and picks the gzip or brotli variant the client accepts. If-None-Match gets
+    a 304 and a Range header on the uncompressed file gets a 206 for that part of it.
+    """
+    protocol_version = "HTTP/1.1"
+    timeout = KEEP_ALIVE_TIMEOUT
+    index = None
+    tiles = None
+    connector = None
+    static = StaticFiles()
+    quiet = False
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+    def _not_modified(self, etag: str) -> bool:
+        tags = [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]
+        return etag in tags or "*" in tags
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        tile = TILE_PATH.match(url.path)
+        if url.path == "/api/points":
+            self._send_points(parse_qs(url.query))
+        elif url.path == "/api/export.geojson" and self.connector is not None:
+            self._send_export(parse_qs(url.query))
+        elif tile:
+            self._send_tile(*(int(value) for value in tile.groups()))
+        else:
+            self._send_static(url.path)
+
+    def do_HEAD(self):
+        self._send_static(urlparse(self.path).path, head=True)
+
+    def _send_static(self, path: str, head: bool = False) -> None:
+        file_path = self.translate_path(path)
+        if os.path.isdir(file_path):
+            file_path = os.path.join(file_path, "index.html")
+        response = self.static.get(file_path, self.headers.get("Accept-Encoding", ""))
+        if response is None:
+            self.send_error(404, "File not found")
+            return
+
+        if self._not_modified(response.etag):
+            self.send_response(304)
+            self.send_header("ETag", response.etag)
+            self.send_header("Cache-Control", response.cache_control)
+            self.end_headers()
+            return
+
+        first, last = 0, response.length - 1
+        status = 200
+        # ranges are only served from the uncompressed file, a range of the gzip bytes isn't useful to anyone
+        if response.encoding is None and "Range" in self.headers:
+            requested = parse_range(self.headers["Range"], response.length)
+            if requested == (None, None):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{response.length}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if requested is not None:
+                (first, last), status = requested, 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", response.content_type)
+        self.send_header("Content-Length", str(last - first + 1))
+        self.send_header("ETag", response.etag)
+        self.send_header("Cache-Control", response.cache_control)
+        self.send_header("Last-Modified", self.date_time_string(response.mtime))
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Accept-Ranges", "bytes")
+        if response.encoding:
+            self.send_header("Content-Encoding", response.encoding)
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {first}-{last}/{response.length}")
+        self.end_headers()
+        if head:
+            return
+
+        if response.body is not None:
+            self.wfile.write(response.body[first:last + 1])
+            return
+        with open(response.path, "rb") as f:
+            f.seek(first)
+            remaining = last - first + 1
+            while remaining > 0:
+                chunk = f.read(min(COPY_BUFFER, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def _send_tile(self, z: int, x: int, y: int) -> None:
+        tile = self.tiles.tile(z, x, y)
+        if tile is None:
+            self.send_error(404, "No such tile")
+            return
+        data, etag = tile
+        etag = f'"{etag}"'
+        # tiles change when new breadcrumbs come in, so the browser has to check, but a 304 is all it gets back
+        if self._not_modified(etag):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.mapbox-vector-tile")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_export(self, query: dict) -> None:
+        try:
+            filters = {
+                "trip_id": int(query["trip_id"][0]) if "trip_id" in query else None,
+                "route_id": query["route_id"][0] if "route_id" in query else None,
+                "vehicle_id": int(query["vehicle_id"][0]) if "vehicle_id" in query else None,
+            }
+            for key in ("start", "end"):
+                seconds = parse_time(query.get(key, [None])[0])
+                filters[key] = dt.datetime.fromtimestamp(seconds, dt.timezone.utc).replace(tzinfo=None) \
+                    if seconds is not None else None
+            precision = int(query.get("precision", [5])[0])
+        except ValueError as e:
+            self.send_error(400, f"Bad query: {e}")
+            return
+
+        # the length isn't known until the last row is written, so the response is chunked
+        self.send_response(200)
+        self.send_header("Content-Type", "application/geo+json")
+        self.send_header("Transfer-Encoding", "chunked")
+        compress = "gzip" in self.headers.get("Accept-Encoding", "")
+        if compress:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        out = _ChunkedWriter(self.wfile)
+        if compress:
+            with gzip.GzipFile(fileobj=out, mode="wb", compresslevel=6) as compressed:
+                export_geojson(self.connector, compressed, precision=precision, **filters)
+        else:
+            export_geojson(self.connector, out, precision=precision, **filters)
+        out.close()
+
+    def _send_points(self, query: dict) -> None:
+        try:
+            west, south, east, north = (float(value) for value in query["bbox"][0].split(","))
+            zoom = float(query["zoom"][0]) if "zoom" in query else None
+            start = parse_time(query.get("start", [None])[0])
+            end = parse_time(query.get("end", [None])[0])
+            limit = min(int(query.get("limit", [MAX_POINTS])[0]), MAX_POINTS)
+        except (KeyError, ValueError) as e:
+            self.send_error(400, f"Bad query: {e}")
+            return
+
+        points = self.index.query(west, south, east, north, start=start, end=end, zoom=zoom, limit=limit)
+        body = json.dumps(points_to_geojson(points), separators=(",", ":")).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/geo+json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def follow_breadcrumbs(connector, tiles: SpeedTiles, since: int, interval: float) -> None:
+    """
+    Poll the breadcrumb table for rows added after the ones we have and add them to the tiles. The watermark is
+    breadcrumb_id, the identity key from the schema migrations, and not tstamp: a row can be committed long after rows
+    with a newer tstamp (a trip finished in the next raw_to_processed, a spill log replay), but it always gets a new id.
+    :param since: the highest breadcrumb_id already in the tiles
+    """
+    from sqlalchemy import text
+    from src.schema import BREADCRUMB_SCHEMA, apply_schema, column_list
+    query = (f"SELECT breadcrumb_id, {column_list(BREADCRUMB_SCHEMA)} FROM {connector.breadcrumb_table} "
+             f"WHERE breadcrumb_id > :since ORDER BY breadcrumb_id")
+    while True:
+        time.sleep(interval)
+        try:
+            new = apply_schema(pd.read_sql(text(query), connector.engine, params={"since": since}), BREADCRUMB_SCHEMA)
+        except Exception as e:
+            print(f"Error reading new breadcrumbs: {e}")
+            continue
+        if new.empty:
+            continue
+        since = int(new["breadcrumb_id"].max())
+        invalidated = tiles.add_breadcrumbs(new.drop(columns="breadcrumb_id"))
+        print(f"added {len(new)} breadcrumbs, {invalidated} tiles invalidated")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the speed map")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--geojson", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "data.geojson"),
+                        help="load the points from this file")
+    parser.add_argument("--postgres", action="store_true", help="load the points from the breadcrumb table instead")
+    parser.add_argument("--refresh", type=float, default=0,
+                        help="with --postgres, check for new breadcrumbs every this many seconds")
+    parser.add_argument("--tile-cache", default=TILE_CACHE_DIR, help="directory for rendered tiles")
+    parser.add_argument("--precompress", action="store_true",
+                        help="write .gz/.br versions of index.html and the geojson file before starting")
+    parser.add_argument("--quiet", action="store_true", help="don't log every request")
+    args = parser.parse_args()
+
+    if args.precompress:
+        here = os.path.dirname(os.path.abspath(__file__))
+        print(f"precompressed {precompress([os.path.join(here, 'index.html'), args.geojson])} files")
+    MapRequestHandler.quiet = args.quiet
+
+    if args.postgres:
+        from src.postgres_connector import PostgresConnector
+        connector = PostgresConnector()
+        MapRequestHandler.connector = connector
+        # the points are read up to this id and follow_breadcrumbs carries on after it, so nothing is missed or doubled
+        last_id = None
+        if args.refresh:
+            last_id = connector.last_breadcrumb_id()
+            if last_id is None:
+                print("The breadcrumb table has no breadcrumb_id, run migrate.py to follow it. Not refreshing")
+        points_df = connector.get_breadcrumb(up_to_id=last_id)
+        newest = points_df["tstamp"].max() if len(points_df) else pd.Timestamp(0)
+        version = ("postgres", len(points_df), str(newest))
+    else:
+        points_df = load_geojson(args.geojson)
+        version = ("geojson", os.path.abspath(args.geojson), os.path.getmtime(args.geojson))
+    MapRequestHandler.index = GridIndex.from_frame(points_df)
+    print(f"indexed {len(MapRequestHandler.index)} points")
+
+    MapRequestHandler.tiles = SpeedTiles(MapRequestHandler.index, TileCache(args.tile_cache, version=version))
+    start = time.perf_counter()
+    rendered = MapRequestHandler.tiles.precompute()
+    print(f"precomputed {rendered} tiles in {time.perf_counter() - start:.1f}s")
+    if args.postgres and args.refresh and last_id is not None:
+        threading.Thread(target=follow_breadcrumbs, args=(connector, MapRequestHandler.tiles, last_id, args.refresh),
+                         daemon=True).start()
+
+    # a thread per connection, so a slow client or a long export doesn't hold up everyone else
+    with http.server.ThreadingHTTPServer(("", args.port), MapRequestHandler) as server:
+        print("serving at port", args.port)
+        server.serve_forever()
@@ -0,0 +1,170 @@
+import datetime as dt
+import glob
+import hashlib
+import os
+import threading
+import uuid
+import pandas as pd
+import pyarrow as pa
+from sqlalchemy import text
+from sqlalchemy.exc import ProgrammingError
+from src.schema import BREADCRUMB_SCHEMA, column_list
+
+DEFAULT_MAX_BYTES = 4 * 1024 ** 3
+
+
+class ArrowTableCache:
+    """
+    Read through cache of query results as Arrow IPC files. The first read of a (name, version) runs the loader and
+    writes the result to cache_dir, every later read memory maps the file, which is zero copy and basically free no
+    matter how big the table is. The version is whatever identifies the data, e.g. a watermark like the max timestamp
+    and row count. When a name is stored under a new version the old files for that name are deleted, and when the
+    directory grows past max_bytes the least recently read files are evicted.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, name: str, version) -> str:
+        digest = hashlib.sha1(repr(version).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{name}@{digest}.arrow")
+
+    def get(self, name: str, version, loader) -> pa.Table:
+        """
+        :param name: file system safe name for the table or partition, e.g. "breadcrumb-2024-04-15"
+        :param version: anything with a stable repr that changes when the data changes
+        :param loader: called on a miss, returns a pa.Table or a pd.DataFrame
+        :return: pa.Table backed by the memory mapped file
+        """
+        path = self._path(name, version)
+        if os.path.exists(path):
+            try:
+                table = self._open(path)
+                os.utime(path)
+                with self._lock:
+                    self.hits += 1
+                return table
+            except (OSError, pa.ArrowInvalid):
+                # evicted between exists and open, or a truncated file, just load it again
+                pass
+
+        with self._lock:
+            self.misses += 1
+        data = loader()
+        table = pa.Table.from_pandas(data, preserve_index=False) if isinstance(data, pd.DataFrame) else data
+
+        # write to a temporary name and rename so a reader never maps a half written file
+        temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+        with pa.OSFile(temporary, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(temporary, path)
+
+        self.invalidate(name, keep=path)
+        self._evict()
+        return self._open(path)
+
+    def _open(self, path: str) -> pa.Table:
+        return pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+
+    def invalidate(self, name: str, keep: str = None) -> None:
+        """
+        Delete every cached version of name (except keep).
+        """
+        for path in glob.glob(os.path.join(glob.escape(self.cache_dir), f"{glob.escape(name)}@*.arrow")):
+            if path != keep:
+                self._remove(path)
+
+    def _evict(self) -> None:
+        files = []
+        for path in glob.glob(os.path.join(glob.escape(self.cache_dir), "*.arrow")):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        # oldest read first, never evict the file we just wrote
+        for _, size, path in sorted(files)[:-1]:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path: str) -> None:
+        # files that are still memory mapped stay readable after the unlink on linux
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def size(self) -> int:
+        return sum(os.path.getsize(path) for path in glob.glob(os.path.join(glob.escape(self.cache_dir), "*.arrow")))
+
+
+class CachedTableReader:
+    """
+    Drop in for the get_breadcrumb/get_trip methods of PostgresConnector that goes through an ArrowTableCache. Whole
+    tables are versioned with their row count and the newest row. For breadcrumb that is max(breadcrumb_id), which every
+    insert raises and the primary key answers right away, and rows are never updated in place. trip rows are updated
+    (the stop events fill in the route), so trip uses the newest xmin instead, the id of the transaction that wrote the
+    row, which changes on updates too. The table is small enough that scanning it for that is nothing. A single day of
+    breadcrumbs is versioned with its row count and max timestamp, so appending a new day doesn't invalidate the days
+    that are already cached.
+
+    pg_stat_user_tables would be cheaper but isn't a version: its counters are only updated some time after a commit,
+    and n_live_tup changes when the table is vacuumed or analyzed.
+    """
+
+    def __init__(self, connector, cache: ArrowTableCache):
+        self._connector = connector
+        self._cache = cache
+
+    def _table_version(self, table: str, key: str = None):
+        """
+        :param key: an identity column that only ever goes up, without one (or if the schema migrations that add it
+        haven't been applied) the row versions' xmin is used
+        """
+        newest = key if key is not None else "xmin::text::bigint"
+        try:
+            with self._connector.engine.connect() as connection:
+                row = connection.execute(text(f"SELECT count(*), max({newest}) FROM {table}")).fetchone()
+        except ProgrammingError:
+            if key is None:
+                raise
+            return self._table_version(table)
+        return (newest,) + tuple(row)
+
+    def _day_version(self, table: str, day: dt.date):
+        with self._connector.engine.connect() as connection:
+            row = connection.execute(text(
+                f"SELECT count(*), max(tstamp) FROM {table} WHERE tstamp >= :start AND tstamp < :end"),
+                {"start": day, "end": day + dt.timedelta(days=1)}).fetchone()
+        return tuple(row)
+
+    def get_breadcrumb(self, day: dt.date = None, as_arrow: bool = False):
+        """
+        :param day: only this service day, None reads the whole table
+        :param as_arrow: return the memory mapped pa.Table instead of converting to pandas
+        """
+        table = self._connector.breadcrumb_table
+        if day is None:
+            result = self._cache.get(table, self._table_version(table, "breadcrumb_id"), self._connector.get_breadcrumb)
+        else:
+            def load_day():
+                return pd.read_sql(text(f"SELECT {column_list(BREADCRUMB_SCHEMA)} FROM {table} "
+                                        f"WHERE tstamp >= :start AND tstamp < :end"),
+                                   self._connector.engine,
+                                   params={"start": day, "end": day + dt.timedelta(days=1)})
+            result = self._cache.get(f"{table}-{day.isoformat()}", self._day_version(table, day), load_day)
+        return result if as_arrow else result.to_pandas()
+
+    def get_trip(self, as_arrow: bool = False):
+        table = self._connector.trip_table
+        result = self._cache.get(table, self._table_version(table), self._connector.get_trip)
+        return result if as_arrow else result.to_pandas()
@@ -0,0 +1,175 @@
+import datetime as dt
+import os
+import threading
+import time
+import uuid
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+from src.date_cache import opd_date_cache
+
+# the breadcrumb exactly as the api sends it, using the same narrow types as src/schema.py. Everything is nullable
+# because the archive keeps every message, including the ones validation throws away
+ARCHIVE_SCHEMA = pa.schema([
+    ("EVENT_NO_TRIP", pa.int32()),
+    ("EVENT_NO_STOP", pa.int32()),
+    # int32 indices, an archive rebuilt from a few months of NDJSON has more than the 127 dates int8 would allow
+    ("OPD_DATE", pa.dictionary(pa.int32(), pa.string())),
+    ("VEHICLE_ID", pa.int32()),
+    ("METERS", pa.int32()),
+    ("ACT_TIME", pa.int32()),
+    ("GPS_LONGITUDE", pa.float32()),
+    ("GPS_LATITUDE", pa.float32()),
+    ("GPS_HDOP", pa.float32()),
+    ("GPS_SATELLITES", pa.int8()),
+    ("service_date", pa.date32()),
+])
+PARTITIONING = ds.partitioning(pa.schema([("service_date", pa.date32())]), flavor="hive")
+ROW_GROUP_SIZE = 128 * 1024
+# columns process_batch actually needs, everything else is never read off disk
+BATCH_COLUMNS = ["EVENT_NO_TRIP", "OPD_DATE", "VEHICLE_ID", "METERS", "ACT_TIME", "GPS_LONGITUDE", "GPS_LATITUDE"]
+
+
+def _service_date(opd_date) -> dt.date | None:
+    parsed = opd_date_cache.try_parse(opd_date)
+    return parsed.date() if parsed is not None else None
+
+
+def breadcrumbs_to_table(breadcrumbs: pd.DataFrame | list[dict]) -> pa.Table:
+    """
+    Convert api breadcrumbs to an arrow table in ARCHIVE_SCHEMA. Values that don't fit their column (a string in
+    METERS, say) become nulls rather than failing the whole batch.
+    :param breadcrumbs: DataFrame or list of breadcrumb dicts
+    :return: pa.Table
+    """
+    df = breadcrumbs if isinstance(breadcrumbs, pd.DataFrame) else pd.DataFrame(breadcrumbs)
+    columns = {}
+    for field in ARCHIVE_SCHEMA:
+        if field.name == "service_date":
+            continue
+        if field.name not in df.columns:
+            columns[field.name] = pa.nulls(len(df), field.type)
+        elif field.name == "OPD_DATE":
+            values = df[field.name].where(df[field.name].map(lambda v: isinstance(v, str)), None)
+            columns[field.name] = pa.array(values, pa.string()).dictionary_encode().cast(field.type)
+        else:
+            values = pd.to_numeric(df[field.name], errors="coerce")
+            columns[field.name] = pa.array(values, field.type, from_pandas=True, safe=False)
+    opd_dates = df["OPD_DATE"] if "OPD_DATE" in df.columns else pd.Series([None] * len(df))
+    columns["service_date"] = pa.array(opd_dates.map(_service_date), pa.date32())
+    return pa.Table.from_pydict(columns, schema=ARCHIVE_SCHEMA)
+
+
+class ColumnarArchiveWriter:
+    """
+    Writes the raw breadcrumb archive as Parquet, partitioned by service day (root/service_date=2024-04-15/...). This
+    replaces the NDJSON files from part 1: the files are a fraction of the size because of the narrow types, dictionary
+    encoded dates and compression, and reading a day back doesn't have to parse JSON. Rows are buffered and written as
+    one file per partition per flush with row groups of ROW_GROUP_SIZE, so the row group statistics are useful for
+    skipping data when reading. It is safe to call append from several threads. If a write fails the rows go back in
+    the buffer for the next flush and the error is raised to whoever triggered the flush.
+    """
+
+    def __init__(self, root: str, flush_rows: int = ROW_GROUP_SIZE, compression: str = "zstd"):
+        self.root = root
+        self.flush_rows = flush_rows
+        self.compression = compression
+        self.rows_written = 0
+        self.files_written = 0
+        self._pending = []
+        self._pending_rows = 0
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def append(self, breadcrumbs: pd.DataFrame | list[dict] | dict) -> None:
+        if isinstance(breadcrumbs, dict):
+            breadcrumbs = [breadcrumbs]
+        with self._lock:
+            self._pending.append(breadcrumbs)
+            self._pending_rows += len(breadcrumbs)
+            should_flush = self._pending_rows >= self.flush_rows
+        if should_flush:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending, self._pending_rows = self._pending, [], 0
+        if not pending:
+            return
+        try:
+            rows = self._write(pending)
+        except Exception:
+            # put the batch back in front of anything appended since, so nothing is lost and the order stays the same
+            with self._lock:
+                self._pending = pending + self._pending
+                self._pending_rows += sum(len(batch) for batch in pending)
+            raise
+        with self._lock:
+            self.rows_written += rows
+            self.files_written += 1
+
+    def _write(self, pending: list) -> int:
+        records = []
+        tables = []
+        for batch in pending:
+            if isinstance(batch, pd.DataFrame):
+                tables.append(breadcrumbs_to_table(batch))
+            else:
+                records.extend(batch)
+        if records:
+            tables.append(breadcrumbs_to_table(records))
+        table = pa.concat_tables(tables).unify_dictionaries().combine_chunks()
+
+        # every flush gets its own file name so appends never overwrite an earlier flush in the same partition
+        basename = f"part-{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}-{{i}}.parquet"
+        ds.write_dataset(table, self.root, format="parquet", partitioning=PARTITIONING,
+                         basename_template=basename, existing_data_behavior="overwrite_or_ignore",
+                         file_options=ds.ParquetFileFormat().make_write_options(compression=self.compression),
+                         min_rows_per_group=min(ROW_GROUP_SIZE, table.num_rows), max_rows_per_group=ROW_GROUP_SIZE)
+        return table.num_rows
+
+    @property
+    def pending_rows(self) -> int:
+        return self._pending_rows
+
+    def close(self) -> None:
+        self.flush()
+
+
+def read_archive(root: str, columns: list[str] = None, service_date: dt.date = None,
+                 predicate: ds.Expression = None) -> pd.DataFrame:
+    """
+    Read breadcrumbs back from a columnar archive. Only the requested columns are read, a service_date prunes the other
+    day partitions without opening them, and predicate is pushed down into the scan so row groups whose statistics can't
+    match are skipped.
+    :param root: archive directory
+    :param columns: columns to read, None means all of them
+    :param service_date: only read this day
+    :param predicate: extra pyarrow.dataset expression, e.g. ds.field("VEHICLE_ID") == 3908
+    :return: pd.DataFrame
+    """
+    dataset = ds.dataset(root, format="parquet", partitioning=PARTITIONING)
+    expression = predicate
+    if service_date is not None:
+        day = ds.field("service_date") == pa.scalar(service_date, pa.date32())
+        expression = day if expression is None else expression & day
+    table = dataset.to_table(columns=columns, filter=expression)
+    return table.to_pandas()
+
+
+def convert_ndjson(path: str, root: str, chunksize: int = 500_000) -> int:
+    """
+    Convert one of the part 1 NDJSON archives into the columnar archive, a chunk at a time so a whole day never has
+    to fit in memory.
+    :param path: path to the .ndjson file
+    :param root: archive directory to write into
+    :return: number of rows converted
+    """
+    writer = ColumnarArchiveWriter(root, flush_rows=chunksize)
+    rows = 0
+    with pd.read_json(path, lines=True, chunksize=chunksize, dtype=False) as reader:
+        for chunk in reader:
+            writer.append(chunk)
+            rows += len(chunk)
+    writer.close()
+    return rows
@@ -0,0 +1,166 @@
+import os
+import time
+from src.instrumentation import metrics
+
+ADAPTIVE_FLUSH = os.environ.get("ADAPTIVE_FLUSH", "1") == "1"
+# how long a message should sit in the buffer plus how long its flush takes, at most
+FLUSH_TARGET_LATENCY_SECONDS = float(os.environ.get("FLUSH_TARGET_LATENCY_SECONDS", "10"))
+# the buffer is flushed before the messages in it add up to this many bytes
+FLUSH_MEMORY_BUDGET_BYTES = int(os.environ.get("FLUSH_MEMORY_BUDGET_BYTES", str(64 * 1024 ** 2)))
+FLUSH_MIN_ROWS = int(os.environ.get("FLUSH_MIN_ROWS", "20"))
+FLUSH_MAX_ROWS = int(os.environ.get("FLUSH_MAX_ROWS", "20000"))
+# weight of the newest observation in the moving averages
+SMOOTHING = 0.2
+# how long arrivals are counted before the rate is updated
+RATE_WINDOW_SECONDS = 1.0
+
+
+class AdaptiveFlushController:
+    """
+    Decides when the subscriber flushes its buffer, instead of a fixed MAX_BREADCRUMB. Three things are measured as we
+    go:
+
+    - the arrival rate, messages per second, as a moving average over one second windows
+    - the size of a message in bytes (the payload, which is close to what a buffered row costs in memory)
+    - how long a flush takes, fitted as fixed + per_row * rows from the recent flushes (a decaying least squares fit),
+      since a round trip costs about the same whether it carries 10 rows or 1000 and the rows add a bit each on top
+
+    The oldest message in a batch of n rows waits n / rate seconds for the batch to fill and then for the flush, so the
+    biggest batch that still makes target_latency is (target_latency - fixed) / (1 / rate + per_row). The batch size
+    moves halfway towards the smaller of that and what fits in memory_budget after every flush, clamped to
+    [min_rows, max_rows]. Bigger batches mean fewer round trips, so this is the most rows per round trip the latency
+    target allows. When messages slow down, due() says to flush a batch that has been waiting too long, the
+    subscriber checks it from its poll loop.
+
+    Every decision goes to the metrics as flush.{name}.* gauges (batch size, rate, the fitted costs, the predicted
+    latency) and a counter per flush reason. With adaptive=False the batch size stays at initial_rows, which is the old
+    behaviour. Not thread safe, the subscriber calls it under its own lock.
+    """
+
+    def __init__(self, name: str, initial_rows: int, target_latency: float = FLUSH_TARGET_LATENCY_SECONDS,
+                 memory_budget: int = FLUSH_MEMORY_BUDGET_BYTES, min_rows: int = FLUSH_MIN_ROWS,
+                 max_rows: int = FLUSH_MAX_ROWS, adaptive: bool = ADAPTIVE_FLUSH, clock=time.monotonic):
+        self.name = name
+        self.target_latency = target_latency
+        self.memory_budget = memory_budget
+        self.min_rows = min(min_rows, initial_rows)
+        self.max_rows = max(max_rows, initial_rows)
+        self.adaptive = adaptive
+        self.batch_size = initial_rows
+        self.last_reason = None
+        self._clock = clock
+
+        self._rows = 0
+        self._bytes = 0
+        self._oldest = None
+        self._rate = None
+        self._window_start = clock()
+        self._window_rows = 0
+        self._bytes_per_row = None
+        # decayed sums for the fit of flush seconds against rows
+        self._n = self._sx = self._sy = self._sxx = self._sxy = 0.0
+
+    def _average(self, current, value):
+        return value if current is None else current + SMOOTHING * (value - current)
+
+    def add(self, rows: int = 1, nbytes: int = 0) -> bool:
+        """
+        Count rows that were just buffered.
+        :return: True if the buffer should be flushed now
+        """
+        now = self._clock()
+        if self._oldest is None:
+            self._oldest = now
+        self._rows += rows
+        self._bytes += nbytes
+        if nbytes:
+            self._bytes_per_row = self._average(self._bytes_per_row, nbytes / rows)
+
+        self._window_rows += rows
+        elapsed = now - self._window_start
+        if elapsed >= RATE_WINDOW_SECONDS:
+            self._rate = self._average(self._rate, self._window_rows / elapsed)
+            self._window_start = now
+            self._window_rows = 0
+            metrics.gauge(f"flush.{self.name}.arrival_rate", round(self._rate, 1))
+
+        if self._rows >= self.batch_size:
+            return self._decide("size")
+        if self.adaptive and self._bytes >= self.memory_budget:
+            return self._decide("memory")
+        return self.due(now)
+
+    def due(self, now: float = None) -> bool:
+        """
+        :return: True if the oldest buffered row would miss the latency target if we waited any longer
+        """
+        if not self.adaptive or self._oldest is None:
+            return False
+        now = self._clock() if now is None else now
+        fixed, per_row = self._model()
+        if now - self._oldest + fixed + per_row * self._rows >= self.target_latency:
+            return self._decide("age")
+        return False
+
+    def _decide(self, reason: str) -> bool:
+        self.last_reason = reason
+        metrics.count(f"flush.{self.name}.reason.{reason}")
+        return True
+
+    def _model(self) -> tuple[float, float]:
+        if self._n < 1:
+            return 0.0, 0.0
+        mean_x = self._sx / self._n
+        mean_y = self._sy / self._n
+        variance = self._sxx / self._n - mean_x ** 2
+        if variance <= 1e-9 * max(mean_x ** 2, 1.0):
+            # every flush was about the same size, all we can say is the cost per row
+            return 0.0, mean_y / mean_x if mean_x else 0.0
+        per_row = max((self._sxy / self._n - mean_x * mean_y) / variance, 0.0)
+        fixed = max(mean_y - per_row * mean_x, 0.0)
+        return fixed, per_row
+
+    def flushed(self, rows: int, seconds: float) -> None:
+        """
+        Record a flush of rows that took seconds and pick the next batch size.
+        """
+        self._rows = 0
+        self._bytes = 0
+        self._oldest = None
+        if rows <= 0:
+            return
+        decay = 1 - SMOOTHING
+        self._n = self._n * decay + 1
+        self._sx = self._sx * decay + rows
+        self._sy = self._sy * decay + seconds
+        self._sxx = self._sxx * decay + rows * rows
+        self._sxy = self._sxy * decay + rows * seconds
+        metrics.gauge(f"flush.{self.name}.last_rows", rows)
+        metrics.gauge(f"flush.{self.name}.last_seconds", round(seconds, 4))
+        if not self.adaptive or self._rate is None:
+            return
+
+        fixed, per_row = self._model()
+        latency_rows = (self.target_latency - fixed) / (1 / max(self._rate, 1e-3) + per_row)
+        memory_rows = self.memory_budget / self._bytes_per_row if self._bytes_per_row else self.max_rows
+        target = min(max(min(latency_rows, memory_rows), self.min_rows), self.max_rows)
+        self.batch_size = max(self.min_rows, int(self.batch_size + (target - self.batch_size) / 2))
+
+        metrics.gauge(f"flush.{self.name}.batch_size", self.batch_size)
+        metrics.gauge(f"flush.{self.name}.flush_fixed_s", round(fixed, 4))
+        metrics.gauge(f"flush.{self.name}.flush_per_row_us", round(per_row * 1e6, 2))
+        metrics.gauge(f"flush.{self.name}.predicted_latency_s", round(self.predicted_latency(), 3))
+
+    def predicted_latency(self) -> float:
+        """
+        :return: how long the oldest row of a full batch at the current size waits until it's written
+        """
+        fixed, per_row = self._model()
+        fill = self.batch_size / self._rate if self._rate else 0.0
+        return fill + fixed + per_row * self.batch_size
+
+    def report(self) -> str:
+        fixed, per_row = self._model()
+        rate = f"{self._rate:.0f}/s" if self._rate is not None else "unknown"
+        return (f"flush {self.name}: batch {self.batch_size} rows, arrivals {rate}, flush {fixed * 1000:.1f}ms + "
+                f"{per_row * 1e6:.1f}us/row, predicted latency {self.predicted_latency():.2f}s")
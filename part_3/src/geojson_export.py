@@ -0,0 +1,104 @@
+import datetime as dt
+import math
+from sqlalchemy import text
+
+# 5 decimal places of a degree is about a meter, which is already better than the GPS fixes are
+DEFAULT_PRECISION = 5
+DEFAULT_SPEED_PRECISION = 1
+BATCH_ROWS = 10000
+
+_HEADER = b'{"type":"FeatureCollection","features":['
+_FOOTER = b']}\n'
+
+
+def _number(value, precision: int) -> str:
+    # NaN and infinity aren't valid JSON (a speed over a zero length step is inf)
+    if value is None or not math.isfinite(value):
+        return "null"
+    value = round(value, precision)
+    # repr is the shortest form that reads back the same, so 8.0 stays 8.0 but trailing zeros aren't written
+    return repr(int(value)) if precision <= 0 else repr(value)
+
+
+def write_feature_collection(rows, out, precision: int = DEFAULT_PRECISION,
+                             speed_precision: int = DEFAULT_SPEED_PRECISION) -> int:
+    """
+    Write breadcrumbs as a GeoJSON FeatureCollection of points, the same shape data.geojson has, one batch of
+    features at a time. Nothing is kept around between batches, so the memory used doesn't depend on how many rows
+    there are.
+    :param rows: iterable of batches, each a list of (longitude, latitude, speed) tuples
+    :param out: binary file like object, e.g. an open file, a gzip.GzipFile or the wfile of an http handler
+    :param precision: decimal places to keep of the coordinates
+    :param speed_precision: decimal places to keep of the speed
+    :return: number of features written
+    """
+    written = 0
+    out.write(_HEADER)
+    for batch in rows:
+        features = []
+        for longitude, latitude, speed in batch:
+            features.append('{"type":"Feature","geometry":{"type":"Point","coordinates":[%s,%s]},'
+                            '"properties":{"speed":%s}}' % (_number(longitude, precision),
+                                                            _number(latitude, precision),
+                                                            _number(speed, speed_precision)))
+        if not features:
+            continue
+        chunk = ",".join(features)
+        out.write(((b"," if written else b"") + chunk.encode("utf-8")))
+        written += len(features)
+    out.write(_FOOTER)
+    return written
+
+
+def breadcrumb_query(connector, trip_id: int = None, route_id: str = None, vehicle_id: int = None,
+                     start: dt.datetime = None, end: dt.datetime = None) -> tuple:
+    """
+    :return: (sql, params) selecting longitude, latitude, speed of the breadcrumbs that match every filter given.
+    route and vehicle come from the trip table
+    """
+    conditions = []
+    params = {}
+    join = ""
+    if route_id is not None or vehicle_id is not None:
+        join = f" JOIN {connector.trip_table} t ON t.trip_id = b.trip_id"
+    if trip_id is not None:
+        conditions.append("b.trip_id = :trip_id")
+        params["trip_id"] = trip_id
+    if route_id is not None:
+        conditions.append("t.route_id = :route_id")
+        params["route_id"] = str(route_id)
+    if vehicle_id is not None:
+        conditions.append("t.vehicle_id = :vehicle_id")
+        params["vehicle_id"] = vehicle_id
+    if start is not None:
+        conditions.append("b.tstamp >= :start")
+        params["start"] = start
+    if end is not None:
+        conditions.append("b.tstamp < :end")
+        params["end"] = end
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    return f"SELECT b.longitude, b.latitude, b.speed FROM {connector.breadcrumb_table} b{join}{where}", params
+
+
+def stream_breadcrumbs(connector, batch_rows: int = BATCH_ROWS, **filters):
+    """
+    Yield the matching breadcrumbs in batches of batch_rows (longitude, latitude, speed) tuples. yield_per makes
+    SQLAlchemy use a server side cursor, so Postgres hands the rows over a batch at a time instead of the whole result
+    being loaded into memory like pd.read_sql does.
+    :param filters: trip_id, route_id, vehicle_id, start, end, see breadcrumb_query
+    """
+    sql, params = breadcrumb_query(connector, **filters)
+    with connector.engine.connect() as connection:
+        result = connection.execution_options(yield_per=batch_rows).execute(text(sql), params)
+        for partition in result.partitions():
+            yield partition
+
+
+def export_geojson(connector, out, precision: int = DEFAULT_PRECISION, speed_precision: int = DEFAULT_SPEED_PRECISION,
+                   batch_rows: int = BATCH_ROWS, **filters) -> int:
+    """
+    Stream the breadcrumb table into a GeoJSON file or response.
+    :return: number of features written
+    """
+    return write_feature_collection(stream_breadcrumbs(connector, batch_rows, **filters), out, precision,
+                                    speed_precision)
@@ -0,0 +1,82 @@
+import os
+import threading
+import time
+
+# end the pull once nothing has come in for this long and every message that did come in is done. 0 turns it off and
+# the subscribers wait out their whole MAX_TIMEOUT like before
+IDLE_SHUTDOWN_SECONDS = float(os.environ.get("IDLE_SHUTDOWN_SECONDS", "300"))
+# with idle shutdown on, the pull still ends after this long even if messages keep coming
+MAX_RUN_SECONDS = float(os.environ.get("MAX_RUN_SECONDS", str(24 * 3600)))
+
+
+class IdleMonitor:
+    """
+    Tells a subscriber's poll loop when to stop pulling. Without it the subscribers block for a fixed MAX_TIMEOUT,
+    which is two hours of waiting on a day the backlog drained in ten minutes and a cut off backlog on a busy day.
+
+    The callbacks call started and finished around every message, so the monitor knows how many messages are
+    outstanding and when the last one finished. With quiet_seconds > 0 the pull ends once nothing is outstanding and
+    nothing has finished for quiet_seconds. The quiet period only starts counting after the first message, before that
+    we wait up to first_message_timeout for the publisher to get going. max_run_seconds is a backstop in case the
+    messages never stop. With quiet_seconds = 0 the pull ends after first_message_timeout no matter what, which is the
+    old fixed window.
+    """
+
+    def __init__(self, quiet_seconds: float, first_message_timeout: float, max_run_seconds: float = MAX_RUN_SECONDS,
+                 clock=time.monotonic):
+        self.quiet_seconds = quiet_seconds
+        self.first_message_timeout = first_message_timeout
+        self.max_run_seconds = max_run_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._started_at = clock()
+        self._outstanding = 0
+        self._messages = 0
+        self._last_activity = None
+
+    def reset(self) -> None:
+        """
+        Start the clocks over, sub calls this when it starts pulling.
+        """
+        with self._lock:
+            self._started_at = self._clock()
+
+    def started(self) -> None:
+        with self._lock:
+            self._outstanding += 1
+            self._messages += 1
+            self._last_activity = self._clock()
+
+    def finished(self) -> None:
+        with self._lock:
+            self._outstanding -= 1
+            self._last_activity = self._clock()
+
+    @property
+    def outstanding(self) -> int:
+        return self._outstanding
+
+    @property
+    def messages(self) -> int:
+        return self._messages
+
+    def should_stop(self) -> str | None:
+        """
+        :return: why the pull should end now, or None to keep pulling
+        """
+        with self._lock:
+            now = self._clock()
+            running = now - self._started_at
+            if self.quiet_seconds <= 0:
+                if running >= self.first_message_timeout:
+                    return "Timeout"
+                return None
+            if self._last_activity is None:
+                if running >= self.first_message_timeout:
+                    return f"Timeout, no messages in {running:.0f}s"
+                return None
+            if self._outstanding == 0 and now - self._last_activity >= self.quiet_seconds:
+                return f"Idle for {now - self._last_activity:.0f}s after {self._messages} messages, stopping"
+            if running >= self.max_run_seconds:
+                return f"Timeout, still getting messages after {running:.0f}s"
+            return None
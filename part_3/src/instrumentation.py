@@ -0,0 +1,310 @@
+import cProfile
+import faulthandler
+import json
+import os
+import pstats
+import random
+import signal
+import threading
+import time
+
+OFF = "off"
+SAMPLED = "sampled"
+FULL = "full"
+
+
+class _NullStage:
+    """
+    Context manager that does nothing. A single shared instance is handed out whenever a stage isn't being timed so
+    that the off and (unsampled) sampled paths cost one attribute lookup and one comparison.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Histogram:
+    """
+    Latency histogram with power of two buckets in microseconds. Bucket i holds observations in [2^(i-1), 2^i) us, so
+    32 buckets cover everything from 1us to over an hour without any allocation after construction.
+    """
+    BUCKETS = 32
+
+    def __init__(self):
+        self.counts = [0] * Histogram.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        index = min(int(seconds * 1_000_000).bit_length(), Histogram.BUCKETS - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other: "Histogram") -> None:
+        """
+        Add the observations of other, e.g. to combine histograms kept per thread.
+        """
+        for index, bucket_count in enumerate(other.counts):
+            self.counts[index] += bucket_count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, pct: float) -> float:
+        """
+        :param pct: float between 0 and 100
+        :return: the upper bound (in seconds) of the bucket that contains the requested percentile
+        """
+        if self.count == 0:
+            return 0.0
+        target = self.count * pct / 100
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= target:
+                return min((1 << index) / 1_000_000, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_s": self.total / self.count if self.count else 0.0,
+            "p50_s": self.percentile(50),
+            "p95_s": self.percentile(95),
+            "p99_s": self.percentile(99),
+            "max_s": self.max,
+        }
+
+
+class _Stage:
+    __slots__ = ("_metrics", "_name", "_start", "_profiler", "_local")
+
+    def __init__(self, metrics, name: str):
+        self._metrics = metrics
+        self._name = name
+        self._profiler = None
+
+    def __enter__(self):
+        if self._metrics.profiling:
+            # stages nest (subscriber.message_parser around subscriber.json_decode and the rest) and share the thread's
+            # profiler, so only the outermost one turns it on and off. The thread local is kept because stop_profiling
+            # replaces it, possibly while we're inside the stage
+            self._local = self._metrics._local
+            self._profiler = self._metrics._thread_profiler()
+            depth = getattr(self._local, "depth", 0)
+            self._local.depth = depth + 1
+            if depth == 0:
+                self._profiler.enable()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self._start
+        if self._profiler is not None:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                self._profiler.disable()
+        self._metrics.record(self._name, elapsed)
+        return False
+
+
+class PipelineMetrics:
+    """
+    Lightweight timing for the ingest hot path. Every stage we care about (json decode, process_individual, buffering,
+    the flush to Postgres, and the steps in raw_to_processed) is wrapped in "with metrics.stage(name):". The mode
+    decides what that costs:
+
+    off      - stage() returns a shared no-op context manager and counters/gauges return immediately.
+    sampled  - roughly one in every 1/sample_rate stages is timed, everything else gets the no-op. Counters are still
+               exact so throughput numbers are right even though the histograms are sampled.
+    full     - every stage is timed.
+
+    The mode comes from the METRICS_MODE environment variable (and METRICS_SAMPLE_RATE for sampled mode) so it can be
+    switched without touching the code. There is one module level instance, metrics, that the subscriber and the
+    PostgresConnector share.
+    """
+
+    def __init__(self, mode: str = OFF, sample_rate: float = 0.01):
+        if mode not in (OFF, SAMPLED, FULL):
+            raise ValueError(f"Unknown metrics mode: {mode}")
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.profiling = False
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._started = time.monotonic()
+        self._profilers = []
+        self._local = threading.local()
+        self._dump_dir = "."
+
+    @staticmethod
+    def from_env():
+        mode = os.environ.get("METRICS_MODE", OFF).lower()
+        sample_rate = float(os.environ.get("METRICS_SAMPLE_RATE", "0.01"))
+        return PipelineMetrics(mode, sample_rate)
+
+    def set_mode(self, mode: str, sample_rate: float = None) -> None:
+        if mode not in (OFF, SAMPLED, FULL):
+            raise ValueError(f"Unknown metrics mode: {mode}")
+        self.mode = mode
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+
+    def stage(self, name: str):
+        """
+        :param name: str name of the stage, e.g. "subscriber.json_decode"
+        :return: a context manager that times the block (or does nothing, depending on the mode)
+        """
+        if self.profiling:
+            return _Stage(self, name)
+        if self.mode == OFF:
+            return _NULL_STAGE
+        if self.mode == SAMPLED and random.random() >= self.sample_rate:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def record(self, name: str, seconds: float) -> None:
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name: str, n: int = 1) -> None:
+        if self.mode == OFF:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def gauge(self, name: str, value: float) -> None:
+        if self.mode == OFF:
+            return
+        self._gauges[name] = value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            elapsed = max(time.monotonic() - self._started, 1e-9)
+            return {
+                "mode": self.mode,
+                "sample_rate": self.sample_rate,
+                "elapsed_s": elapsed,
+                "stages": {name: h.snapshot() for name, h in self._histograms.items()},
+                "counters": {name: {"total": total, "per_second": total / elapsed}
+                             for name, total in self._counters.items()},
+                "gauges": dict(self._gauges),
+            }
+
+    def report(self) -> str:
+        """
+        Human readable summary that is short enough to go through the Discord logger.
+        """
+        snap = self.snapshot()
+        lines = [f"metrics ({snap['mode']}) over {snap['elapsed_s']:.0f}s"]
+        for name, stats in sorted(snap["stages"].items()):
+            lines.append(f"{name}: n={stats['count']} mean={stats['mean_s'] * 1000:.3f}ms "
+                         f"p95={stats['p95_s'] * 1000:.3f}ms max={stats['max_s'] * 1000:.3f}ms")
+        for name, stats in sorted(snap["counters"].items()):
+            lines.append(f"{name}: {stats['total']} ({stats['per_second']:.1f}/s)")
+        for name, value in sorted(snap["gauges"].items()):
+            lines.append(f"{name}: {value}")
+        return "\n".join(lines)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self._gauges.clear()
+            self._started = time.monotonic()
+
+    def _thread_profiler(self) -> cProfile.Profile:
+        # cProfile only sees the thread it is enabled in, and the Pub/Sub callbacks run on a thread pool, so every
+        # thread gets its own profiler and they are merged when we dump
+        profiler = getattr(self._local, "profiler", None)
+        if profiler is None:
+            profiler = self._local.profiler = cProfile.Profile()
+            with self._lock:
+                self._profilers.append(profiler)
+        return profiler
+
+    def start_profiling(self) -> None:
+        self.profiling = True
+
+    def stop_profiling(self, path: str) -> str | None:
+        """
+        Stop profiling and write the merged stats of every thread to path. The file can be opened with pstats,
+        snakeviz, or anything else that reads cProfile output.
+        :return: the path written or None if nothing was profiled
+        """
+        self.profiling = False
+        with self._lock:
+            profilers, self._profilers = self._profilers, []
+        self._local = threading.local()
+        stats = None
+        for profiler in profilers:
+            profiler.disable()
+            try:
+                if stats is None:
+                    stats = pstats.Stats(profiler)
+                else:
+                    stats.add(profiler)
+            except TypeError:
+                # a thread's profiler that never recorded anything can't be loaded
+                continue
+        if stats is None:
+            return None
+        stats.dump_stats(path)
+        return path
+
+    def dump(self, path: str) -> None:
+        """
+        Write the current metrics and the stack of every thread to path. The stack dump is the same information that
+        "py-spy dump --pid" gives, which is handy when py-spy isn't installed on the box.
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, indent=2)
+            f.write("\n\n")
+            f.flush()
+            faulthandler.dump_traceback(file=f, all_threads=True)
+
+    def install_signal_handlers(self, dump_dir: str = None) -> None:
+        """
+        SIGUSR1 toggles cProfile on and off (the profile is written when it is turned off) and SIGUSR2 writes a
+        metrics/stack dump. Files go to dump_dir (or PROFILE_DIR, or the current directory) and are named with the pid
+        so several subscribers can share a directory. This must be called from the main thread.
+        """
+        self._dump_dir = dump_dir or os.environ.get("PROFILE_DIR", ".")
+
+        def toggle_profile(signum, frame):
+            if self.profiling:
+                stamp = time.strftime("%Y%m%d-%H%M%S")
+                path = os.path.join(self._dump_dir, f"profile-{os.getpid()}-{stamp}.prof")
+                written = self.stop_profiling(path)
+                print(f"Wrote profile to {written}" if written else "Profiling stopped, nothing recorded")
+            else:
+                self.start_profiling()
+                print("Profiling started")
+
+        def dump_metrics(signum, frame):
+            stamp = time.strftime("%Y%m%d-%H%M%S")
+            path = os.path.join(self._dump_dir, f"metrics-{os.getpid()}-{stamp}.txt")
+            self.dump(path)
+            print(f"Wrote metrics to {path}")
+
+        signal.signal(signal.SIGUSR1, toggle_profile)
+        signal.signal(signal.SIGUSR2, dump_metrics)
+
+
+metrics = PipelineMetrics.from_env()
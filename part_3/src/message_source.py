@@ -0,0 +1,296 @@
+import json
+import threading
+from abc import ABC, abstractmethod
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from src.instrumentation import Histogram
+
+
+class MessageSource(ABC):
+    """
+    Where a subscriber gets its messages from. subscribe takes the same callback Pub/Sub does and returns something
+    that behaves like a StreamingPullFuture (result(timeout) and cancel()), and the messages handed to the callback have
+    data, ack() and nack(). This lets Subscriber.sub run against the real subscription or against a local replay without
+    knowing which one it has.
+    """
+
+    @abstractmethod
+    def subscribe(self, callback):
+        """
+        :param callback: called with every message, from a thread pool
+        :return: a future like StreamingPullFuture
+        """
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+class PubSubMessageSource(MessageSource):
+    """
+    The real thing. Setting PUBSUB_EMULATOR_HOST makes the client library talk to the local Pub/Sub emulator instead of
+    GCP, so this is also the emulator backed source. Several sources can share one client (and its gRPC channel) by
+    passing it in, the ingest daemon does that, and then closing it is up to whoever made it.
+    """
+
+    def __init__(self, project_id: str, subscription_id: str, flow_control=None, client=None):
+        # imported here so the local source can be used on a machine without the Pub/Sub client installed
+        from google.cloud import pubsub_v1
+        self._owns_client = client is None
+        self._client = client if client is not None else pubsub_v1.SubscriberClient()
+        self._flow_control = flow_control
+        self.subscription_path = self._client.subscription_path(project_id, subscription_id)
+
+    def subscribe(self, callback):
+        if self._flow_control is None:
+            return self._client.subscribe(self.subscription_path, callback=callback)
+        return self._client.subscribe(self.subscription_path, callback=callback, flow_control=self._flow_control)
+
+    def close(self) -> None:
+        if self._owns_client:
+            self._client.close()
+
+
+class LocalMessage:
+    """
+    A message from ReplayMessageSource. It has the parts of pubsub_v1.subscriber.message.Message that our callbacks use.
+    """
+    __slots__ = ("data", "message_id", "publish_time", "delivery_attempt", "_source", "_settled")
+
+    def __init__(self, source, message_id: int, data: bytes, publish_time: float):
+        self._source = source
+        self.message_id = message_id
+        self.data = data
+        self.publish_time = publish_time
+        self.delivery_attempt = 0
+        self._settled = False
+
+    def ack(self) -> None:
+        self._source._settle(self, True)
+
+    def nack(self) -> None:
+        self._source._settle(self, False)
+
+
+class ReplayMessageSource(MessageSource):
+    """
+    In process stand in for a Pub/Sub subscription. It replays a sequence of message bodies (an NDJSON archive, or
+    synthetic breadcrumbs) into the callback on a thread pool, like the real client does, at a controlled rate.
+
+    Acks and nacks behave the way Pub/Sub's do: an acked message is done, a nacked message is redelivered (with
+    delivery_attempt incremented) until max_delivery_attempts, after which it is dead lettered. A callback that returns
+    without acking or nacking is treated like an expired ack deadline and the message is redelivered. max_outstanding
+    plays the part of flow control, so a slow callback applies back pressure to the replay instead of letting the
+    backlog pile up in memory.
+
+    The future returned by subscribe completes once every message has been settled (when stop_when_drained is set), so
+    a load test can wait for it instead of guessing a timeout. stats() has the counts, throughput and the publish to ack
+    latency histogram.
+    """
+
+    def __init__(self, messages, rate: float = None, max_workers: int = 10, max_outstanding: int = 1000,
+                 max_delivery_attempts: int = 5, stop_when_drained: bool = True):
+        """
+        :param messages: iterable of bytes, one message body each
+        :param rate: messages per second to publish at, None means as fast as the callback keeps up
+        :param max_workers: size of the callback thread pool (the Pub/Sub client defaults to 10)
+        :param max_outstanding: most messages that can be delivered but not yet settled
+        :param max_delivery_attempts: a message nacked this many times is dead lettered
+        :param stop_when_drained: complete the future once the input is exhausted and everything is settled
+        """
+        self._messages = messages
+        self._rate = rate
+        self._max_workers = max_workers
+        self._max_delivery_attempts = max_delivery_attempts
+        self._stop_when_drained = stop_when_drained
+        self._slots = threading.Semaphore(max_outstanding)
+        self._lock = threading.Lock()
+        self._redeliver = deque()
+        self._cancelled = threading.Event()
+        self._executor = None
+        self._feeder = None
+        self._future = None
+        self._exhausted = False
+        self._outstanding = 0
+        self._latency = Histogram()
+        self._counts = {"published": 0, "delivered": 0, "acked": 0, "nacked": 0, "redelivered": 0,
+                        "dead_lettered": 0, "callback_errors": 0}
+        self._started = None
+        self._finished = None
+
+    @staticmethod
+    def from_ndjson(path: str, **kwargs):
+        """
+        Replay a part 1 style archive, one JSON document per line.
+        """
+        def lines():
+            with open(path, "rb") as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        yield line
+        return ReplayMessageSource(lines(), **kwargs)
+
+    @staticmethod
+    def from_dicts(records, **kwargs):
+        """
+        Replay dicts (e.g. from benchmark.synthetic.generate_breadcrumbs) encoded the same way the publisher does.
+        """
+        return ReplayMessageSource((json.dumps(record).encode("utf-8") for record in records), **kwargs)
+
+    def subscribe(self, callback):
+        if self._future is not None:
+            raise RuntimeError("ReplayMessageSource can only be subscribed once")
+        self._future = _ReplayFuture(self)
+        self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="replay-callback")
+        self._started = time.monotonic()
+        self._feeder = threading.Thread(target=self._feed, args=(callback,), name="replay-feeder", daemon=True)
+        self._feeder.start()
+        return self._future
+
+    def _feed(self, callback) -> None:
+        interval = 1 / self._rate if self._rate else 0
+        next_publish = time.monotonic()
+        message_id = 0
+        iterator = iter(self._messages)
+        while not self._cancelled.is_set():
+            message = self._next_redelivery()
+            if message is None:
+                try:
+                    data = next(iterator)
+                except StopIteration:
+                    break
+                if interval:
+                    delay = next_publish - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    next_publish += interval
+                message = LocalMessage(self, message_id, data, time.monotonic())
+                message_id += 1
+                with self._lock:
+                    self._counts["published"] += 1
+            self._deliver(message, callback)
+
+        with self._lock:
+            self._exhausted = True
+        # redeliveries can still come in after the input runs out, keep going until everything is settled
+        while not self._cancelled.is_set():
+            message = self._next_redelivery()
+            if message is not None:
+                self._deliver(message, callback)
+                continue
+            with self._lock:
+                if self._outstanding == 0 and not self._redeliver:
+                    break
+            time.sleep(0.001)
+        self._maybe_finish()
+
+    def _next_redelivery(self):
+        with self._lock:
+            return self._redeliver.popleft() if self._redeliver else None
+
+    def _deliver(self, message: LocalMessage, callback) -> None:
+        self._slots.acquire()
+        message.delivery_attempt += 1
+        message._settled = False
+        with self._lock:
+            self._outstanding += 1
+            self._counts["delivered"] += 1
+        self._executor.submit(self._run_callback, message, callback)
+
+    def _run_callback(self, message: LocalMessage, callback) -> None:
+        try:
+            callback(message)
+        except Exception:
+            with self._lock:
+                self._counts["callback_errors"] += 1
+        if not message._settled:
+            # same as letting the ack deadline expire
+            self._settle(message, False)
+
+    def _settle(self, message: LocalMessage, acked: bool) -> None:
+        with self._lock:
+            if message._settled:
+                return
+            message._settled = True
+            self._outstanding -= 1
+            if acked:
+                self._counts["acked"] += 1
+                self._latency.observe(time.monotonic() - message.publish_time)
+            else:
+                self._counts["nacked"] += 1
+                if message.delivery_attempt < self._max_delivery_attempts:
+                    self._counts["redelivered"] += 1
+                    self._redeliver.append(message)
+                else:
+                    self._counts["dead_lettered"] += 1
+        self._slots.release()
+
+    def _maybe_finish(self) -> None:
+        with self._lock:
+            done = self._exhausted and self._outstanding == 0 and not self._redeliver
+        if done or self._cancelled.is_set():
+            self._finished = time.monotonic()
+            if self._stop_when_drained or self._cancelled.is_set():
+                self._future._finish()
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+        if self._future is not None:
+            self._future._finish()
+
+    def close(self) -> None:
+        self._cancelled.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        if self._future is not None:
+            self._future._finish()
+
+    def outstanding(self) -> int:
+        with self._lock:
+            return self._outstanding
+
+    def stats(self) -> dict:
+        with self._lock:
+            end = self._finished or time.monotonic()
+            elapsed = end - self._started if self._started else 0.0
+            stats = dict(self._counts)
+            stats["elapsed_s"] = elapsed
+            stats["acked_per_second"] = stats["acked"] / elapsed if elapsed else 0.0
+            stats["ack_latency"] = self._latency.snapshot()
+            return stats
+
+
+class _ReplayFuture:
+    """
+    Just enough of StreamingPullFuture for Subscriber.sub: result(timeout) raises TimeoutError (the
+    concurrent.futures one, which is what sub catches) and cancel() stops the replay.
+    """
+
+    def __init__(self, source: ReplayMessageSource):
+        self._source = source
+        self._future = Future()
+
+    def _finish(self) -> None:
+        if not self._future.done():
+            self._future.set_result(None)
+
+    def result(self, timeout: float = None):
+        return self._future.result(timeout=timeout)
+
+    def cancel(self) -> bool:
+        self._source.cancel()
+        return True
+
+    def cancelled(self) -> bool:
+        return self._source._cancelled.is_set()
+
+    def done(self) -> bool:
+        return self._future.done()
@@ -0,0 +1,105 @@
+"""
+Versioned schema for the pipeline's tables, applied by PostgresConnector.migrate. Run python migrate.py from the
+part_3 directory (or set MIGRATE_ON_START=1). Until now to_sql created the tables the first time something was
+appended, with no keys and no indexes, so every query on them was a sequential scan.
+
+Each migration is (version, description, statements). The statements are formatted with the connector's table names
+(raw, breadcrumb, trip, trip_metadata, part3) and, for naming indexes, the same names without a schema (raw_name,
+breadcrumb_name, ...). A migration is applied in one transaction together with its row in schema_migrations, so it
+either happens completely or not at all. Migrations are never edited once they have been applied somewhere, a change
+is a new migration at the end of the list.
+
+Why these indexes (run explain_queries.py to see the plans):
+
+- raw and breadcrumb don't have a natural key we can enforce, Pub/Sub delivers at least once and a duplicate would
+  fail a whole COPY batch, so they get a surrogate identity primary key. trip already had trip_id
+- raw_to_processed only ever reads the rows that aren't in the final table yet, which after the first day are a small
+  slice of raw. The partial index holds just those, so finding them doesn't mean reading every row ever received
+- the summaries, the geojson export and the tiles look up breadcrumbs by trip, in time order, hence (trip_id, tstamp)
+- the arrow cache's day queries are time ranges. breadcrumb is appended roughly in time order, so a BRIN index on
+  tstamp is a few pages instead of a btree the size of the column. The tile server polls by breadcrumb_id, that's the
+  primary key
+"""
+
+# adds an identity column as the primary key unless the table has one already (a table someone keyed by hand)
+_SURROGATE_KEY = """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_index WHERE indrelid = '{table}'::regclass AND indisprimary) THEN
+            ALTER TABLE {table} ADD COLUMN {column} bigint GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY;
+        END IF;
+    END $$
+"""
+
+MIGRATIONS = [
+    (1, "create the tables", [
+        """
+        CREATE TABLE IF NOT EXISTS {raw} (
+            "EVENT_NO_TRIP" integer,
+            "VEHICLE_ID" integer,
+            "METERS" integer,
+            "GPS_LONGITUDE" real,
+            "GPS_LATITUDE" real,
+            processed_date date,
+            is_in_final_table boolean,
+            "timestamp" timestamp
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS {breadcrumb} (
+            tstamp timestamp,
+            latitude real,
+            longitude real,
+            speed real,
+            trip_id integer
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS {trip} (
+            trip_id integer PRIMARY KEY,
+            route_id text,
+            vehicle_id integer,
+            service_key text,
+            direction text
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS {trip_metadata} (
+            trip_id integer PRIMARY KEY,
+            route_id text,
+            vehicle_id integer,
+            service_key text,
+            direction text,
+            received_at timestamp DEFAULT clock_timestamp()
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS {part3} (
+            trip_id integer,
+            route_id text,
+            vehicle_id integer,
+            service_key text,
+            direction text
+        )""",
+    ]),
+    (2, "primary keys", [
+        _SURROGATE_KEY.replace("{table}", "{raw}").replace("{column}", "raw_id"),
+        _SURROGATE_KEY.replace("{table}", "{breadcrumb}").replace("{column}", "breadcrumb_id"),
+        _SURROGATE_KEY.replace("{table}", "{part3}").replace("{column}", "part3_id"),
+        # a trip table from before it was created with its key, append_to_trip's ON CONFLICT needs it
+        """
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_index WHERE indrelid = '{trip}'::regclass AND indisprimary) THEN
+                ALTER TABLE {trip} ADD PRIMARY KEY (trip_id);
+            END IF;
+        END $$""",
+    ]),
+    (3, "indexes for raw_to_processed, the summaries and the day queries", [
+        ('CREATE INDEX IF NOT EXISTS {raw_name}_unprocessed_idx ON {raw} ("EVENT_NO_TRIP", "VEHICLE_ID") '
+         'WHERE NOT is_in_final_table'),
+        "CREATE INDEX IF NOT EXISTS {breadcrumb_name}_trip_id_tstamp_idx ON {breadcrumb} (trip_id, tstamp)",
+        "CREATE INDEX IF NOT EXISTS {breadcrumb_name}_tstamp_brin ON {breadcrumb} USING brin (tstamp)",
+        "CREATE INDEX IF NOT EXISTS {trip_name}_route_id_idx ON {trip} (route_id)",
+        "CREATE INDEX IF NOT EXISTS {part3_name}_trip_id_idx ON {part3} (trip_id)",
+        "ANALYZE {raw}",
+        "ANALYZE {breadcrumb}",
+        "ANALYZE {trip}",
+    ]),
+]
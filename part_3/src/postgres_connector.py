@@ -1,12 +1,28 @@
+import io
+from contextlib import contextmanager
 import pandas as pd
 import psycopg as pg
 import os
-from sqlalchemy import create_engine, inspect, text, BigInteger, Text
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.exc import ProgrammingError
 from urllib.parse import quote_plus
+from src.instrumentation import metrics
+from src.schema import RAW_SCHEMA, BREADCRUMB_SCHEMA, TRIP_SCHEMA, PART3_SCHEMA, RAW_FINAL_SCHEMA, apply_schema, \
+    column_list, sql_types
+from src.migrations import MIGRATIONS
+
+TRIP_METADATA_TTL_DAYS = 7
+# fail fast when the database is down so the subscriber can spill to disk instead of hanging (see src/spill_log.py)
+CONNECT_TIMEOUT = int(os.environ.get("POSTGRES_CONNECT_TIMEOUT", "10"))
+# bring the tables up to date (see src/migrations.py) whenever a connector is made. Off by default, the first migration
+# on an existing database rewrites the big tables under an exclusive lock, that should be a deliberate python migrate.py
+# and not whatever process happens to start first
+MIGRATE_ON_START = os.environ.get("MIGRATE_ON_START", "0") == "1"
+SCHEMA_MIGRATIONS_TABLE = "schema_migrations"
 
 
 class PostgresConnector:
-    def __init__(self):
+    def __init__(self, migrate: bool = MIGRATE_ON_START):
         user = os.environ.get("USER")
         password = os.environ.get("PASS")
         host = os.environ.get("HOST")
@@ -16,89 +32,382 @@ class PostgresConnector:
         self.breadcrumb_table = os.environ.get("BREADCRUMB_TABLE")
         self.trip_table = os.environ.get("TRIP_TABLE")
         self.part3_table = os.environ.get("PART3_TABLE")
-        self.engine = create_engine(f'postgresql://{user}:{quote_plus(password)}@{host}:{port}/{db}')
+        self.trip_metadata_table = os.environ.get("TRIP_METADATA_TABLE", "trip_metadata_pending")
+        self._trip_tables_created = False
+        self._bulk_tables = set()
+        # pool_pre_ping throws away connections that died while the database was down instead of failing on them
+        self.engine = create_engine(f'postgresql://{user}:{quote_plus(password)}@{host}:{port}/{db}',
+                                    pool_pre_ping=True, connect_args={"connect_timeout": CONNECT_TIMEOUT})
         self.connection = self.engine.connect()
+        if migrate:
+            try:
+                self.migrate()
+            except Exception as e:
+                # the old tables still work, just slower, so this isn't a reason not to start
+                print(f"Migrating the schema failed: {e}")
 
-    def upsert_to_trip(self, df):
-        temp_table_name = "temp_trip_table"
-        engine = self.engine
+    def migrate(self) -> list[int]:
+        """
+        Apply the migrations in src/migrations.py that this database doesn't have yet, in order, each in its own
+        transaction with its row in schema_migrations. It's safe to run more than once and from several processes at
+        once, an advisory lock makes the others wait and then there is nothing left for them to do. The first run on
+        an existing database adds the key columns and builds the indexes, which locks the tables for a while, so it is
+        run with migrate.py rather than on every start.
+        :return: the versions that were applied
+        """
+        tables = {"raw": self.raw_table, "breadcrumb": self.breadcrumb_table, "trip": self.trip_table,
+                  "trip_metadata": self.trip_metadata_table, "part3": self.part3_table}
+        missing = [name for name, table in tables.items() if not table]
+        if missing:
+            print(f"Not migrating the schema, there are no table names for {', '.join(missing)}")
+            return []
+        # index names can't be schema qualified (the index goes in its table's schema), so they are made from the bare
+        # table name: {raw_name}_unprocessed_idx for a RAW_TABLE of transit.raw is raw_unprocessed_idx
+        tables.update({f"{name}_name": table.split(".")[-1].strip('"') for name, table in list(tables.items())})
 
-        with engine.connect() as connection:
-            connection.execute(text(f"DROP TABLE IF EXISTS {temp_table_name}"))
+        applied = []
+        with self.engine.connect() as connection:
+            connection.execute(text("SELECT pg_advisory_lock(hashtext(:name))"), {"name": SCHEMA_MIGRATIONS_TABLE})
             connection.commit()
+            try:
+                with connection.begin():
+                    connection.execute(text(f"""
+                            CREATE TABLE IF NOT EXISTS {SCHEMA_MIGRATIONS_TABLE} (
+                                version integer PRIMARY KEY,
+                                description text,
+                                applied_at timestamptz DEFAULT now()
+                            )"""))
+                    done = set(connection.execute(text(f"SELECT version FROM {SCHEMA_MIGRATIONS_TABLE}")).scalars())
+                for version, description, statements in MIGRATIONS:
+                    if version in done:
+                        continue
+                    with metrics.stage("postgres.migrate"), connection.begin():
+                        for statement in statements:
+                            connection.exec_driver_sql(statement.format(**tables))
+                        connection.execute(text(f"INSERT INTO {SCHEMA_MIGRATIONS_TABLE} (version, description) "
+                                                f"VALUES (:version, :description)"),
+                                           {"version": version, "description": description})
+                    print(f"Applied schema migration {version}: {description}")
+                    applied.append(version)
+            finally:
+                connection.execute(text("SELECT pg_advisory_unlock(hashtext(:name))"),
+                                   {"name": SCHEMA_MIGRATIONS_TABLE})
+                connection.commit()
+        return applied
+
+    def migration_status(self) -> tuple[list, list]:
+        """
+        :return: (applied, pending) lists of (version, description)
+        """
+        try:
+            with self.engine.connect() as connection:
+                done = set(connection.execute(text(f"SELECT version FROM {SCHEMA_MIGRATIONS_TABLE}")).scalars())
+        except ProgrammingError:
+            done = set()
+        applied = [(version, description) for version, description, _ in MIGRATIONS if version in done]
+        pending = [(version, description) for version, description, _ in MIGRATIONS if version not in done]
+        return applied, pending
+
+    def _create_trip_tables(self, connection):
+        """
+        The trip table needs a unique trip_id for the ON CONFLICT below, to_sql would create it without one. The
+        pending table holds route_id, direction and service_key from the stop events for trips that aren't in the trip
+        table yet.
+        """
+        if self._trip_tables_created:
+            return
+        connection.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS {self.trip_table} (
+                    trip_id integer PRIMARY KEY,
+                    route_id text,
+                    vehicle_id integer,
+                    service_key text,
+                    direction text
+                )"""))
+        connection.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS {self.trip_metadata_table} (
+                    trip_id integer PRIMARY KEY,
+                    route_id text,
+                    vehicle_id integer,
+                    service_key text,
+                    direction text,
+                    received_at timestamp DEFAULT clock_timestamp()
+                )"""))
+        self._trip_tables_created = True
+
+    def _stage_trips(self, connection, df, name):
+        connection.execute(text(f"""
+                CREATE TEMPORARY TABLE {name} (
+                    trip_id integer,
+                    route_id text,
+                    vehicle_id integer,
+                    service_key text,
+                    direction text
+                ) ON COMMIT DROP"""))
+        df = df.drop_duplicates(subset=['trip_id'], keep='last')
+        df[["trip_id", "route_id", "vehicle_id", "service_key", "direction"]].to_sql(
+            name, con=connection, if_exists='append', index=False)
+
+    def _merge_trip_metadata(self, connection):
+        """
+        Copy the pending metadata of every trip that is in the trip table now into it and drop it from the pending
+        table. Only the trips that have pending metadata are touched, and the pending table only ever holds the trips
+        the two pipelines haven't both seen yet, so this is small no matter how big trip gets. Pending rows older than
+        TRIP_METADATA_TTL_DAYS are for trips we never got breadcrumbs for and are thrown away.
+        :return: trip ids that got their metadata
+        """
+        merged = connection.execute(text(f"""
+                WITH applied AS (
+                    DELETE FROM {self.trip_metadata_table} p
+                    USING {self.trip_table} t
+                    WHERE t.trip_id = p.trip_id
+                    RETURNING p.*
+                )
+                UPDATE {self.trip_table} t SET
+                    route_id = COALESCE(a.route_id, t.route_id),
+                    service_key = COALESCE(a.service_key, t.service_key),
+                    direction = COALESCE(a.direction, t.direction),
+                    vehicle_id = COALESCE(t.vehicle_id, a.vehicle_id)
+                FROM applied a
+                WHERE t.trip_id = a.trip_id
+                RETURNING t.trip_id
+            """)).scalars().all()
+        connection.execute(text(
+            f"DELETE FROM {self.trip_metadata_table} "
+            f"WHERE received_at < now() - interval '{TRIP_METADATA_TTL_DAYS} days'"))
+        return merged
+
+    def _lock_trip_metadata(self, connection):
+        # the breadcrumb and stop event subscribers both merge, one at a time so neither misses the other's rows
+        connection.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {"name": self.trip_metadata_table})
 
+    def upsert_to_trip(self, df):
+        """
+        Route, direction and service key from the stop events. They go into the pending table first (a later stop event
+        for the same trip replaces an earlier one) and are merged into the trip table right away for the trips it
+        already has. The rest are merged by append_to_trip when the breadcrumb pipeline gets to those trips.
+        :return: trip ids whose trip row was updated
+        """
+        metrics.count("postgres.upsert_to_trip.rows", len(df))
+        with metrics.stage("postgres.upsert_to_trip"), self.engine.begin() as connection:
+            self._create_trip_tables(connection)
+            self._stage_trips(connection, df, "staged_trip_metadata")
+            self._lock_trip_metadata(connection)
             connection.execute(text(f"""
-                    CREATE TEMPORARY TABLE {temp_table_name} (
-                        trip_id bigint,
-                        route_id text,
-                        vehicle_id bigint,
-                        service_key text,
-                        direction text
-                    );
+                    INSERT INTO {self.trip_metadata_table} (trip_id, route_id, vehicle_id, service_key, direction)
+                    SELECT trip_id, route_id, vehicle_id, service_key, direction
+                    FROM staged_trip_metadata
+                    ON CONFLICT (trip_id)
+                    DO UPDATE SET
+                        route_id = EXCLUDED.route_id,
+                        vehicle_id = EXCLUDED.vehicle_id,
+                        service_key = EXCLUDED.service_key,
+                        direction = EXCLUDED.direction,
+                        received_at = EXCLUDED.received_at;
                 """))
-    
-            connection.commit()
-    
-            df = df.drop_duplicates(subset=['trip_id'])
-    
-            df.to_sql(temp_table_name, con=connection, if_exists='append', index=False, dtype={
-                          'trip_id': BigInteger,
-                          'route_id': Text,
-                          'vehicle_id': BigInteger,
-                          'service_key': Text,
-                          'direction': Text
-            })
-            connection.execute(text(f"""
-                        INSERT INTO trip (trip_id, route_id, vehicle_id, service_key, direction)
-                        SELECT 
-                            trip_id::bigint, 
-                            route_id, 
-                            vehicle_id::bigint, 
-                            service_key, 
-                            direction
-                        FROM {temp_table_name}
-                        ON CONFLICT (trip_id)
-                        DO UPDATE SET
-                            route_id = EXCLUDED.route_id,
-                            vehicle_id = EXCLUDED.vehicle_id,
-                            service_key = EXCLUDED.service_key,
-                            direction = EXCLUDED.direction;
-                    """))
-    
-            connection.commit()
-        
-            connection.execute(text(f"DROP TABLE IF EXISTS {temp_table_name}"))
-            connection.commit()
+            merged = self._merge_trip_metadata(connection)
+        metrics.count("postgres.trip_metadata.merged", len(merged))
+        return merged
 
     def append_to_part3(self, df):
-        df.to_sql(self.part3_table, self.engine, if_exists='append', index=False)
+        metrics.count("postgres.append_to_part3.rows", len(df))
+        with metrics.stage("postgres.append_to_part3"):
+            df = apply_schema(df, PART3_SCHEMA)
+            df.to_sql(self.part3_table, self.engine, if_exists='append', index=False, dtype=sql_types(PART3_SCHEMA))
         
     def get_part3(self):
-        return pd.read_sql(f"SELECT * FROM {self.part3_table}", self.engine)
+        return apply_schema(pd.read_sql(f"SELECT {column_list(PART3_SCHEMA)} FROM {self.part3_table}", self.engine),
+                            PART3_SCHEMA)
 
     def append_to_raw(self, df):
-        df.to_sql(self.raw_table, self.engine, if_exists='append', index=False)
+        metrics.count("postgres.append_to_raw.rows", len(df))
+        with metrics.stage("postgres.append_to_raw"):
+            df = apply_schema(df, RAW_SCHEMA)
+            df.to_sql(self.raw_table, self.engine, if_exists='append', index=False, dtype=sql_types(RAW_SCHEMA))
+
+    def bulk_append(self, table, data, schema, connection=None):
+        """
+        Append with COPY instead of to_sql's INSERTs, which is several times faster for big batches. The table is
+        created the same way to_sql would create it if it isn't there yet.
+        :param table: name of the table
+        :param data: a DataFrame, or CSV bytes with a header row of column names (what the spill log stores)
+        :param schema: the schema of the table, e.g. RAW_SCHEMA
+        :param connection: a SQLAlchemy connection to COPY in, inside whatever transaction it has open. Committing is
+        then up to the caller, without it the COPY gets a connection of its own and is committed right away
+        :return: number of rows appended
+        """
+        if isinstance(data, pd.DataFrame):
+            buffer = io.BytesIO()
+            apply_schema(data, schema).to_csv(buffer, index=False)
+            data = buffer.getvalue()
+        header, _, body = data.partition(b"\n")
+        rows = body.count(b"\n")
+        if rows == 0:
+            return 0
+        if table not in self._bulk_tables:
+            empty = apply_schema(pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in schema.items()}),
+                                 schema)
+            empty.to_sql(table, self.engine, if_exists='append', index=False, dtype=sql_types(schema))
+            self._bulk_tables.add(table)
+
+        columns = ", ".join(f'"{column}"' for column in header.decode("utf-8").strip().split(","))
+        query = f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv, HEADER true)"
+        metrics.count("postgres.bulk_append.rows", rows)
+        with metrics.stage("postgres.bulk_append"):
+            if connection is not None:
+                self._copy(connection.connection.cursor(), query, data)
+                return rows
+            connection = self.engine.raw_connection()
+            try:
+                self._copy(connection.cursor(), query, data)
+                connection.commit()
+            finally:
+                connection.close()
+        return rows
+
+    @staticmethod
+    def _copy(cursor, query, data):
+        if hasattr(cursor, "copy_expert"):
+            cursor.copy_expert(query, io.BytesIO(data))
+        else:
+            # psycopg 3
+            with cursor.copy(query) as copy:
+                copy.write(data)
 
     def set_is_in_final_table(self):
         # set every row in raw table to is_in_final_table = True
-        query = f"UPDATE {self.raw_table} SET is_in_final_table = 't' WHERE is_in_final_table = 'f'"
-        self.connection.execute(text(query))
-        self.connection.commit()
+        query = f"UPDATE {self.raw_table} SET is_in_final_table = 't' WHERE NOT is_in_final_table"
+        with metrics.stage("postgres.set_is_in_final_table"):
+            self.connection.execute(text(query))
+            self.connection.commit()
+
+    def mark_raw_final(self, df) -> int:
+        """
+        Mark the raw rows of every trip in df up to its tstamp as in the final table. The online speed path calls this
+        once the breadcrumbs up to there are committed, so a raw row is only marked when its breadcrumb is in.
+        :param df: trip_id and tstamp, see RAW_FINAL_SCHEMA
+        :return: number of raw rows marked
+        """
+        if df.empty:
+            return 0
+        df = apply_schema(df, RAW_FINAL_SCHEMA)
+        query = f"""
+            UPDATE {self.raw_table} AS raw SET is_in_final_table = 't'
+            FROM unnest(CAST(:trip_ids AS integer[]), CAST(:tstamps AS timestamp[])) AS final(trip_id, tstamp)
+            WHERE NOT raw.is_in_final_table AND raw."EVENT_NO_TRIP" = final.trip_id AND raw."timestamp" <= final.tstamp
+        """
+        params = {"trip_ids": df["trip_id"].astype(int).tolist(), "tstamps": df["tstamp"].tolist()}
+        with metrics.stage("postgres.mark_raw_final"), self.engine.begin() as connection:
+            return connection.execute(text(query), params).rowcount
+
+    @contextmanager
+    def unprocessed_raw(self, shard: int = 0, shards: int = 1, quiet_seconds: float = 0):
+        """
+        The raw rows that aren't in the final table yet, for raw_to_processed:
+
+            with connector.unprocessed_raw() as (raw_df, connection):
+                ...write raw_df to the final tables, in connection's transaction if you want it all or nothing...
+
+        The rows are read in a REPEATABLE READ transaction, and when the with block finishes without an error the same
+        transaction marks them as in the final table. The update only sees the snapshot, so rows the subscriber appends
+        while raw_to_processed is running are left for the next run instead of being marked without being processed,
+        which is what set_is_in_final_table would do. If the block raises nothing is marked.
+
+        With shards > 1 only the rows whose hash of (EVENT_NO_TRIP, VEHICLE_ID) falls in shard are read and marked, so
+        every trip is whole in exactly one shard and the shards can be processed side by side (see
+        src/sharded_processing.py).
+
+        With quiet_seconds > 0 a trip is only read once its newest unprocessed fix is that much older than the newest
+        unprocessed fix of any trip, i.e. once it has probably ended. A run while the buses are still out (the ingest
+        daemon's) then leaves the trips that are still going for later instead of cutting them in two, which would
+        leave the first breadcrumb of the second half without a speed. The clock is the fixes' own timestamps rather
+        than now, so it works the same for a backlog of an old day.
+        """
+        # NOT is_in_final_table is what the partial index is on, so the planner can use it
+        where = "NOT is_in_final_table"
+        params = {}
+        if shards > 1:
+            # & drops the sign bit, abs() would overflow on the smallest int
+            where += (' AND (hashtext("EVENT_NO_TRIP"::text || \'|\' || "VEHICLE_ID"::text) & 2147483647) % :shards'
+                      ' = :shard')
+            params = {"shard": shard, "shards": shards}
+        if quiet_seconds > 0:
+            where += f"""
+                AND ("EVENT_NO_TRIP", "VEHICLE_ID") IN (
+                    SELECT "EVENT_NO_TRIP", "VEHICLE_ID" FROM {self.raw_table}
+                    WHERE NOT is_in_final_table
+                    GROUP BY "EVENT_NO_TRIP", "VEHICLE_ID"
+                    HAVING max("timestamp") <= (
+                        SELECT max("timestamp") FROM {self.raw_table} WHERE NOT is_in_final_table
+                    ) - make_interval(secs => :quiet_seconds))"""
+            params["quiet_seconds"] = quiet_seconds
+        with self.engine.connect().execution_options(isolation_level="REPEATABLE READ") as connection:
+            with connection.begin():
+                with metrics.stage("postgres.get_unprocessed_raw"):
+                    query = f"SELECT {column_list(RAW_SCHEMA)} FROM {self.raw_table} WHERE {where}"
+                    raw_df = apply_schema(pd.read_sql(text(query), connection, params=params), RAW_SCHEMA)
+                yield raw_df, connection
+                with metrics.stage("postgres.set_is_in_final_table"):
+                    connection.execute(text(f"UPDATE {self.raw_table} SET is_in_final_table = 't' WHERE {where}"),
+                                       params)
 
     def append_to_breadcrumb(self, df):
-        df.to_sql(self.breadcrumb_table, self.engine, if_exists='append', index=False)
+        metrics.count("postgres.append_to_breadcrumb.rows", len(df))
+        with metrics.stage("postgres.append_to_breadcrumb"):
+            df = apply_schema(df, BREADCRUMB_SCHEMA)
+            df.to_sql(self.breadcrumb_table, self.engine, if_exists='append', index=False,
+                      dtype=sql_types(BREADCRUMB_SCHEMA))
         
     def append_to_trip(self, df):
-        df.to_sql(self.trip_table, self.engine, if_exists='append', index=False)
+        """
+        New trips from the breadcrumb pipeline. A trip that is already there is left alone instead of failing the
+        batch or being added twice, and any metadata the stop events sent before the trip existed is merged in.
+        :return: trip ids that got their metadata
+        """
+        metrics.count("postgres.append_to_trip.rows", len(df))
+        with metrics.stage("postgres.append_to_trip"), self.engine.begin() as connection:
+            self._create_trip_tables(connection)
+            self._stage_trips(connection, apply_schema(df, TRIP_SCHEMA), "staged_trip")
+            connection.execute(text(f"""
+                    INSERT INTO {self.trip_table} (trip_id, route_id, vehicle_id, service_key, direction)
+                    SELECT trip_id, route_id, vehicle_id, service_key, direction
+                    FROM staged_trip
+                    ON CONFLICT (trip_id) DO NOTHING;
+                """))
+            self._lock_trip_metadata(connection)
+            merged = self._merge_trip_metadata(connection)
+        metrics.count("postgres.trip_metadata.merged", len(merged))
+        return merged
+
+    def get_pending_trip_metadata(self):
+        return pd.read_sql(f"SELECT * FROM {self.trip_metadata_table}", self.engine)
 
     def get_raw(self):
-        return pd.read_sql(f"SELECT * FROM {self.raw_table}", self.engine)
+        return apply_schema(pd.read_sql(f"SELECT {column_list(RAW_SCHEMA)} FROM {self.raw_table}", self.engine),
+                            RAW_SCHEMA)
+
+    def get_breadcrumb(self, up_to_id: int = None):
+        """
+        :param up_to_id: only the rows with a breadcrumb_id up to this one, see last_breadcrumb_id
+        """
+        query = f"SELECT {column_list(BREADCRUMB_SCHEMA)} FROM {self.breadcrumb_table}"
+        if up_to_id is not None:
+            query += f" WHERE breadcrumb_id <= {int(up_to_id)}"
+        return apply_schema(pd.read_sql(query, self.engine), BREADCRUMB_SCHEMA)
 
-    def get_breadcrumb(self):
-        return pd.read_sql(f"SELECT * FROM {self.breadcrumb_table}", self.engine)
+    def last_breadcrumb_id(self) -> int | None:
+        """
+        :return: the highest breadcrumb_id, 0 for an empty table, or None if the table doesn't have the column yet
+        """
+        try:
+            with self.engine.connect() as connection:
+                last = connection.execute(text(f"SELECT max(breadcrumb_id) FROM {self.breadcrumb_table}")).scalar()
+        except Exception:
+            return None
+        return last or 0
 
     def get_trip(self):
-        return pd.read_sql(f"SELECT * FROM {self.trip_table}", self.engine)
+        return apply_schema(pd.read_sql(f"SELECT * FROM {self.trip_table}", self.engine), TRIP_SCHEMA)
 
     def empty_raw(self):
         query = f"DELETE FROM {self.raw_table}"
@@ -0,0 +1,198 @@
+import datetime as dt
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import NamedTuple
+import pytz
+import requests
+
+# empty turns the cache off and every vehicle is fetched and published like before
+RESPONSE_CACHE_DIR = os.environ.get("RESPONSE_CACHE_DIR", os.path.expanduser("~/busdata_cache"))
+# days of responses to keep around for replays
+RESPONSE_CACHE_DAYS = int(os.environ.get("RESPONSE_CACHE_DAYS", "14"))
+REQUEST_TIMEOUT = 60
+
+
+def service_day(now: dt.datetime = None) -> str:
+    """
+    :return: today in Portland as YYYY-MM-DD, which is the day a publisher run is filed under
+    """
+    now = now or dt.datetime.now(pytz.timezone('US/Pacific'))
+    return now.strftime("%Y-%m-%d")
+
+
+class CachedResponse(NamedTuple):
+    ok: bool
+    status: int
+    content: bytes
+    # True unless the body is the one that was published last time for this vehicle and day
+    changed: bool
+    # True if the body came from disk (a 304, or a replay) instead of over the network
+    from_cache: bool
+    sha256: str
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class ResponseCache:
+    """
+    On disk cache of the busdata API responses, one file per endpoint, vehicle and service day:
+
+        {cache_dir}/{day}/{endpoint}/{vehicle_id}.gz     the body, gzipped
+        {cache_dir}/{day}/{endpoint}/{vehicle_id}.json   ETag, Last-Modified, sha256 of the body, and the sha256 of
+                                                         the body we last published
+
+    fetch sends If-None-Match/If-Modified-Since when it has them, so an unchanged vehicle costs a 304 instead of the
+    whole body. The API doesn't always send validators, so the body hash is compared too. A response is "changed" when
+    it isn't the body we already published for that vehicle today, and the publishers skip the ones that aren't. The
+    publisher calls mark_published once a vehicle's messages are out, so a run that crashed halfway only republishes
+    the vehicles it hadn't finished.
+
+    With offline=True nothing goes over the network, fetch returns what was stored for that day and every response
+    counts as changed, which replays a past day's run (REPLAY_DATE=2024-04-15 in the publishers).
+    """
+
+    def __init__(self, cache_dir: str, day: str = None, offline: bool = False, session: requests.Session = None,
+                 keep_days: int = RESPONSE_CACHE_DAYS):
+        self.cache_dir = cache_dir
+        self.day = day or service_day()
+        self.offline = offline
+        self._session = session or requests.Session()
+        self.stats = {"requests": 0, "not_modified": 0, "unchanged": 0, "changed": 0, "replayed": 0, "errors": 0,
+                      "bytes_downloaded": 0}
+        if not offline:
+            self.prune(keep_days)
+
+    def _path(self, endpoint: str, vehicle_id: int, suffix: str) -> str:
+        return os.path.join(self.cache_dir, self.day, endpoint, f"{vehicle_id}{suffix}")
+
+    def _load_meta(self, endpoint: str, vehicle_id: int) -> dict | None:
+        try:
+            with open(self._path(endpoint, vehicle_id, ".json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_meta(self, endpoint: str, vehicle_id: int, meta: dict) -> None:
+        path = self._path(endpoint, vehicle_id, ".json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(path + ".tmp", path)
+
+    def _load_body(self, endpoint: str, vehicle_id: int) -> bytes | None:
+        try:
+            with gzip.open(self._path(endpoint, vehicle_id, ".gz"), "rb") as f:
+                return f.read()
+        except (OSError, EOFError):
+            return None
+
+    def _save_body(self, endpoint: str, vehicle_id: int, body: bytes) -> None:
+        path = self._path(endpoint, vehicle_id, ".gz")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with gzip.open(path + ".tmp", "wb", compresslevel=6) as f:
+            f.write(body)
+        os.replace(path + ".tmp", path)
+
+    def fetch(self, url: str, endpoint: str, vehicle_id: int, params: dict = None) -> CachedResponse:
+        """
+        :param url: the API url
+        :param endpoint: name the response is filed under, e.g. getBreadCrumbs
+        :param vehicle_id: the vehicle the request is for
+        :param params: query parameters
+        :return: CachedResponse, ok is False if the request failed or (offline) there is nothing stored
+        """
+        meta = self._load_meta(endpoint, vehicle_id)
+        if self.offline:
+            body = self._load_body(endpoint, vehicle_id) if meta is not None else None
+            if body is None:
+                return CachedResponse(False, 404, b"", False, True, "")
+            self.stats["replayed"] += 1
+            return CachedResponse(True, 200, body, True, True, meta["sha256"])
+
+        headers = {}
+        body = None
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        self.stats["requests"] += 1
+        try:
+            response = self._session.get(url, params=params, headers=headers, timeout=REQUEST_TIMEOUT)
+        except requests.RequestException:
+            self.stats["errors"] += 1
+            return CachedResponse(False, 0, b"", False, False, "")
+
+        if response.status_code == 304 and meta is not None:
+            body = self._load_body(endpoint, vehicle_id)
+            if body is not None:
+                self.stats["not_modified"] += 1
+                meta["checked_at"] = time.time()
+                self._save_meta(endpoint, vehicle_id, meta)
+                return self._result(meta, body, from_cache=True)
+            # the body is gone, ask again without the validators
+            response = self._session.get(url, params=params, timeout=REQUEST_TIMEOUT)
+
+        if not response.ok:
+            self.stats["errors"] += 1
+            return CachedResponse(False, response.status_code, response.content, False, False, "")
+
+        body = response.content
+        self.stats["bytes_downloaded"] += len(body)
+        digest = hashlib.sha256(body).hexdigest()
+        if meta is None or meta.get("sha256") != digest:
+            self._save_body(endpoint, vehicle_id, body)
+        meta = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "sha256": digest,
+            "published_sha256": meta.get("published_sha256") if meta is not None else None,
+            "fetched_at": time.time(),
+            "checked_at": time.time(),
+        }
+        self._save_meta(endpoint, vehicle_id, meta)
+        return self._result(meta, body, from_cache=False)
+
+    def _result(self, meta: dict, body: bytes, from_cache: bool) -> CachedResponse:
+        changed = meta["sha256"] != meta.get("published_sha256")
+        self.stats["changed" if changed else "unchanged"] += 1
+        return CachedResponse(True, 200, body, changed, from_cache, meta["sha256"])
+
+    def mark_published(self, endpoint: str, vehicle_id: int, response: CachedResponse) -> None:
+        """
+        Remember that this body has been published, so the next run today skips the vehicle unless it changes.
+        """
+        if self.offline:
+            return
+        meta = self._load_meta(endpoint, vehicle_id)
+        if meta is None:
+            return
+        meta["published_sha256"] = response.sha256
+        self._save_meta(endpoint, vehicle_id, meta)
+
+    def prune(self, keep_days: int) -> int:
+        """
+        Delete the days older than keep_days.
+        :return: number of days deleted
+        """
+        if not os.path.isdir(self.cache_dir):
+            return 0
+        cutoff = (dt.datetime.strptime(self.day, "%Y-%m-%d") - dt.timedelta(days=keep_days)).strftime("%Y-%m-%d")
+        deleted = 0
+        for name in os.listdir(self.cache_dir):
+            if len(name) == 10 and name < cutoff and os.path.isdir(os.path.join(self.cache_dir, name)):
+                shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+                deleted += 1
+        return deleted
+
+    def report(self) -> str:
+        return ", ".join(f"{name} {value}" for name, value in self.stats.items())
@@ -0,0 +1,130 @@
+"""
+Declared column types for every frame and table in the pipeline. Left alone pandas gives us int64, float64 and object
+columns, and to_sql turns those into bigint, double precision and text. Nothing we store needs that much room:
+
+- trip ids are around 2.6e8 and vehicle ids are four digits, so int32/integer is plenty (METERS too, a bus would have
+  to drive two million km in one trip to overflow it)
+- float32 keeps ~7 significant digits, which for a longitude around -122.6 is a step of about 8e-6 degrees, i.e.
+  well under a meter, and the GPS fixes themselves are only good to a few meters. Speed in m/s doesn't need more either
+- route_id, direction and service_key only take a handful of values, so categoricals store a one byte code per row
+- processed_date was a column of python date objects and is now datetime64, is_in_final_table is a numpy bool
+
+Memory per million rows (pandas memory_usage(deep=True), computed from the dtypes, run the schema_memory benchmark to
+measure it on real frames):
+
+    raw         89 MB -> 37 MB   (5 x 8 byte numbers + date objects + bool + timestamp -> 5 x 4 + 8 + 1 + 8)
+    breadcrumb  40 MB -> 24 MB   (tstamp stays 8 bytes, lat/lon/speed/trip_id go from 8 to 4)
+    trip        88 MB -> 11 MB   (mostly the None objects in route_id/service_key/direction becoming 1 byte codes)
+
+On disk a new breadcrumb table row is 52 bytes instead of 68 (28 bytes of tuple header and line pointer plus the
+data) and a raw row goes from 84 to 68, so roughly a quarter and a fifth smaller. Existing tables keep the types they
+were created with since to_sql only uses dtype when it creates the table.
+"""
+import pandas as pd
+from sqlalchemy import Boolean, Date, DateTime, Integer, REAL, Text
+
+RAW_SCHEMA = {
+    "EVENT_NO_TRIP": "int32",
+    "VEHICLE_ID": "int32",
+    "METERS": "int32",
+    "GPS_LONGITUDE": "float32",
+    "GPS_LATITUDE": "float32",
+    "processed_date": "datetime64[ns]",
+    "is_in_final_table": "bool",
+    "timestamp": "datetime64[ns]",
+}
+
+BREADCRUMB_SCHEMA = {
+    "tstamp": "datetime64[ns]",
+    "latitude": "float32",
+    "longitude": "float32",
+    "speed": "float32",
+    "trip_id": "int32",
+}
+
+TRIP_SCHEMA = {
+    "trip_id": "int32",
+    "route_id": "category",
+    "vehicle_id": "int32",
+    "service_key": "category",
+    "direction": "category",
+}
+
+PART3_SCHEMA = {
+    "trip_id": "int32",
+    "route_id": "category",
+    "vehicle_id": "int32",
+    "service_key": "category",
+    "direction": "category",
+}
+
+# the newest breadcrumb of each trip the online speed path has committed, its raw rows up to there are marked as in
+# the final table (see PostgresConnector.mark_raw_final)
+RAW_FINAL_SCHEMA = {
+    "trip_id": "int32",
+    "tstamp": "datetime64[ns]",
+}
+
+_SQL_TYPES = {
+    "int32": Integer,
+    "float32": REAL,
+    "bool": Boolean,
+    "category": Text,
+}
+
+
+def sql_types(schema: dict, date_columns: tuple = ("processed_date",)) -> dict:
+    """
+    The SQLAlchemy types to hand to to_sql as dtype, so new tables are created with the narrow Postgres types.
+    :param schema: one of the schemas above
+    :param date_columns: datetime64 columns that only hold a date
+    :return: dict of column name to SQLAlchemy type
+    """
+    types = {}
+    for column, dtype in schema.items():
+        if dtype.startswith("datetime64"):
+            types[column] = Date if column in date_columns else DateTime
+        else:
+            types[column] = _SQL_TYPES[dtype]
+    return types
+
+
+def column_list(schema: dict, alias: str = None) -> str:
+    """
+    The schema's columns quoted for a SELECT. Reading these instead of * keeps the surrogate keys (see
+    src/migrations.py) and anything else that only lives in the database out of the frames.
+    :param schema: one of the schemas above
+    :param alias: table alias to prefix the columns with
+    """
+    prefix = f"{alias}." if alias else ""
+    return ", ".join(f'{prefix}"{column}"' for column in schema)
+
+
+def apply_schema(df: pd.DataFrame, schema: dict) -> pd.DataFrame:
+    """
+    Cast the columns of df that are in the schema. Columns that are already the right type are left alone, so calling
+    this on a frame that has been through it before is cheap. Integer columns with missing values get the nullable
+    Int32 type instead of failing.
+    :param df: pd.DataFrame
+    :param schema: one of the schemas above
+    :return: pd.DataFrame with the declared types
+    """
+    casts = {}
+    for column, dtype in schema.items():
+        if column not in df.columns or str(df[column].dtype) == dtype:
+            continue
+        if dtype == "int32" and df[column].isnull().any():
+            dtype = "Int32"
+        casts[column] = dtype
+    if not casts:
+        return df
+    return df.astype(casts)
+
+
+def bytes_per_row(df: pd.DataFrame) -> float:
+    """
+    :return: average bytes per row of df including python objects, which is the same number as MB per million rows
+    """
+    if len(df) == 0:
+        return 0.0
+    return df.memory_usage(deep=True, index=False).sum() / len(df)
@@ -0,0 +1,185 @@
+import datetime as dt
+import hashlib
+import math
+import os
+import struct
+import threading
+from src.date_cache import opd_date_cache
+
+# empty turns the seen-set off and every fetched breadcrumb is published like before
+SEEN_SET_DIR = os.environ.get("SEEN_SET_DIR", os.path.expanduser("~/breadcrumb_seen"))
+# breadcrumbs per service day the filter is sized for, TriMet has ~1.5 million on a weekday. Going over still works,
+# the false positive rate just climbs
+SEEN_SET_CAPACITY = int(os.environ.get("SEEN_SET_CAPACITY", "5000000"))
+# chance a breadcrumb that was never published is taken for one that was (and not published)
+SEEN_SET_ERROR_RATE = float(os.environ.get("SEEN_SET_ERROR_RATE", "0.0001"))
+SEEN_SET_DAYS = int(os.environ.get("SEEN_SET_DAYS", "3"))
+
+# magic, bits, hash functions, keys added, capacity, error rate
+FILE_HEADER = struct.Struct("<4sQIQQd")
+MAGIC = b"BLM1"
+
+
+class BloomFilter:
+    """
+    Plain Bloom filter over a bytearray. The k bit positions come from one blake2b digest split into two 64 bit halves
+    (h1 + i * h2, Kirsch and Mitzenmacher), so a lookup is one hash no matter what k is. Sized the textbook way:
+    bits = -n ln(p) / ln(2)^2 and k = bits / n * ln(2), which for 5 million keys at 1 in 10,000 is 12 MB and 13 hashes.
+    """
+
+    def __init__(self, capacity: int, error_rate: float, bits: int = None, hashes: int = None, data: bytearray = None,
+                 count: int = 0):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bits = bits or max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = hashes or max(1, int(round(self.bits / capacity * math.log(2))))
+        self.data = data if data is not None else bytearray((self.bits + 7) // 8)
+        self.count = count
+
+    def _positions(self, key: bytes):
+        digest = int.from_bytes(hashlib.blake2b(key, digest_size=16).digest(), "little")
+        bits = self.bits
+        position = (digest & 0xFFFFFFFFFFFFFFFF) % bits
+        step = ((digest >> 64) | 1) % bits
+        for _ in range(self.hashes):
+            yield position
+            position += step
+            if position >= bits:
+                position -= bits
+
+    def __contains__(self, key: bytes) -> bool:
+        data = self.data
+        return all(data[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def add(self, key: bytes) -> bool:
+        """
+        :return: True if the key wasn't in the filter (as far as the filter can tell)
+        """
+        data = self.data
+        new = False
+        # this is the publisher's inner loop, hence the inlined _positions
+        digest = int.from_bytes(hashlib.blake2b(key, digest_size=16).digest(), "little")
+        bits = self.bits
+        position = (digest & 0xFFFFFFFFFFFFFFFF) % bits
+        step = ((digest >> 64) | 1) % bits
+        for _ in range(self.hashes):
+            byte = position >> 3
+            mask = 1 << (position & 7)
+            if not data[byte] & mask:
+                data[byte] |= mask
+                new = True
+            position += step
+            if position >= bits:
+                position -= bits
+        if new:
+            self.count += 1
+        return new
+
+    def estimated_error_rate(self) -> float:
+        return (1 - math.exp(-self.hashes * self.count / self.bits)) ** self.hashes
+
+    def save(self, path: str) -> None:
+        with open(path + ".tmp", "wb") as f:
+            f.write(FILE_HEADER.pack(MAGIC, self.bits, self.hashes, self.count, self.capacity, self.error_rate))
+            f.write(self.data)
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def load(path: str) -> "BloomFilter":
+        with open(path, "rb") as f:
+            magic, bits, hashes, count, capacity, error_rate = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a seen-set file")
+            data = bytearray(f.read())
+        if len(data) != (bits + 7) // 8:
+            raise ValueError(f"{path} is truncated")
+        return BloomFilter(capacity, error_rate, bits, hashes, data, count)
+
+
+class SeenSet:
+    """
+    The breadcrumbs the publisher has already put on the topic, so a rerun or an overlapping fetch doesn't publish them
+    again. A breadcrumb is identified by vehicle, trip, OPD_DATE and ACT_TIME, and there is one Bloom filter per service
+    day (OPD_DATE) in {directory}/{day}.bloom. Filters are loaded the first time a day comes up and written back by
+    save, days older than keep_days are deleted.
+
+    A Bloom filter never forgets a key, so the worst it can do is skip a breadcrumb that wasn't published yet, with
+    probability error_rate. Breadcrumbs with an OPD_DATE that doesn't parse are always let through, the subscriber
+    throws them away anyway.
+    """
+
+    def __init__(self, directory: str, capacity: int = SEEN_SET_CAPACITY, error_rate: float = SEEN_SET_ERROR_RATE,
+                 keep_days: int = SEEN_SET_DAYS):
+        self.directory = directory
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.keep_days = keep_days
+        self._filters = {}
+        self._dirty = set()
+        # OPD_DATE -> YYYY-MM-DD, there are only ever a couple of distinct OPD_DATEs in a run
+        self._days = {}
+        self._lock = threading.Lock()
+        self.stats = {"new": 0, "seen": 0, "unkeyed": 0}
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, day: str) -> str:
+        return os.path.join(self.directory, f"{day}.bloom")
+
+    def _filter(self, day: str) -> BloomFilter:
+        bloom = self._filters.get(day)
+        if bloom is None:
+            try:
+                bloom = BloomFilter.load(self._path(day))
+            except (OSError, ValueError, struct.error):
+                bloom = BloomFilter(self.capacity, self.error_rate)
+            self._filters[day] = bloom
+        return bloom
+
+    def add(self, breadcrumb: dict) -> bool:
+        """
+        :param breadcrumb: a breadcrumb dict from the api
+        :return: True if it hasn't been published before and should be, False to skip it
+        """
+        try:
+            opd_date = breadcrumb["OPD_DATE"]
+            day = self._days.get(opd_date)
+            if day is None:
+                service_date = opd_date_cache.try_parse(opd_date)
+                day = self._days[opd_date] = service_date.strftime("%Y-%m-%d") if service_date is not None else ""
+            key = f"{breadcrumb['VEHICLE_ID']}|{breadcrumb['EVENT_NO_TRIP']}|{breadcrumb['ACT_TIME']}".encode("utf-8")
+        except (KeyError, TypeError):
+            day = ""
+        if not day:
+            self.stats["unkeyed"] += 1
+            return True
+
+        with self._lock:
+            new = self._filter(day).add(key)
+            if new:
+                self._dirty.add(day)
+        self.stats["new" if new else "seen"] += 1
+        return new
+
+    def save(self) -> int:
+        """
+        Write the filters that changed since the last save and delete the days that are too old.
+        :return: number of filters written
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            for day in dirty:
+                self._filters[day].save(self._path(day))
+            if self._filters:
+                newest = max(dt.date.fromisoformat(day) for day in self._filters)
+                cutoff = (newest - dt.timedelta(days=self.keep_days)).isoformat()
+                for name in os.listdir(self.directory):
+                    if name.endswith(".bloom") and name[:-len(".bloom")] < cutoff:
+                        os.remove(os.path.join(self.directory, name))
+                        self._filters.pop(name[:-len(".bloom")], None)
+        return len(dirty)
+
+    def report(self) -> str:
+        days = ", ".join(f"{day}: {bloom.count} keys, ~{bloom.estimated_error_rate():.1e} false positives"
+                         for day, bloom in sorted(self._filters.items()))
+        return (f"{self.stats['new']} new, {self.stats['seen']} already published, {self.stats['unkeyed']} unkeyed "
+                f"({days})")
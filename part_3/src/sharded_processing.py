@@ -0,0 +1,92 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from src.breadcrumb_processor import BreadCrumbProcessor
+from src.instrumentation import metrics
+from src.postgres_connector import PostgresConnector
+from src.schema import BREADCRUMB_SCHEMA
+
+# how many pieces raw_to_processed splits the raw table into, 1 processes everything in the subscriber's process
+RAW_TO_PROCESSED_SHARDS = int(os.environ.get("RAW_TO_PROCESSED_SHARDS", "1"))
+# worker processes for the shards, defaults to one per shard up to the number of cores
+RAW_TO_PROCESSED_WORKERS = int(os.environ.get("RAW_TO_PROCESSED_WORKERS", "0")) or None
+# a shard that fails is tried this many more times, after that its rows stay unprocessed for the next run
+SHARD_RETRIES = int(os.environ.get("SHARD_RETRIES", "2"))
+SHARD_RETRY_SECONDS = 5
+
+
+def process_shard(shard: int, shards: int, connector: PostgresConnector = None, quiet_seconds: float = 0) -> dict:
+    """
+    raw_to_processed for the trips in one shard. The breadcrumbs are COPYed in the same transaction that marks the raw
+    rows as in the final table, so a shard either goes in completely or not at all and retrying it can't add anything
+    twice. The trips go in first in a transaction of their own, which is fine because adding a trip twice does nothing.
+    :param shard: which shard, 0 to shards - 1
+    :param shards: how many shards there are
+    :param connector: the PostgresConnector to use, by default (in a worker process) the shard makes its own
+    :param quiet_seconds: leave the trips that are still going, see PostgresConnector.unprocessed_raw
+    :return: dict with the shard, how many raw rows, breadcrumbs and trips it had, and the trip ids for the summaries
+    """
+    own_connector = connector is None
+    if own_connector:
+        # the process that started the shards is the one that decides about migrating
+        connector = PostgresConnector(migrate=False)
+    try:
+        with connector.unprocessed_raw(shard, shards, quiet_seconds) as (raw_df, connection):
+            with metrics.stage("raw_to_processed.filter"):
+                raw_df = raw_df.drop_duplicates()
+            with metrics.stage("raw_to_processed.transform"):
+                trip_df, breadcrumb_df = BreadCrumbProcessor.raw_table_to_processed_tables(raw_df)
+            connector.append_to_trip(trip_df)
+            breadcrumbs = connector.bulk_append(connector.breadcrumb_table, breadcrumb_df, BREADCRUMB_SCHEMA,
+                                                connection=connection)
+        return {"shard": shard, "raw_rows": len(raw_df), "breadcrumbs": breadcrumbs, "trips": len(trip_df),
+                "trip_ids": breadcrumb_df["trip_id"].unique().tolist()}
+    finally:
+        if own_connector:
+            connector.connection.close()
+            connector.engine.dispose()
+
+
+def process_sharded(shards: int = RAW_TO_PROCESSED_SHARDS, workers: int = RAW_TO_PROCESSED_WORKERS,
+                    retries: int = SHARD_RETRIES, retry_seconds: float = SHARD_RETRY_SECONDS,
+                    quiet_seconds: float = 0) -> dict:
+    """
+    raw_to_processed split by hash of (trip, vehicle) inside the database, with every shard in a worker process of its
+    own. add_speed and the plausibility filter only ever look at one trip at a time, so the shards don't need anything
+    from each other and the wall time goes down with the number of workers, until Postgres is the bottleneck.
+
+    The shards are independent transactions, so one that fails (a lost connection, a worker that died) doesn't take
+    the others with it. The failed ones are run again up to retries times, in a new pool in case the old one is broken.
+    A shard that keeps failing is left unmarked in the raw table and the next raw_to_processed picks it up.
+    :return: dict with the totals, trip_ids of every shard that went in, and failed, shard -> last error
+    """
+    workers = min(workers or shards, shards, os.cpu_count() or 1)
+    # spawn like the subscriber workers, a forked child would share the parent's connections
+    context = multiprocessing.get_context("spawn")
+    totals = {"shards": shards, "raw_rows": 0, "breadcrumbs": 0, "trips": 0, "trip_ids": [], "retried": 0,
+              "failed": {}}
+    pending = list(range(shards))
+    for attempt in range(retries + 1):
+        if not pending:
+            break
+        if attempt:
+            totals["retried"] += len(pending)
+            time.sleep(retry_seconds)
+        failed = {}
+        with ProcessPoolExecutor(max_workers=min(workers, len(pending)), mp_context=context) as pool:
+            futures = {pool.submit(process_shard, shard, shards, None, quiet_seconds): shard for shard in pending}
+            for future in as_completed(futures):
+                shard = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    metrics.count("raw_to_processed.shard_failures")
+                    failed[shard] = f"{type(e).__name__}: {e}"
+                    continue
+                for key in ("raw_rows", "breadcrumbs", "trips"):
+                    totals[key] += result[key]
+                totals["trip_ids"].extend(result["trip_ids"])
+        pending = sorted(failed)
+        totals["failed"] = failed
+    return totals
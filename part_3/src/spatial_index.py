@@ -0,0 +1,140 @@
+import threading
+import numpy as np
+import pandas as pd
+
+# about 1.1 km north/south, a good size for bus density downtown
+DEFAULT_CELL_DEGREES = 0.01
+TILE_SIZE = 256
+# at zoom z one screen pixel is 360 / (256 * 2^z) degrees of longitude, keeping one point per this many pixels is
+# about as dense as the circle layer can draw without the points sitting on top of each other
+DECIMATION_PIXELS = 3
+
+
+class GridIndex:
+    """
+    Spatial index over breadcrumb points for the map server. The world is cut into a fixed grid of cell_degrees sized
+    cells, and the points are stored sorted by cell key (row * columns + column). All the cells of one grid row that
+    overlap a bounding box are consecutive keys, so a box query is one pair of binary searches per grid row followed by
+    an exact filter on the candidates. The work depends on how many points are in the viewport, not on how many points
+    there are in total.
+
+    Everything lives in numpy arrays: latitude, longitude, speed, trip_id, and tstamp as seconds since the epoch. extend
+    adds new points and is safe to call while queries are running.
+    """
+
+    def __init__(self, cell_degrees: float = DEFAULT_CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        self._columns = int(np.ceil(360 / cell_degrees))
+        self._lock = threading.Lock()
+        self._keys = np.empty(0, dtype=np.int64)
+        self._latitude = np.empty(0, dtype=np.float32)
+        self._longitude = np.empty(0, dtype=np.float32)
+        self._speed = np.empty(0, dtype=np.float32)
+        self._trip_id = np.empty(0, dtype=np.int64)
+        self._tstamp = np.empty(0, dtype=np.int64)
+
+    @staticmethod
+    def from_frame(df: pd.DataFrame, cell_degrees: float = DEFAULT_CELL_DEGREES):
+        """
+        :param df: breadcrumb table rows (latitude, longitude, speed, and optionally tstamp and trip_id)
+        """
+        index = GridIndex(cell_degrees)
+        index.extend(df)
+        return index
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def _cell(self, latitude, longitude):
+        column = np.floor((np.asarray(longitude, dtype=np.float64) + 180) / self.cell_degrees).astype(np.int64)
+        row = np.floor((np.asarray(latitude, dtype=np.float64) + 90) / self.cell_degrees).astype(np.int64)
+        return row, np.clip(column, 0, self._columns - 1)
+
+    def extend(self, df: pd.DataFrame) -> None:
+        """
+        Add points. Rows without a position are skipped, rows without a speed (the first fix of every trip) are kept
+        with a NaN speed.
+        """
+        df = df.dropna(subset=["latitude", "longitude"])
+        if df.empty:
+            return
+        latitude = df["latitude"].to_numpy(dtype=np.float32)
+        longitude = df["longitude"].to_numpy(dtype=np.float32)
+        speed = df["speed"].to_numpy(dtype=np.float32, na_value=np.nan) if "speed" in df else \
+            np.full(len(df), np.nan, dtype=np.float32)
+        trip_id = df["trip_id"].to_numpy(dtype=np.int64) if "trip_id" in df else np.zeros(len(df), dtype=np.int64)
+        if "tstamp" in df:
+            tstamp = pd.to_datetime(df["tstamp"]).to_numpy(dtype="datetime64[s]").astype(np.int64)
+        else:
+            tstamp = np.zeros(len(df), dtype=np.int64)
+        row, column = self._cell(latitude, longitude)
+        keys = row * self._columns + column
+
+        with self._lock:
+            keys = np.concatenate([self._keys, keys])
+            order = np.argsort(keys, kind="stable")
+            self._keys = keys[order]
+            self._latitude = np.concatenate([self._latitude, latitude])[order]
+            self._longitude = np.concatenate([self._longitude, longitude])[order]
+            self._speed = np.concatenate([self._speed, speed])[order]
+            self._trip_id = np.concatenate([self._trip_id, trip_id])[order]
+            self._tstamp = np.concatenate([self._tstamp, tstamp])[order]
+
+    def query(self, west: float, south: float, east: float, north: float, start: int = None, end: int = None,
+              zoom: float = None, limit: int = None) -> dict:
+        """
+        :param west, south, east, north: bounding box in degrees
+        :param start: only points at or after this many seconds since the epoch
+        :param end: only points before this many seconds since the epoch
+        :param zoom: map zoom level, if given the points are thinned to about one per DECIMATION_PIXELS pixels
+        :param limit: most points to return, evenly sampled if there are more
+        :return: dict of numpy arrays latitude, longitude, speed, trip_id, tstamp
+        """
+        with self._lock:
+            keys, latitude, longitude = self._keys, self._latitude, self._longitude
+            speed, trip_id, tstamp = self._speed, self._trip_id, self._tstamp
+
+        first_row, first_column = self._cell(south, west)
+        last_row, last_column = self._cell(north, east)
+        slices = []
+        for row in range(int(first_row), int(last_row) + 1):
+            low = np.searchsorted(keys, row * self._columns + first_column, side="left")
+            high = np.searchsorted(keys, row * self._columns + last_column, side="right")
+            if high > low:
+                slices.append(np.arange(low, high))
+        candidates = np.concatenate(slices) if slices else np.empty(0, dtype=np.int64)
+
+        mask = (latitude[candidates] >= south) & (latitude[candidates] <= north) & \
+               (longitude[candidates] >= west) & (longitude[candidates] <= east)
+        if start is not None:
+            mask &= tstamp[candidates] >= start
+        if end is not None:
+            mask &= tstamp[candidates] < end
+        selected = candidates[mask]
+
+        if zoom is not None and len(selected):
+            pixel_degrees = 360 / (TILE_SIZE * 2 ** zoom) * DECIMATION_PIXELS
+            bucket_x = np.floor(longitude[selected] / pixel_degrees).astype(np.int64)
+            bucket_y = np.floor(latitude[selected] / pixel_degrees).astype(np.int64)
+            _, first = np.unique(bucket_y * (1 << 32) + bucket_x, return_index=True)
+            selected = selected[np.sort(first)]
+
+        if limit is not None and len(selected) > limit:
+            selected = selected[np.linspace(0, len(selected) - 1, limit).astype(np.int64)]
+
+        return {"latitude": latitude[selected], "longitude": longitude[selected], "speed": speed[selected],
+                "trip_id": trip_id[selected], "tstamp": tstamp[selected]}
+
+
+def points_to_geojson(points: dict, precision: int = 6) -> dict:
+    """
+    Turn the result of GridIndex.query into the FeatureCollection the map's speeds source expects.
+    """
+    features = []
+    for lon, lat, speed in zip(points["longitude"].tolist(), points["latitude"].tolist(), points["speed"].tolist()):
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [round(lon, precision), round(lat, precision)]},
+            "properties": {"speed": None if speed != speed else round(speed, 1)},
+        })
+    return {"type": "FeatureCollection", "features": features}
@@ -0,0 +1,422 @@
+import io
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError, OperationalError
+from src.instrumentation import metrics
+from src.schema import RAW_SCHEMA, BREADCRUMB_SCHEMA, TRIP_SCHEMA, PART3_SCHEMA, RAW_FINAL_SCHEMA, apply_schema
+
+# empty turns spilling off, and then a failed write raises like it always did
+SPILL_DIR = os.environ.get("SPILL_DIR", os.path.expanduser("~/breadcrumb_spill"))
+SPILL_MAX_BYTES = int(os.environ.get("SPILL_MAX_BYTES", str(1024 ** 3)))
+SPILL_SEGMENT_BYTES = int(os.environ.get("SPILL_SEGMENT_BYTES", str(16 * 1024 ** 2)))
+# how long to go straight to the log after a failed write before trying the database again
+SPILL_RETRY_SECONDS = float(os.environ.get("SPILL_RETRY_SECONDS", "30"))
+SPILL_FSYNC = os.environ.get("SPILL_FSYNC", "1") == "1"
+
+# magic, length of the record body, crc32 of the body
+RECORD_HEADER = struct.Struct("<4sII")
+MAGIC = b"SPL1"
+SEGMENT_SUFFIX = ".spill"
+CHECKPOINT_FILE = "checkpoint"
+# a segment with a damaged record in the middle is renamed to this and left for someone to look at
+CORRUPT_SUFFIX = ".corrupt"
+
+try:
+    # bulk_append COPYs through the raw psycopg2 cursor, so its errors don't get wrapped by SQLAlchemy
+    import psycopg2
+    _DRIVER_CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+except ImportError:
+    _DRIVER_CONNECTION_ERRORS = ()
+
+# what can be spilled, the schema it's read back with and the table the bulk path copies it into (None means it goes
+# back through the connector method instead, since those are merges or updates rather than appends)
+SPILL_KINDS = {
+    "raw": (RAW_SCHEMA, "raw_table"),
+    "breadcrumb": (BREADCRUMB_SCHEMA, "breadcrumb_table"),
+    "trip": (TRIP_SCHEMA, None),
+    "trip_metadata": (PART3_SCHEMA, None),
+    "raw_final": (RAW_FINAL_SCHEMA, None),
+}
+
+
+class SpillLogFull(Exception):
+    pass
+
+
+class SpillLogCorrupt(Exception):
+    def __init__(self, sequence: int, offset: int):
+        super().__init__(f"spill segment {sequence} is corrupt at byte {offset}")
+        self.sequence = sequence
+        self.offset = offset
+
+
+def is_outage(error: Exception) -> bool:
+    """
+    Whether a failed write means the database can't be reached (spill the batch and try again later) rather than
+    something wrong with the batch or the query, which would fail again on replay and should be raised instead.
+    """
+    if isinstance(error, OperationalError):
+        return True
+    if isinstance(error, DBAPIError) and error.connection_invalidated:
+        return True
+    return isinstance(error, _DRIVER_CONNECTION_ERRORS)
+
+
+class SpillLog:
+    """
+    Append only log on local disk for batches that couldn't be written to Postgres. The log is a directory of numbered
+    segment files. Every record is one batch: a small header (magic, length, crc32) followed by a JSON line saying what
+    the batch is (raw rows, breadcrumbs, trips, stop event trip metadata or raw rows to mark as final) and then the
+    batch as CSV with a header row, which is exactly what COPY wants, so replaying raw and breadcrumb batches doesn't go
+    through pandas at all.
+
+    A record is flushed (and fsynced unless SPILL_FSYNC=0) before append returns, so once a batch is in the log a crash
+    doesn't lose it. A record cut short by a crash is skipped, a damaged one stops the replay of its segment and the
+    segment is set aside instead of deleted. The log never grows past max_bytes, append raises SpillLogFull instead and
+    the caller has to hold on to the batch (or stop acking).
+
+    Only one process should write to a directory, the supervisor gives every worker its own.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = SPILL_MAX_BYTES, segment_bytes: int = SPILL_SEGMENT_BYTES,
+                 fsync: bool = SPILL_FSYNC):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._active = None
+        self._active_sequence = None
+        os.makedirs(directory, exist_ok=True)
+        sequences = self.segments()
+        # segments left by an earlier run are sealed, new records always go into a new segment. A number is never used
+        # twice, not even one whose segment was set aside or replayed, the checkpoint could still point into it
+        used = sequences + self._set_aside_segments() + [self.checkpoint()[0]]
+        self._next_sequence = max(used) + 1 if used else 0
+        self._bytes = sum(os.path.getsize(self._segment_path(sequence)) for sequence in sequences)
+        self.stats = {"records": 0, "rows": 0, "rejected": 0}
+        metrics.gauge("spill.bytes", self._bytes)
+
+    def _segment_path(self, sequence: int) -> str:
+        return os.path.join(self.directory, f"{sequence:010d}{SEGMENT_SUFFIX}")
+
+    def segments(self) -> list[int]:
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+
+    def _set_aside_segments(self) -> list[int]:
+        suffix = SEGMENT_SUFFIX + CORRUPT_SUFFIX
+        return [int(name[:-len(suffix)]) for name in os.listdir(self.directory)
+                if name.endswith(suffix) and name[:-len(suffix)].isdigit()]
+
+    def append(self, kind: str, df: pd.DataFrame) -> int:
+        """
+        Write one batch to the log.
+        :param kind: one of SPILL_KINDS
+        :param df: the batch
+        :return: number of bytes written
+        """
+        schema, _ = SPILL_KINDS[kind]
+        payload = io.BytesIO()
+        payload.write(json.dumps({"kind": kind, "rows": len(df), "spilled_at": time.time()}).encode("utf-8") + b"\n")
+        apply_schema(df, schema).to_csv(payload, index=False)
+        body = payload.getvalue()
+        record = RECORD_HEADER.pack(MAGIC, len(body), zlib.crc32(body)) + body
+
+        with self._lock:
+            if self._bytes + len(record) > self.max_bytes:
+                self.stats["rejected"] += 1
+                metrics.count("spill.rejected")
+                raise SpillLogFull(f"spill log {self.directory} is full ({self._bytes} bytes)")
+            if self._active is None or self._active.tell() >= self.segment_bytes:
+                self._open_segment()
+            self._active.write(record)
+            self._active.flush()
+            if self.fsync:
+                os.fsync(self._active.fileno())
+            self._bytes += len(record)
+            self.stats["records"] += 1
+            self.stats["rows"] += len(df)
+        metrics.count("spill.rows", len(df))
+        metrics.gauge("spill.bytes", self._bytes)
+        return len(record)
+
+    def _open_segment(self) -> None:
+        if self._active is not None:
+            self._active.close()
+        self._active_sequence = self._next_sequence
+        self._next_sequence += 1
+        self._active = open(self._segment_path(self._active_sequence), "ab")
+
+    def seal(self) -> None:
+        """
+        Close the segment being written so it can be replayed, the next append starts a new one.
+        """
+        with self._lock:
+            if self._active is not None:
+                self._active.close()
+                self._active = None
+                self._active_sequence = None
+
+    def sealed_segments(self) -> list[int]:
+        with self._lock:
+            return [sequence for sequence in self.segments() if sequence != self._active_sequence]
+
+    def read(self, sequence: int, offset: int = 0):
+        """
+        Yield (offset after the record, kind, CSV bytes) for every record of a segment starting at offset. A record cut
+        short at the end of the segment is what a crash in the middle of append leaves, nothing can come after it so
+        the read just ends there. A record that is all there but fails its checksum means the segment is damaged and
+        whatever follows it can't be trusted to be read right, that raises SpillLogCorrupt.
+        """
+        with open(self._segment_path(sequence), "rb") as f:
+            f.seek(offset)
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    if header:
+                        self._torn(sequence, offset)
+                    return
+                magic, length, crc = RECORD_HEADER.unpack(header)
+                if magic != MAGIC:
+                    metrics.count("spill.corrupt_records")
+                    raise SpillLogCorrupt(sequence, offset)
+                body = f.read(length)
+                if len(body) < length:
+                    self._torn(sequence, offset)
+                    return
+                if zlib.crc32(body) != crc:
+                    metrics.count("spill.corrupt_records")
+                    raise SpillLogCorrupt(sequence, offset)
+                offset += RECORD_HEADER.size + length
+                meta, _, csv = body.partition(b"\n")
+                yield offset, json.loads(meta)["kind"], csv
+
+    def _torn(self, sequence: int, offset: int) -> None:
+        metrics.count("spill.torn_records")
+        print(f"Spill segment {sequence} ends in a record cut short at byte {offset}, skipping it")
+
+    def set_aside(self, sequence: int) -> str:
+        """
+        Take a damaged segment out of the log without deleting it, the replay skips it from then on.
+        :return: the segment's new path
+        """
+        path = self._segment_path(sequence)
+        size = os.path.getsize(path)
+        os.replace(path, path + CORRUPT_SUFFIX)
+        with self._lock:
+            self._bytes -= size
+        metrics.gauge("spill.bytes", self._bytes)
+        return path + CORRUPT_SUFFIX
+
+    def remove(self, sequence: int) -> None:
+        path = self._segment_path(sequence)
+        size = os.path.getsize(path)
+        os.remove(path)
+        if self.checkpoint()[0] == sequence:
+            # the offset is into a segment that is gone, it mustn't be applied to whatever gets this number next
+            os.remove(os.path.join(self.directory, CHECKPOINT_FILE))
+        with self._lock:
+            self._bytes -= size
+        metrics.gauge("spill.bytes", self._bytes)
+
+    def checkpoint(self) -> tuple[int, int]:
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE)) as f:
+                sequence, offset = f.read().split()
+                return int(sequence), int(offset)
+        except (OSError, ValueError):
+            return -1, 0
+
+    def set_checkpoint(self, sequence: int, offset: int) -> None:
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        with open(path + ".tmp", "w") as f:
+            f.write(f"{sequence} {offset}")
+        os.replace(path + ".tmp", path)
+
+    def pending(self) -> bool:
+        return self._bytes > 0
+
+    def size(self) -> int:
+        return self._bytes
+
+    def close(self) -> None:
+        self.seal()
+
+
+def replay_batch(connector, kind: str, csv: bytes):
+    """
+    Write one spilled batch to Postgres. Appends go through COPY, the merges through their connector methods.
+    :return: whatever the connector method returned (the merged trip ids for trip and trip_metadata)
+    """
+    schema, table = SPILL_KINDS[kind]
+    if table is not None:
+        return connector.bulk_append(getattr(connector, table), csv, schema)
+    df = apply_schema(pd.read_csv(io.BytesIO(csv)), schema)
+    if kind == "trip":
+        return connector.append_to_trip(df)
+    if kind == "raw_final":
+        return connector.mark_raw_final(df)
+    return connector.upsert_to_trip(df)
+
+
+class SpillingWriter:
+    """
+    Sits between a subscriber and the PostgresConnector so a database outage doesn't lose batches or stall ingest.
+    write tries the normal write, and if that fails the batch goes to the spill log and the database is treated as down
+    for retry_seconds, during which batches go straight to the log without waiting on a connection timeout. Nothing is
+    written directly while there is anything in the log, so the stop event upserts are applied in the order they came
+    in: the first write after the database is back replays the log first, unless the background replay is already
+    doing that, in which case the batch is spilled behind it and the flush doesn't wait.
+
+    A background thread (start/stop) checks the database every interval seconds once it is down and replays the log
+    when it's back, oldest segment first. The checkpoint file records how far the replay got so a batch isn't written
+    twice if the replay is interrupted, and a segment is deleted once all of it is in. on_replayed(kind, result) is
+    called after every replayed batch, the part 3 subscriber uses it to refresh the summaries of the merged trips.
+
+    Only errors that mean the database can't be reached are spilled (see is_outage), anything else is raised like it
+    would be without the writer. With no log (SPILL_DIR empty) write just calls the normal write and failures are the
+    caller's problem as before.
+    """
+
+    def __init__(self, connector, log: SpillLog | None, retry_seconds: float = SPILL_RETRY_SECONDS,
+                 on_replayed=None):
+        self._connector = connector
+        self.log = log
+        self.retry_seconds = retry_seconds
+        self._on_replayed = on_replayed
+        self._down_until = 0.0
+        self._replay_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def from_env(connector, directory: str | None = SPILL_DIR, on_replayed=None):
+        return SpillingWriter(connector, SpillLog(directory) if directory else None, on_replayed=on_replayed)
+
+    def healthy(self) -> bool:
+        return time.monotonic() >= self._down_until
+
+    def mark_down(self) -> None:
+        self._down_until = time.monotonic() + self.retry_seconds
+        metrics.count("spill.database_down")
+
+    def write(self, kind: str, df: pd.DataFrame, direct):
+        """
+        :param kind: one of SPILL_KINDS
+        :param df: the batch
+        :param direct: the normal write, called with df
+        :return: what direct returned, or None if the batch was spilled
+        """
+        if self.log is None:
+            return direct(df)
+        if self.healthy() and (not self.log.pending() or self._drain()):
+            try:
+                return direct(df)
+            except Exception as e:
+                # a bad batch or a broken query would fail the same way on replay, only an outage is worth spilling
+                if not is_outage(e):
+                    raise
+                print(f"Writing {len(df)} {kind} rows failed, spilling them: {e}")
+                self.mark_down()
+        self.log.append(kind, df)
+        return None
+
+    def _drain(self) -> bool:
+        # replay unless a replay is already running
+        if not self._replay_lock.acquire(blocking=False):
+            return False
+        try:
+            self._replay()
+            return True
+        except Exception as e:
+            print(f"Replaying the spill log failed: {e}")
+            self.mark_down()
+            return False
+        finally:
+            self._replay_lock.release()
+
+    def _ping(self) -> bool:
+        try:
+            with self._connector.engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+            return True
+        except Exception:
+            return False
+
+    def replay(self) -> int:
+        """
+        Write everything in the log to Postgres.
+        :return: number of batches replayed
+        """
+        if self.log is None:
+            return 0
+        with self._replay_lock:
+            return self._replay()
+
+    def _replay(self) -> int:
+        replayed = 0
+        self.log.seal()
+        for sequence in self.log.sealed_segments():
+            checkpoint_sequence, checkpoint_offset = self.log.checkpoint()
+            offset = checkpoint_offset if checkpoint_sequence == sequence else 0
+            try:
+                with metrics.stage("spill.replay_segment"):
+                    for offset, kind, csv in self.log.read(sequence, offset):
+                        result = replay_batch(self._connector, kind, csv)
+                        self.log.set_checkpoint(sequence, offset)
+                        replayed += 1
+                        metrics.count("spill.replayed")
+                        if self._on_replayed is not None:
+                            self._on_replayed(kind, result)
+            except SpillLogCorrupt as e:
+                # everything before the damaged record is in, the rest of the segment is kept for whoever looks at it
+                path = self.log.set_aside(sequence)
+                print(f"{e}, the records after it were not replayed, the segment was moved to {path}")
+                continue
+            self.log.remove(sequence)
+        return replayed
+
+    def _run(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            if not self.log.pending():
+                continue
+            if not self.healthy() and not self._ping():
+                continue
+            try:
+                replayed = self.replay()
+                self._down_until = 0.0
+                if replayed:
+                    print(f"Replayed {replayed} spilled batches")
+            except Exception as e:
+                print(f"Replaying the spill log failed: {e}")
+                self.mark_down()
+
+    def start(self, interval: float = 5.0) -> None:
+        if self.log is None or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, args=(interval,), name="spill-replayer", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop the replay thread and try to drain what is left, whatever can't be written stays on disk for next time.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.log is None:
+            return
+        if self.log.pending() and (self.healthy() or self._ping()):
+            try:
+                self.replay()
+            except Exception as e:
+                print(f"Replaying the spill log failed, {self.log.size()} bytes are left in {self.log.directory}: {e}")
+        self.log.close()
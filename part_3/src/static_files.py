@@ -0,0 +1,216 @@
+import gzip
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+
+mimetypes.add_type("application/geo+json", ".geojson")
+
+DEFAULT_MAX_BYTES = 64 * 1024 ** 2
+# anything bigger is streamed from disk instead of being kept in memory
+MAX_CACHED_FILE_BYTES = 8 * 1024 ** 2
+# not worth compressing, the gzip header and trailer alone are 18 bytes
+MIN_COMPRESS_BYTES = 1024
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/geo+json", "application/javascript", "image/svg+xml")
+# html is checked every time so a change to index.html shows up on reload, everything else can be reused for a while
+STATIC_MAX_AGE = 300
+# preferred order when the client takes both, brotli is ~15-20% smaller than gzip on geojson
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+class StaticResponse(NamedTuple):
+    content_type: str
+    etag: str
+    cache_control: str
+    mtime: float
+    encoding: str | None
+    length: int
+    # the bytes if the variant is in memory, otherwise the path to stream it from
+    body: bytes | None
+    path: str | None
+
+
+def _brotli():
+    # brotli is optional, without it only gzip variants are served
+    try:
+        import brotli
+        return brotli
+    except ImportError:
+        return None
+
+
+def _accepted_encodings(accept_encoding: str) -> set:
+    accepted = set()
+    for part in accept_encoding.split(","):
+        name, _, parameters = part.strip().partition(";")
+        quality = parameters.strip()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        if name:
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+def _compressible(content_type: str) -> bool:
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def _compress(data: bytes, encoding: str, best: bool = False) -> bytes | None:
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=9 if best else 6, mtime=0)
+    brotli = _brotli()
+    if brotli is None:
+        return None
+    return brotli.compress(data, quality=11 if best else 5)
+
+
+class _Entry:
+    __slots__ = ("mtime", "size", "etag", "content_type", "variants", "bytes")
+
+    def __init__(self, mtime, size, etag, content_type):
+        self.mtime = mtime
+        self.size = size
+        self.etag = etag
+        self.content_type = content_type
+        # encoding (None for the file itself) -> bytes in memory or the path of a precompressed file on disk
+        self.variants = {}
+        self.bytes = 0
+
+
+class StaticFiles:
+    """
+    The static files of the map (index.html, data.geojson) for the threaded server. Files up to
+    MAX_CACHED_FILE_BYTES are read once and kept in memory together with their compressed variants, in a least
+    recently used cache of max_bytes, so a hot file costs a stat and a dict lookup per request. A precompressed file
+    next to the original (data.geojson.gz, data.geojson.br, see precompress) is used instead of compressing on the
+    fly, and for files too big to keep in memory it's the only way they get compressed. Entries are checked against
+    the file's mtime and size on every request, so editing a file takes effect right away.
+
+    ETags are the mtime and size of the file like nginx does it, with the encoding added for compressed variants.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES, max_file_bytes: int = MAX_CACHED_FILE_BYTES):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def get(self, path: str, accept_encoding: str = "") -> StaticResponse | None:
+        """
+        :param path: file system path of the file
+        :param accept_encoding: the Accept-Encoding header of the request
+        :return: the best variant of the file for the client, None if there is no such file
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if not os.path.isfile(path):
+            return None
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and (entry.mtime, entry.size) == (stat.st_mtime_ns, stat.st_size):
+                self._entries.move_to_end(path)
+                self.hits += 1
+            else:
+                entry = None
+                self.misses += 1
+        if entry is None:
+            entry = self._load(path, stat)
+
+        accepted = _accepted_encodings(accept_encoding)
+        for encoding, _ in ENCODINGS:
+            if encoding in accepted and encoding in entry.variants:
+                return self._response(entry, encoding)
+        return self._response(entry, None)
+
+    def _response(self, entry: _Entry, encoding: str | None) -> StaticResponse:
+        variant = entry.variants.get(encoding)
+        if isinstance(variant, bytes):
+            body, path, length = variant, None, len(variant)
+        else:
+            body, path, length = None, variant, os.path.getsize(variant)
+        etag = f'"{entry.etag}-{encoding}"' if encoding else f'"{entry.etag}"'
+        cache_control = "no-cache" if entry.content_type == "text/html" else f"public, max-age={STATIC_MAX_AGE}"
+        return StaticResponse(entry.content_type, etag, cache_control, entry.mtime / 1e9, encoding, length, body, path)
+
+    def _load(self, path: str, stat) -> _Entry:
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        entry = _Entry(stat.st_mtime_ns, stat.st_size, f"{stat.st_mtime_ns // 1000:x}-{stat.st_size:x}", content_type)
+        in_memory = stat.st_size <= self.max_file_bytes
+        data = None
+        if in_memory:
+            with open(path, "rb") as f:
+                data = f.read()
+            entry.variants[None] = data
+        else:
+            entry.variants[None] = path
+
+        if _compressible(content_type) and stat.st_size >= MIN_COMPRESS_BYTES:
+            for encoding, suffix in ENCODINGS:
+                precompressed = path + suffix
+                # a precompressed file only counts if it was made from this version of the file
+                if os.path.exists(precompressed) and os.path.getmtime(precompressed) >= stat.st_mtime:
+                    if in_memory:
+                        with open(precompressed, "rb") as f:
+                            entry.variants[encoding] = f.read()
+                    else:
+                        entry.variants[encoding] = precompressed
+                elif in_memory:
+                    compressed = _compress(data, encoding)
+                    if compressed is not None:
+                        entry.variants[encoding] = compressed
+
+        entry.bytes = sum(len(variant) for variant in entry.variants.values() if isinstance(variant, bytes))
+        with self._lock:
+            previous = self._entries.pop(path, None)
+            if previous is not None:
+                self._bytes -= previous.bytes
+            self._entries[path] = entry
+            self._bytes += entry.bytes
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.bytes
+        return entry
+
+    def size(self) -> int:
+        return self._bytes
+
+
+def precompress(paths: list[str], min_bytes: int = MIN_COMPRESS_BYTES) -> int:
+    """
+    Write .gz (and .br if brotli is installed) files next to each of paths that doesn't have an up to date one, at the
+    highest compression levels since it only happens once.
+    :return: number of files written
+    """
+    written = 0
+    for path in paths:
+        content_type = mimetypes.guess_type(path)[0] or ""
+        if not _compressible(content_type) or os.path.getsize(path) < min_bytes:
+            continue
+        data = None
+        for encoding, suffix in ENCODINGS:
+            target = path + suffix
+            if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(path):
+                continue
+            if data is None:
+                with open(path, "rb") as f:
+                    data = f.read()
+            compressed = _compress(data, encoding, best=True)
+            if compressed is None:
+                continue
+            # temporary name and rename, the server may be reading it
+            with open(target + ".tmp", "wb") as f:
+                f.write(compressed)
+            os.replace(target + ".tmp", target)
+            written += 1
+    return written
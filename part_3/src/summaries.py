@@ -0,0 +1,240 @@
+import os
+import pandas as pd
+from sqlalchemy import text
+from src.instrumentation import metrics
+
+TRIP_SUMMARY_TABLE = os.environ.get("TRIP_SUMMARY_TABLE", "trip_summary")
+ROUTE_DAY_SUMMARY_TABLE = os.environ.get("ROUTE_DAY_SUMMARY_TABLE", "route_day_summary")
+REFRESH_BATCH_TRIPS = 5000
+
+
+class SummaryMaterializer:
+    """
+    Keeps two small summary tables up to date so dashboards don't have to join the whole breadcrumb table with trip
+    every time:
+
+    - trip_summary, one row per trip: route/direction/service_key from the trip table, the service date (the day the
+      trip started), number of breadcrumbs, first and last timestamp, duration, distance, mean/median/95th
+      percentile/max speed and the bounding box
+    - route_day_summary, one row per route, service date and direction: trips, vehicles, breadcrumbs, distance,
+      duration, speed percentiles over all the breadcrumbs of the route that day and the bounding box
+
+    refresh only recomputes the trips it is given and the route days those trips were in before and after, so it costs
+    about the same whether the breadcrumb table has a day or a year in it. Call it with the trip ids of new
+    breadcrumbs after raw_to_processed, and with the trip ids of the stop event upserts, since those fill in the route
+    and direction that part 2 left NULL and move the trip into its route day. Trips without a route yet are in
+    trip_summary but not in route_day_summary.
+
+    Distance is the sum of speed times the time since the previous breadcrumb. That is close to the METERS the speeds
+    were calculated from but not exactly it, filter_implausible drops fixes and with SMOOTH_TRAJECTORY the speeds are
+    smoothed.
+
+    Refreshes can run at the same time (the breadcrumb and stop event paths in the ingest daemon), so a route day is
+    only rebuilt under a transaction level advisory lock on it. Without that two refreshes could both delete the old
+    row and both insert a new one, and the second insert would fail on the primary key.
+    """
+
+    def __init__(self, connector):
+        self._connector = connector
+        self.trip_summary_table = TRIP_SUMMARY_TABLE
+        self.route_day_summary_table = ROUTE_DAY_SUMMARY_TABLE
+        self._created = False
+
+    def create_tables(self) -> None:
+        with self._connector.engine.begin() as connection:
+            connection.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS {self.trip_summary_table} (
+                    trip_id integer PRIMARY KEY,
+                    vehicle_id integer,
+                    route_id text,
+                    direction text,
+                    service_key text,
+                    service_date date,
+                    points integer,
+                    first_tstamp timestamp,
+                    last_tstamp timestamp,
+                    duration_s real,
+                    distance_m real,
+                    mean_speed real,
+                    p50_speed real,
+                    p95_speed real,
+                    max_speed real,
+                    min_latitude real,
+                    min_longitude real,
+                    max_latitude real,
+                    max_longitude real,
+                    updated_at timestamp DEFAULT now()
+                )"""))
+            connection.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS {self.route_day_summary_table} (
+                    route_id text,
+                    service_date date,
+                    direction text,
+                    trips integer,
+                    vehicles integer,
+                    points integer,
+                    first_tstamp timestamp,
+                    last_tstamp timestamp,
+                    duration_s real,
+                    distance_m real,
+                    mean_speed real,
+                    p50_speed real,
+                    p95_speed real,
+                    min_latitude real,
+                    min_longitude real,
+                    max_latitude real,
+                    max_longitude real,
+                    updated_at timestamp DEFAULT now(),
+                    PRIMARY KEY (route_id, service_date, direction)
+                )"""))
+            connection.execute(text(
+                f"CREATE INDEX IF NOT EXISTS {self.trip_summary_table}_route_day_idx "
+                f"ON {self.trip_summary_table} (route_id, service_date)"))
+        self._created = True
+
+    def _mark_route_days(self, connection, trip_ids: list) -> None:
+        # direction is part of the key and can be NULL, so it's stored as '' in route_day_summary
+        connection.execute(text(f"""
+            INSERT INTO dirty_route_day
+            SELECT DISTINCT route_id, service_date, COALESCE(direction, '')
+            FROM {self.trip_summary_table}
+            WHERE trip_id = ANY(:trip_ids) AND route_id IS NOT NULL AND service_date IS NOT NULL
+        """), {"trip_ids": trip_ids})
+
+    def refresh(self, trip_ids) -> int:
+        """
+        Recompute the summaries of these trips and of the route days they are in, in one transaction.
+        :param trip_ids: iterable of trip ids, duplicates are fine
+        :return: number of trips refreshed
+        """
+        trip_ids = sorted({int(trip_id) for trip_id in trip_ids})
+        if not trip_ids:
+            return 0
+        if not self._created:
+            self.create_tables()
+
+        refreshed = 0
+        with metrics.stage("summaries.refresh"):
+            for start in range(0, len(trip_ids), REFRESH_BATCH_TRIPS):
+                refreshed += self._refresh_batch(trip_ids[start:start + REFRESH_BATCH_TRIPS])
+        metrics.count("summaries.trips", refreshed)
+        return refreshed
+
+    def _refresh_batch(self, trip_ids: list) -> int:
+        breadcrumb = self._connector.breadcrumb_table
+        trip = self._connector.trip_table
+        with self._connector.engine.begin() as connection:
+            connection.execute(text(
+                "CREATE TEMPORARY TABLE dirty_route_day (route_id text, service_date date, direction text) "
+                "ON COMMIT DROP"))
+            # the route days the trips were in before, in case the upsert moved a trip to another route
+            self._mark_route_days(connection, trip_ids)
+
+            # the trip table can have more than one row per trip (part 2 appends, part 3 upserts), the one with a
+            # route wins
+            result = connection.execute(text(f"""
+                INSERT INTO {self.trip_summary_table} (
+                    trip_id, vehicle_id, route_id, direction, service_key, service_date, points, first_tstamp,
+                    last_tstamp, duration_s, distance_m, mean_speed, p50_speed, p95_speed, max_speed, min_latitude,
+                    min_longitude, max_latitude, max_longitude, updated_at)
+                SELECT s.trip_id, t.vehicle_id, t.route_id, t.direction, t.service_key, s.first_tstamp::date, s.points,
+                       s.first_tstamp, s.last_tstamp, EXTRACT(EPOCH FROM s.last_tstamp - s.first_tstamp), s.distance_m,
+                       s.mean_speed, s.p50_speed, s.p95_speed, s.max_speed, s.min_latitude, s.min_longitude,
+                       s.max_latitude, s.max_longitude, now()
+                FROM (
+                    SELECT trip_id, count(*) AS points, min(tstamp) AS first_tstamp, max(tstamp) AS last_tstamp,
+                           COALESCE(sum(speed * step_s), 0) AS distance_m, avg(speed) AS mean_speed,
+                           percentile_cont(0.5) WITHIN GROUP (ORDER BY speed) AS p50_speed,
+                           percentile_cont(0.95) WITHIN GROUP (ORDER BY speed) AS p95_speed,
+                           max(speed) AS max_speed, min(latitude) AS min_latitude, min(longitude) AS min_longitude,
+                           max(latitude) AS max_latitude, max(longitude) AS max_longitude
+                    FROM (
+                        SELECT trip_id, tstamp, speed, latitude, longitude,
+                               EXTRACT(EPOCH FROM tstamp - lag(tstamp) OVER (PARTITION BY trip_id ORDER BY tstamp))
+                                   AS step_s
+                        FROM {breadcrumb}
+                        WHERE trip_id = ANY(:trip_ids)
+                    ) b
+                    GROUP BY trip_id
+                ) s
+                LEFT JOIN (
+                    SELECT DISTINCT ON (trip_id) trip_id, vehicle_id, route_id, direction, service_key
+                    FROM {trip}
+                    WHERE trip_id = ANY(:trip_ids)
+                    ORDER BY trip_id, route_id NULLS LAST
+                ) t ON t.trip_id = s.trip_id
+                ON CONFLICT (trip_id) DO UPDATE SET
+                    vehicle_id = EXCLUDED.vehicle_id, route_id = EXCLUDED.route_id, direction = EXCLUDED.direction,
+                    service_key = EXCLUDED.service_key, service_date = EXCLUDED.service_date, points = EXCLUDED.points,
+                    first_tstamp = EXCLUDED.first_tstamp, last_tstamp = EXCLUDED.last_tstamp,
+                    duration_s = EXCLUDED.duration_s, distance_m = EXCLUDED.distance_m,
+                    mean_speed = EXCLUDED.mean_speed, p50_speed = EXCLUDED.p50_speed, p95_speed = EXCLUDED.p95_speed,
+                    max_speed = EXCLUDED.max_speed, min_latitude = EXCLUDED.min_latitude,
+                    min_longitude = EXCLUDED.min_longitude, max_latitude = EXCLUDED.max_latitude,
+                    max_longitude = EXCLUDED.max_longitude, updated_at = EXCLUDED.updated_at
+            """), {"trip_ids": trip_ids})
+            refreshed = result.rowcount
+
+            # and the route days they are in now
+            self._mark_route_days(connection, trip_ids)
+            # held until commit. Taken in key order, so two refreshes that share route days can't deadlock. The DELETE
+            # and INSERT below are new statements, so after waiting they see what the other refresh committed
+            connection.execute(text("""
+                SELECT pg_advisory_xact_lock(key)
+                FROM (SELECT DISTINCT hashtext(route_id || '|' || service_date || '|' || direction) AS key
+                      FROM dirty_route_day) d
+                ORDER BY key
+            """))
+            connection.execute(text(f"""
+                DELETE FROM {self.route_day_summary_table} r
+                USING dirty_route_day d
+                WHERE r.route_id = d.route_id AND r.service_date = d.service_date AND r.direction = d.direction
+            """))
+            connection.execute(text(f"""
+                INSERT INTO {self.route_day_summary_table} (
+                    route_id, service_date, direction, trips, vehicles, points, first_tstamp, last_tstamp, duration_s,
+                    distance_m, mean_speed, p50_speed, p95_speed, min_latitude, min_longitude, max_latitude,
+                    max_longitude, updated_at)
+                WITH trips AS (
+                    SELECT ts.*, COALESCE(ts.direction, '') AS direction_key
+                    FROM {self.trip_summary_table} ts
+                    JOIN (SELECT DISTINCT * FROM dirty_route_day) d
+                      ON ts.route_id = d.route_id AND ts.service_date = d.service_date
+                     AND COALESCE(ts.direction, '') = d.direction
+                ), speeds AS (
+                    SELECT t.route_id, t.service_date, t.direction_key, avg(b.speed) AS mean_speed,
+                           percentile_cont(0.5) WITHIN GROUP (ORDER BY b.speed) AS p50_speed,
+                           percentile_cont(0.95) WITHIN GROUP (ORDER BY b.speed) AS p95_speed
+                    FROM trips t
+                    JOIN {breadcrumb} b ON b.trip_id = t.trip_id
+                    GROUP BY t.route_id, t.service_date, t.direction_key
+                )
+                SELECT t.route_id, t.service_date, t.direction_key, count(*), count(DISTINCT t.vehicle_id),
+                       sum(t.points), min(t.first_tstamp), max(t.last_tstamp), sum(t.duration_s), sum(t.distance_m),
+                       s.mean_speed, s.p50_speed, s.p95_speed, min(t.min_latitude), min(t.min_longitude),
+                       max(t.max_latitude), max(t.max_longitude), now()
+                FROM trips t
+                JOIN speeds s USING (route_id, service_date, direction_key)
+                GROUP BY t.route_id, t.service_date, t.direction_key, s.mean_speed, s.p50_speed, s.p95_speed
+            """))
+        return refreshed
+
+    def refresh_all(self) -> int:
+        """
+        Rebuild the summaries of every trip in the breadcrumb table, for the first run or after a backfill.
+        :return: number of trips refreshed
+        """
+        with self._connector.engine.connect() as connection:
+            trip_ids = connection.execute(text(
+                f"SELECT DISTINCT trip_id FROM {self._connector.breadcrumb_table}")).scalars().all()
+        return self.refresh(trip_ids)
+
+    def get_trip_summary(self, service_date=None) -> pd.DataFrame:
+        where = " WHERE service_date = :service_date" if service_date is not None else ""
+        return pd.read_sql(text(f"SELECT * FROM {self.trip_summary_table}{where}"), self._connector.engine,
+                           params={"service_date": service_date})
+
+    def get_route_day_summary(self, service_date=None) -> pd.DataFrame:
+        where = " WHERE service_date = :service_date" if service_date is not None else ""
+        return pd.read_sql(text(f"SELECT * FROM {self.route_day_summary_table}{where}"), self._connector.engine,
+                           params={"service_date": service_date})
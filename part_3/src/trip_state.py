@@ -0,0 +1,187 @@
+import heapq
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from src.breadcrumb_processor import BreadcrumbRecord, MAX_SPEED, SERVICE_AREA
+
+MAX_TRIPS = int(os.environ.get("TRIP_STATE_MAX_TRIPS", "20000"))
+# a trip nobody has heard from in this long is done (or the bus went out of service), its state is dropped
+TRIP_STATE_TTL_SECONDS = float(os.environ.get("TRIP_STATE_TTL_SECONDS", "1800"))
+# breadcrumbs come every 5 seconds, so this holds back about three of them to put late ones in order
+REORDER_WINDOW_SECONDS = float(os.environ.get("REORDER_WINDOW_SECONDS", "15"))
+# don't walk the whole map for expired trips on every message
+EXPIRE_EVERY = 1000
+# timestamps of the last fixes that went out, so a redelivery that comes after its fix went out is still caught. Only
+# looked at for fixes older than the last one, which are rare
+RECENT_FIXES = 64
+
+
+# the rows that come out are plain tuples in the breadcrumb table layout, so a flush is one pd.DataFrame.from_records
+BREADCRUMB_ROW_COLUMNS = ["tstamp", "latitude", "longitude", "speed", "trip_id"]
+
+
+class _TripState:
+    __slots__ = ("last_meters", "last_timestamp", "newest", "pending", "seen", "recent", "touched")
+
+    def __init__(self):
+        # the last fix that was emitted, speed is measured from here
+        self.last_meters = None
+        self.last_timestamp = None
+        # newest timestamp we've had for the trip, everything older than newest - window can go out
+        self.newest = None
+        # heap of (timestamp, meters, longitude, latitude) waiting for the window to pass
+        self.pending = []
+        # timestamps in pending, to drop redelivered messages
+        self.seen = set()
+        self.recent = deque(maxlen=RECENT_FIXES)
+        self.touched = 0.0
+
+
+class TripStateStore:
+    """
+    Computes speed as the breadcrumbs come in instead of waiting for raw_to_processed to read the whole raw table back.
+    The only thing speed needs is the previous fix of the same trip, so we keep the last fix per (EVENT_NO_TRIP,
+    VEHICLE_ID) in a map and that is the whole state.
+
+    Pub/Sub doesn't keep the order, so every trip has a small reorder buffer: a fix is held until we've seen a fix of
+    the same trip more than reorder_window seconds newer, and then they go out in timestamp order. A fix that shows up
+    after a newer one has already gone out is late; it is still written, but with no speed, like the first fix of a
+    trip. A fix with the same timestamp as one we already have is a redelivery and is dropped.
+
+    The map is bounded two ways. A trip that hasn't had a message in ttl_seconds is expired, and if there are still
+    more than max_trips the least recently updated ones are evicted. Either way whatever is still in its buffer is
+    released first, so nothing is lost, the next fix of an evicted trip just starts over without a speed.
+
+    The point checks of filter_implausible are done here too: fixes outside the service area are dropped before they
+    become the previous fix, and a step faster than MAX_SPEED is dropped and speed is measured from the fix before it.
+    The GPS jump check needs the fix after as well, so it stays in raw_to_processed.
+
+    This is safe to call from the Pub/Sub callback threads. With several worker processes each one only sees part of
+    a trip, so the speeds are over longer steps, but they are still right.
+    """
+
+    def __init__(self, max_trips: int = MAX_TRIPS, ttl_seconds: float = TRIP_STATE_TTL_SECONDS,
+                 reorder_window: float = REORDER_WINDOW_SECONDS, clock=time.monotonic):
+        self.max_trips = max_trips
+        self.ttl_seconds = ttl_seconds
+        self.reorder_window = reorder_window
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._trips = OrderedDict()
+        self._since_expire = 0
+        self.stats = {"fixes": 0, "emitted": 0, "late": 0, "duplicates": 0, "out_of_area": 0, "too_fast": 0,
+                      "expired": 0, "evicted": 0}
+
+    def add(self, record: BreadcrumbRecord) -> tuple[list, list]:
+        """
+        :param record: a breadcrumb from process_individual_fast
+        :return: the breadcrumb rows that are ready (see BREADCRUMB_ROW_COLUMNS), and (trip_id, vehicle_id) of trips
+        that weren't in the store yet, for the trip table
+        """
+        rows = []
+        new_trips = []
+        with self._lock:
+            self.stats["fixes"] += 1
+            if not (SERVICE_AREA["south"] <= record.GPS_LATITUDE <= SERVICE_AREA["north"]
+                    and SERVICE_AREA["west"] <= record.GPS_LONGITUDE <= SERVICE_AREA["east"]):
+                self.stats["out_of_area"] += 1
+                return rows, new_trips
+
+            key = (record.EVENT_NO_TRIP, record.VEHICLE_ID)
+            now = self._clock()
+            state = self._trips.get(key)
+            if state is None:
+                state = self._trips[key] = _TripState()
+                new_trips.append(key)
+            else:
+                self._trips.move_to_end(key)
+            state.touched = now
+
+            timestamp = record.timestamp
+            if timestamp in state.seen or timestamp == state.last_timestamp:
+                self.stats["duplicates"] += 1
+            elif state.last_timestamp is not None and timestamp < state.last_timestamp and timestamp in state.recent:
+                self.stats["duplicates"] += 1
+            elif state.last_timestamp is not None and timestamp < state.last_timestamp:
+                # too late to put in order, the fixes around it already have their speed
+                self.stats["late"] += 1
+                state.recent.append(timestamp)
+                rows.append((timestamp, record.GPS_LATITUDE, record.GPS_LONGITUDE, None, record.EVENT_NO_TRIP))
+            else:
+                heapq.heappush(state.pending, (timestamp, record.METERS, record.GPS_LONGITUDE, record.GPS_LATITUDE))
+                state.seen.add(timestamp)
+                if state.newest is None or timestamp > state.newest:
+                    state.newest = timestamp
+                self._release(key, state, rows, flush=False)
+
+            self._since_expire += 1
+            if self._since_expire >= EXPIRE_EVERY or len(self._trips) > self.max_trips:
+                self._expire(now, rows)
+            self.stats["emitted"] += len(rows)
+        return rows, new_trips
+
+    def _release(self, key, state: _TripState, rows: list, flush: bool) -> None:
+        trip_id = key[0]
+        while state.pending:
+            timestamp, meters, longitude, latitude = state.pending[0]
+            if not flush and (state.newest - timestamp).total_seconds() <= self.reorder_window:
+                break
+            heapq.heappop(state.pending)
+            state.seen.discard(timestamp)
+
+            speed = None
+            if state.last_timestamp is not None:
+                speed = (meters - state.last_meters) / (timestamp - state.last_timestamp).total_seconds()
+                if speed > MAX_SPEED:
+                    self.stats["too_fast"] += 1
+                    continue
+            rows.append((timestamp, latitude, longitude, speed, trip_id))
+            state.recent.append(timestamp)
+            state.last_meters = meters
+            state.last_timestamp = timestamp
+
+    def _expire(self, now: float, rows: list) -> None:
+        self._since_expire = 0
+        # the map is in least recently updated order, so the expired trips are all at the front
+        while self._trips:
+            key, state = next(iter(self._trips.items()))
+            if now - state.touched > self.ttl_seconds:
+                self.stats["expired"] += 1
+            elif len(self._trips) > self.max_trips:
+                self.stats["evicted"] += 1
+            else:
+                break
+            self._trips.popitem(last=False)
+            self._release(key, state, rows, flush=True)
+
+    def expire(self) -> list:
+        """
+        Drop the trips that have been quiet for longer than the TTL, for when no messages are coming in to do it.
+        :return: the rows that were still buffered for those trips
+        """
+        rows = []
+        with self._lock:
+            self._expire(self._clock(), rows)
+            self.stats["emitted"] += len(rows)
+        return rows
+
+    def flush(self) -> list:
+        """
+        Release everything that is waiting in a reorder buffer, e.g. on shutdown. The last fix of every trip is kept
+        so speeds carry on if more messages come.
+        :return: the buffered rows
+        """
+        rows = []
+        with self._lock:
+            for key, state in self._trips.items():
+                self._release(key, state, rows, flush=True)
+            self.stats["emitted"] += len(rows)
+        return rows
+
+    def __len__(self) -> int:
+        return len(self._trips)
+
+    def buffered(self) -> int:
+        with self._lock:
+            return sum(len(state.pending) for state in self._trips.values())
@@ -0,0 +1,379 @@
+import hashlib
+import math
+import os
+import struct
+import threading
+import uuid
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from src.spatial_index import GridIndex
+
+LAYER_NAME = "speeds"
+EXTENT = 4096
+# same as the minzoom of the speeds-point layer in index.html, nothing below it is ever drawn
+MIN_ZOOM = 10
+# mapbox overzooms the z16 tiles past this, a z16 tile is about 600 m across
+MAX_ZOOM = 16
+# below this zoom a tile holds one feature per grid cell with the mean/min speed and count of the points in it, from
+# here up the points themselves (thinned out by GridIndex.query to about one per few pixels)
+AGGREGATE_BELOW_ZOOM = 14
+CELLS_PER_TILE = 64
+MAX_POINTS_PER_TILE = 10000
+DEFAULT_MAX_BYTES = 512 * 1024 ** 2
+
+
+def tile_bounds(z: int, x: int, y: int) -> tuple:
+    """
+    :return: west, south, east, north of a web mercator tile in degrees
+    """
+    n = 2 ** z
+    west = x / n * 360 - 180
+    east = (x + 1) / n * 360 - 180
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return west, south, east, north
+
+
+def _tile_coordinates(longitude, latitude, z: int):
+    """
+    :return: fractional tile x and y of every point at zoom z, y grows to the south
+    """
+    n = 2 ** z
+    longitude = np.asarray(longitude, dtype=np.float64)
+    latitude = np.radians(np.asarray(latitude, dtype=np.float64))
+    tile_x = (longitude + 180) / 360 * n
+    tile_y = (1 - np.log(np.tan(latitude) + 1 / np.cos(latitude)) / np.pi) / 2 * n
+    return tile_x, tile_y
+
+
+def tiles_for_points(longitude, latitude, z: int) -> np.ndarray:
+    """
+    :return: (k, 2) array of the distinct x, y of the tiles at zoom z that contain the points
+    """
+    tile_x, tile_y = _tile_coordinates(longitude, latitude, z)
+    n = 2 ** z
+    tiles = np.stack([np.clip(np.floor(tile_x), 0, n - 1), np.clip(np.floor(tile_y), 0, n - 1)], axis=1)
+    return np.unique(tiles.astype(np.int64), axis=0)
+
+
+# --- Mapbox vector tile encoding. The format is a small protobuf (github.com/mapbox/vector-tile-spec), for a single
+# layer of points it's short enough to write by hand instead of pulling in protobuf and generated code.
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _zigzag(value: int) -> int:
+    return (value << 1) ^ (value >> 31)
+
+
+def _message(field: int, payload: bytes) -> bytes:
+    return _varint(field << 3 | 2) + _varint(len(payload)) + payload
+
+
+def _packed(field: int, values) -> bytes:
+    return _message(field, b"".join(_varint(value) for value in values))
+
+
+def _encode_value(value) -> bytes:
+    # ints are counts and go in uint_value, everything else is a double so the popup doesn't show float32 noise
+    if isinstance(value, (int, np.integer)):
+        return _varint(5 << 3) + _varint(int(value))
+    return _varint(3 << 3 | 1) + struct.pack("<d", float(value))
+
+
+_POINT = b"\x18\x01"  # type = POINT
+_MOVE_TO_ONE = 1 | 1 << 3
+
+
+def encode_tile(features, layer_name: str = LAYER_NAME, extent: int = EXTENT) -> bytes:
+    """
+    Encode point features as a one layer vector tile.
+    :param features: iterable of (x, y, properties) with x, y in tile coordinates (0 to extent, y down) and properties a
+    dict of name to int or float, None values are left out
+    :return: the tile, b"" if there are no features (an empty tile is valid)
+    """
+    keys = {}
+    values = {}
+    encoded = []
+    for x, y, properties in features:
+        tags = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+            tags.append(keys.setdefault(key, len(keys)))
+            # keyed by type too, otherwise a count of 1 and a speed of 1.0 would share a value
+            tags.append(values.setdefault((type(value), value), len(values)))
+        geometry = _packed(4, (_MOVE_TO_ONE, _zigzag(int(x)), _zigzag(int(y))))
+        encoded.append(_message(2, _packed(2, tags) + _POINT + geometry))
+    if not encoded:
+        return b""
+
+    layer = [_varint(15 << 3) + _varint(2), _message(1, layer_name.encode("utf-8"))]
+    layer.extend(encoded)
+    layer.extend(_message(3, key.encode("utf-8")) for key in keys)
+    layer.extend(_message(4, _encode_value(value)) for _, value in values)
+    layer.append(_varint(5 << 3) + _varint(extent))
+    return _message(3, b"".join(layer))
+
+
+def _aggregate(points: dict, tile_x: np.ndarray, tile_y: np.ndarray) -> list:
+    """
+    One feature per occupied cell of a CELLS_PER_TILE x CELLS_PER_TILE grid, placed at the cell center.
+    """
+    cell_size = EXTENT // CELLS_PER_TILE
+    column = np.clip((tile_x // cell_size).astype(np.int64), 0, CELLS_PER_TILE - 1)
+    row = np.clip((tile_y // cell_size).astype(np.int64), 0, CELLS_PER_TILE - 1)
+    cell = row * CELLS_PER_TILE + column
+    cells = CELLS_PER_TILE * CELLS_PER_TILE
+
+    count = np.bincount(cell, minlength=cells)
+    # the first fix of every trip has no speed, it counts as a point but not towards the speeds
+    has_speed = ~np.isnan(points["speed"])
+    speeds = points["speed"][has_speed].astype(np.float64)
+    speed_count = np.bincount(cell[has_speed], minlength=cells)
+    speed_sum = np.bincount(cell[has_speed], weights=speeds, minlength=cells)
+    speed_min = np.full(cells, np.inf)
+    np.minimum.at(speed_min, cell[has_speed], speeds)
+
+    features = []
+    for occupied in np.flatnonzero(count).tolist():
+        center_x = (occupied % CELLS_PER_TILE) * cell_size + cell_size // 2
+        center_y = (occupied // CELLS_PER_TILE) * cell_size + cell_size // 2
+        properties = {"count": int(count[occupied]), "speed": None, "min_speed": None}
+        if speed_count[occupied]:
+            properties["speed"] = round(float(speed_sum[occupied] / speed_count[occupied]), 1)
+            properties["min_speed"] = round(float(speed_min[occupied]), 1)
+        features.append((center_x, center_y, properties))
+    return features
+
+
+def render_tile(index: GridIndex, z: int, x: int, y: int) -> bytes:
+    """
+    :return: the speeds layer of tile z/x/y as a vector tile
+    """
+    west, south, east, north = tile_bounds(z, x, y)
+    if z < AGGREGATE_BELOW_ZOOM:
+        points = index.query(west, south, east, north)
+    else:
+        points = index.query(west, south, east, north, zoom=z, limit=MAX_POINTS_PER_TILE)
+    if not len(points["latitude"]):
+        return b""
+
+    fractional_x, fractional_y = _tile_coordinates(points["longitude"], points["latitude"], z)
+    tile_x = np.clip((fractional_x - x) * EXTENT, 0, EXTENT)
+    tile_y = np.clip((fractional_y - y) * EXTENT, 0, EXTENT)
+    if z < AGGREGATE_BELOW_ZOOM:
+        return encode_tile(_aggregate(points, tile_x, tile_y))
+
+    speeds = [None if speed != speed else round(speed, 1) for speed in points["speed"].tolist()]
+    return encode_tile((px, py, {"speed": speed})
+                       for px, py, speed in zip(tile_x.astype(np.int64).tolist(), tile_y.astype(np.int64).tolist(),
+                                                speeds))
+
+
+class TileCache:
+    """
+    Rendered tiles on disk, one file per tile, with a least recently used limit on the total size. The LRU order is
+    kept in memory and rebuilt from the file modification times on startup, so the directory survives a restart. The
+    ETag of a tile is a hash of its bytes.
+
+    version identifies the data the tiles were rendered from. If the directory was written for a different version
+    everything in it is thrown away on startup, a tile rendered from yesterday's table shouldn't be served for today's.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES, version=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # path -> (size, etag or None until the tile is read)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+        version_path = os.path.join(cache_dir, "VERSION")
+        stored = None
+        if os.path.exists(version_path):
+            with open(version_path, encoding="utf-8") as f:
+                stored = f.read()
+        files = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith(".mvt")]
+        if stored != repr(version):
+            for path in files:
+                self._remove(path)
+            with open(version_path, "w", encoding="utf-8") as f:
+                f.write(repr(version))
+            files = []
+        for mtime, size, path in sorted((os.path.getmtime(path), os.path.getsize(path), path) for path in files):
+            self._entries[path] = (size, None)
+            self._bytes += size
+
+    def _path(self, z: int, x: int, y: int) -> str:
+        return os.path.join(self.cache_dir, f"{z}-{x}-{y}.mvt")
+
+    def get(self, z: int, x: int, y: int):
+        """
+        :return: (tile bytes, etag), or None if the tile isn't cached
+        """
+        path = self._path(z, x, y)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(path)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            # invalidated while we were reading
+            with self._lock:
+                self.misses += 1
+            return None
+        etag = entry[1] or hashlib.sha1(data).hexdigest()[:16]
+        with self._lock:
+            if path in self._entries:
+                self._entries[path] = (len(data), etag)
+            self.hits += 1
+        os.utime(path)
+        return data, etag
+
+    def put(self, z: int, x: int, y: int, data: bytes) -> str:
+        """
+        :return: the etag of the tile
+        """
+        path = self._path(z, x, y)
+        etag = hashlib.sha1(data).hexdigest()[:16]
+        # write to a temporary name and rename so a reader never gets half a tile
+        temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(data)
+        os.replace(temporary, path)
+
+        evicted = []
+        with self._lock:
+            previous = self._entries.pop(path, None)
+            if previous is not None:
+                self._bytes -= previous[0]
+            self._entries[path] = (len(data), etag)
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                oldest, (size, _) = self._entries.popitem(last=False)
+                self._bytes -= size
+                evicted.append(oldest)
+        for oldest in evicted:
+            self._remove(oldest)
+        return etag
+
+    def invalidate(self, z: int, x: int, y: int) -> bool:
+        """
+        :return: True if the tile was cached and has been dropped
+        """
+        path = self._path(z, x, y)
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is None:
+                return False
+            self._bytes -= entry[0]
+        self._remove(path)
+        return True
+
+    def _remove(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def size(self) -> int:
+        return self._bytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SpeedTiles:
+    """
+    The speeds layer as vector tiles, rendered from a GridIndex and kept in a TileCache. add_breadcrumbs puts new points
+    into the index and only throws away the cached tiles the new points fall in, at every zoom, and renders them again
+    right away up to precompute_zoom so the low zoom tiles that cover the whole city are never slow to load.
+    """
+
+    def __init__(self, index: GridIndex, cache: TileCache, min_zoom: int = MIN_ZOOM, max_zoom: int = MAX_ZOOM,
+                 precompute_zoom: int = AGGREGATE_BELOW_ZOOM - 1):
+        self.index = index
+        self.cache = cache
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.precompute_zoom = precompute_zoom
+        self.tiles_rendered = 0
+        # bumped by every add_breadcrumbs, a tile rendered from the index before an update isn't stored after it
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def tile(self, z: int, x: int, y: int):
+        """
+        :return: (tile bytes, etag), or None if z/x/y isn't a tile this layer has
+        """
+        if not self.min_zoom <= z <= self.max_zoom or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            return None
+        cached = self.cache.get(z, x, y)
+        if cached is not None:
+            return cached
+        with self._lock:
+            generation = self._generation
+        data = render_tile(self.index, z, x, y)
+        with self._lock:
+            self.tiles_rendered += 1
+            current = generation == self._generation
+        if not current:
+            return data, hashlib.sha1(data).hexdigest()[:16]
+        return data, self.cache.put(z, x, y, data)
+
+    def precompute(self, longitude=None, latitude=None) -> int:
+        """
+        Render every tile from min_zoom to precompute_zoom that has points in it, or only the ones that have these
+        points in them.
+        :return: number of tiles rendered
+        """
+        if longitude is None:
+            everything = self.index.query(-180, -90, 180, 90)
+            longitude, latitude = everything["longitude"], everything["latitude"]
+        rendered = 0
+        for z in range(self.min_zoom, self.precompute_zoom + 1):
+            for x, y in tiles_for_points(longitude, latitude, z).tolist():
+                self.tile(z, x, y)
+                rendered += 1
+        return rendered
+
+    def add_breadcrumbs(self, df: pd.DataFrame) -> int:
+        """
+        :param df: new breadcrumb table rows
+        :return: number of cached tiles that were invalidated
+        """
+        df = df.dropna(subset=["latitude", "longitude"])
+        if df.empty:
+            return 0
+        self.index.extend(df)
+        with self._lock:
+            self._generation += 1
+
+        longitude = df["longitude"].to_numpy(dtype=np.float64)
+        latitude = df["latitude"].to_numpy(dtype=np.float64)
+        invalidated = 0
+        for z in range(self.min_zoom, self.max_zoom + 1):
+            for x, y in tiles_for_points(longitude, latitude, z).tolist():
+                if self.cache.invalidate(z, x, y):
+                    invalidated += 1
+        self.precompute(longitude, latitude)
+        return invalidated
+
+    def stats(self) -> dict:
+        return {"points": len(self.index), "cached_tiles": len(self.cache), "cached_bytes": self.cache.size(),
+                "hits": self.cache.hits, "misses": self.cache.misses, "rendered": self.tiles_rendered}
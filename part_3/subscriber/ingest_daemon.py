@@ -0,0 +1,227 @@
+#!/home/sarah/sub_env/bin/python
+"""
+Both subscriptions in one process, see IngestDaemon. Run it from the part_3 directory as a module so the subscriber
+package is importable:
+
+    PYTHONPATH=.:../part_1 python -m subscriber.ingest_daemon
+"""
+import os
+import signal
+import threading
+import time
+from logger import Discord_logger
+from src.postgres_connector import PostgresConnector
+from src.instrumentation import metrics
+from src.message_source import MessageSource, PubSubMessageSource
+from src.spill_log import SPILL_DIR, SpillingWriter
+from subscriber import part3_subscriber, subscriber as breadcrumb_subscriber
+
+project_id = os.environ.get("PROJECT_ID")
+# the streams this daemon consumes, names from STREAMS below
+INGEST_STREAMS = [name.strip() for name in os.environ.get("INGEST_STREAMS", "breadcrumbs,stop_events").split(",")
+                  if name.strip()]
+# how often raw_to_processed runs while the daemon is up, it also runs once on the way down. 0 only runs it then
+RAW_TO_PROCESSED_SECONDS = float(os.environ.get("RAW_TO_PROCESSED_SECONDS", "3600"))
+# the scheduled runs leave a trip alone until its newest fix is this much older than the newest fix overall, the one on
+# shutdown takes everything
+TRIP_QUIET_SECONDS = float(os.environ.get("TRIP_QUIET_SECONDS", "1800"))
+POLL_SECONDS = 1
+
+
+def _breadcrumb_handler(daemon):
+    return breadcrumb_subscriber.Subscriber(daemon.logger, None, daemon.connector, writer=daemon.writer)
+
+
+def _stop_event_handler(daemon):
+    return part3_subscriber.Subscriber(daemon.connector, writer=daemon.writer)
+
+
+# stream name -> (subscription id, handler factory). A handler is one of the subscriber classes, the daemon uses their
+# on_message, flush_if_due, clean_up and stats. Adding a stream is adding a line here
+STREAMS = {
+    "breadcrumbs": (breadcrumb_subscriber.subscriber_id, _breadcrumb_handler),
+    "stop_events": (part3_subscriber.subscriber_id, _stop_event_handler),
+}
+
+
+class _DaemonLogger(Discord_logger):
+    """
+    Discord_logger keeps every message it was ever given and sends all of them on every send, which is fine for a job
+    that sends a couple of times but not for a daemon that sends after every raw_to_processed. This one starts over.
+    The streams and raw_to_processed log from their own threads, so the lists are swapped out under a lock and a
+    message that comes in while a send is going out goes with the next one.
+    """
+
+    def __init__(self, webhook_url):
+        super().__init__(webhook_url)
+        self._lock = threading.Lock()
+
+    def error(self, message):
+        with self._lock:
+            self._errors.append(message)
+
+    def info(self, message):
+        with self._lock:
+            self._info.append(message)
+
+    def send(self):
+        with self._lock:
+            errors, info = self._errors, self._info
+            self._errors, self._info = [], []
+        # Discord_logger.send posts whatever is in the lists, so it gets a logger of its own with just these messages
+        batch = Discord_logger(self.webhook_url)
+        batch._errors, batch._info = errors, info
+        batch.send()
+
+
+class IngestDaemon:
+    """
+    One long running process for all of the subscriptions, instead of a breadcrumb subscriber and a stop event
+    subscriber that each have their own PostgresConnector (and engine, and connections), their own spill log and their
+    own copy of pandas in memory. The streams are handled by the same subscriber classes as before, but they share:
+
+    - one PostgresConnector, so one connection pool for everything
+    - one SpillingWriter, so one spill log and one replay thread. Replayed stop event upserts go to the stop event
+      handler to refresh the summaries, like its own writer did
+    - one Pub/Sub client (one gRPC channel) for all the streaming pulls
+    - the metrics, which are per process anyway, so every stream shows up in one report
+
+    raw_to_processed runs in process every RAW_TO_PROCESSED_SECONDS on a thread of its own, ingest carries on while it
+    runs, and once more on shutdown. The scheduled runs only take the trips that have gone quiet for
+    TRIP_QUIET_SECONDS, so a trip that is still going isn't split in two with the first breadcrumb of the second half
+    missing its speed. The run on shutdown takes everything. With ONLINE_SPEED on the breadcrumbs are already in the
+    final table and it only runs once on start, for the raw rows a crash left behind (see Subscriber.catch_up).
+
+    The daemon runs until SIGINT/SIGTERM, or until every stream's pull has ended. A pull that ends with an error is
+    logged and dropped, the daemon doesn't try to resubscribe, whatever runs it (systemd) should restart it.
+    """
+
+    def __init__(self, logger: Discord_logger, streams: list[str] = None, connector: PostgresConnector = None,
+                 sources: dict[str, MessageSource] = None):
+        """
+        :param logger: shared by the daemon and the breadcrumb handler
+        :param streams: names from STREAMS, defaults to INGEST_STREAMS
+        :param connector: the shared PostgresConnector
+        :param sources: stream name -> MessageSource to use instead of the Pub/Sub subscription, for local replays
+        """
+        streams = streams if streams is not None else INGEST_STREAMS
+        unknown = [name for name in streams if name not in STREAMS]
+        if unknown:
+            raise ValueError(f"Unknown streams {unknown}, pick from {list(STREAMS)}")
+        self.logger = logger
+        self.connector = connector if connector is not None else PostgresConnector()
+        self.writer = SpillingWriter.from_env(self.connector, SPILL_DIR, on_replayed=self._on_replayed)
+        self.handlers = {name: STREAMS[name][1](self) for name in streams}
+        self._sources = dict(sources or {})
+        self._stop = threading.Event()
+        self._raw_to_processed_thread = None
+
+    def _on_replayed(self, kind, result):
+        stop_events = self.handlers.get("stop_events")
+        if stop_events is not None:
+            stop_events.refresh_summaries(kind, result)
+
+    def stop(self, signum=None, frame=None) -> None:
+        self._stop.set()
+
+    def _raw_to_processed_handler(self):
+        handler = self.handlers.get("breadcrumbs")
+        if handler is None or handler.online_speed:
+            return None
+        return handler
+
+    def _start_raw_to_processed(self) -> None:
+        handler = self._raw_to_processed_handler()
+        if handler is None:
+            return
+        if self._raw_to_processed_thread is not None and self._raw_to_processed_thread.is_alive():
+            self.logger.info("raw_to_processed is still running from last time, skipping this one")
+            return
+        self._raw_to_processed_thread = threading.Thread(target=handler.raw_to_processed, args=(TRIP_QUIET_SECONDS,),
+                                                         name="raw-to-processed")
+        self._raw_to_processed_thread.start()
+
+    def run(self) -> dict:
+        """
+        Pull from every stream until stopped, then flush everything and run raw_to_processed one last time.
+        :return: stream name -> that handler's stats
+        """
+        breadcrumbs = self.handlers.get("breadcrumbs")
+        if breadcrumbs is not None:
+            breadcrumbs.catch_up()
+        client = None
+        sources = {}
+        for name in self.handlers:
+            source = self._sources.get(name)
+            if source is None:
+                if client is None:
+                    from google.cloud import pubsub_v1
+                    client = pubsub_v1.SubscriberClient()
+                source = PubSubMessageSource(project_id, STREAMS[name][0], client=client)
+            sources[name] = source
+
+        futures = {name: sources[name].subscribe(handler.on_message) for name, handler in self.handlers.items()}
+        print(f"Listening for messages on {', '.join(futures)}..\n")
+        next_run = time.monotonic() + RAW_TO_PROCESSED_SECONDS if RAW_TO_PROCESSED_SECONDS > 0 else None
+        try:
+            while futures and not self._stop.wait(POLL_SECONDS):
+                for name, future in list(futures.items()):
+                    if not future.done():
+                        continue
+                    try:
+                        future.result(timeout=0)
+                        self.logger.info(f"The {name} pull ended")
+                    except Exception as e:
+                        self.logger.error(f"The {name} pull failed: {str(e)}")
+                    del futures[name]
+                for handler in self.handlers.values():
+                    handler.flush_if_due()
+                if next_run is not None and time.monotonic() >= next_run:
+                    self._start_raw_to_processed()
+                    next_run = time.monotonic() + RAW_TO_PROCESSED_SECONDS
+        finally:
+            for future in futures.values():
+                future.cancel()
+            for source in sources.values():
+                source.close()
+            if client is not None:
+                client.close()
+        return self._shut_down()
+
+    def _shut_down(self) -> dict:
+        for name, handler in self.handlers.items():
+            try:
+                handler.clean_up()
+            except Exception as e:
+                self.logger.error(f"Cleaning up {name} failed: {str(e)}")
+        # replays what is left in the spill log, so the last raw_to_processed sees those rows too
+        self.writer.stop()
+        if self._raw_to_processed_thread is not None:
+            self._raw_to_processed_thread.join()
+        handler = self._raw_to_processed_handler()
+        if handler is not None:
+            handler.raw_to_processed()
+
+        stats = {name: handler.stats() for name, handler in self.handlers.items()}
+        for name, stream_stats in stats.items():
+            self.logger.info(f"{name}: {stream_stats}")
+        if self.writer.log is not None and self.writer.log.pending():
+            self.logger.info(f"{self.writer.log.size()} bytes are still in the spill log {self.writer.log.directory}, "
+                             f"they will be replayed on the next start or with replay_spill.py")
+        self.logger.send()
+        return stats
+
+
+if __name__ == '__main__':
+    logger = _DaemonLogger(
+        "https://discord.com/api/webhooks/1226677851843989657/tiieQtc6oXsgkkZQb8bc7BT___vgH8H-gHEOiiV_6wPdKlB-wseYFTnupQ4_sb4DefcY")
+    daemon = IngestDaemon(logger)
+    metrics.install_signal_handlers()
+    signal.signal(signal.SIGINT, daemon.stop)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    logger.info(f"Starting the ingest daemon for {', '.join(daemon.handlers)}")
+    logger.send()
+
+    daemon.run()
+
+    print("We exited the ingest daemon")
@@ -3,14 +3,26 @@ from google.cloud import pubsub_v1
 from concurrent.futures import TimeoutError
 import json
 import os
+import time
 from src.breadcrumb_processor import BreadCrumbProcessor
 from src.postgres_connector import PostgresConnector
+from src.message_source import MessageSource, PubSubMessageSource
+from src.summaries import SummaryMaterializer
+from src.instrumentation import metrics
+from src.spill_log import SPILL_DIR, SPILL_RETRY_SECONDS, SpillingWriter, SpillLogFull
+from src.flush_controller import AdaptiveFlushController
+from src.idle_monitor import IdleMonitor
 from threading import Thread, Lock
 
 project_id = os.environ.get("PROJECT_ID")
 subscriber_id = os.environ.get("PART3_SUBSCRIBER_ID")
 MAX_BREADCRUMB = 20
 MAX_TIMEOUT = 60
+# the stop events come in one burst right after the publisher runs, so a short quiet period is enough. 0 waits out
+# MAX_TIMEOUT like before, with idle shutdown MAX_TIMEOUT is only how long we wait for the first message
+IDLE_SHUTDOWN_SECONDS = float(os.environ.get("PART3_IDLE_SHUTDOWN_SECONDS", "10"))
+POLL_SECONDS = 1
+MATERIALIZE_SUMMARIES = os.environ.get("MATERIALIZE_SUMMARIES", "1") == "1"
 
 
 class Subscriber:
@@ -23,11 +35,33 @@ class Subscriber:
     and send the logs to Discord.
     """
 
-    def __init__(self, postgres_connector: PostgresConnector):
+    def __init__(self, postgres_connector: PostgresConnector,
+                 spill_dir: str | None = os.path.join(SPILL_DIR, "stop_events") if SPILL_DIR else None,
+                 writer: SpillingWriter = None):
         self._postgres_connector = postgres_connector
         self._processed_breadcrumbs = pd.DataFrame()
         self._lock = Lock()
         self._bad_breadcrumbs = 0
+        self._summaries = SummaryMaterializer(postgres_connector)
+        # upserts that fail while Postgres is down are kept on disk and replayed in order when it's back. The ingest
+        # daemon passes in its shared writer and sends the replayed upserts to refresh_summaries itself
+        self._owns_writer = writer is None
+        self._writer = writer if writer is not None else SpillingWriter.from_env(postgres_connector, spill_dir,
+                                                                                 on_replayed=self.refresh_summaries)
+        self._writer.start()
+        # set when the spill log is full too, messages are nacked until then so Pub/Sub holds on to them
+        self._backpressure_until = 0.0
+        self._flush_controller = AdaptiveFlushController("part3", MAX_BREADCRUMB)
+        self._idle = IdleMonitor(IDLE_SHUTDOWN_SECONDS, MAX_TIMEOUT)
+
+    def refresh_summaries(self, kind, merged_trip_ids):
+        # the stop events fill in route_id and direction, which moves the trips into their route days. Trips that
+        # aren't in the trip table yet wait in the pending table and get refreshed by raw_to_processed instead
+        if kind == "trip_metadata" and MATERIALIZE_SUMMARIES and merged_trip_ids:
+            try:
+                self._summaries.refresh(merged_trip_ids)
+            except Exception as e:
+                print(f"Error refreshing summaries: {e}")
 
     def _finalize_and_send(self):
         if self._processed_breadcrumbs is None:
@@ -35,96 +69,162 @@ class Subscriber:
         
         print(f"Appending {self._processed_breadcrumbs.shape[0]} breadcrumbs to part3 table")
 
-        self._postgres_connector.upsert_to_trip(self._processed_breadcrumbs)
+        merged_trip_ids = self._writer.write("trip_metadata", self._processed_breadcrumbs,
+                                             self._postgres_connector.upsert_to_trip)
+        self.refresh_summaries("trip_metadata", merged_trip_ids)
 
         self._processed_breadcrumbs = None
 
+    def _timed_flush(self):
+        rows = self._processed_breadcrumbs.shape[0] if self._processed_breadcrumbs is not None else 0
+        start = time.perf_counter()
+        self._finalize_and_send()
+        self._backpressure_until = 0.0
+        self._flush_controller.flushed(rows, time.perf_counter() - start)
 
     def clean_up(self):
         """
         Right now this method just calls the finalize_and_send method. I made it a separate method in case I need to add
-        more clean up steps in the future.
+        more clean up steps in the future. It also replays the spill log if the database is up.
         :return: None
         """
         self._finalize_and_send()
+        if self._owns_writer:
+            self._writer.stop()
+        print(self._flush_controller.report())
 
-    def sub(self, project_id: str, subscription_id: str) -> None:
+    def message_parser(self, message: pubsub_v1.subscriber.message.Message) -> None:
         """
-        This method listens for messages on a Google Pub/Sub subscription. It calls the message_parser method to process
-        the messages. It takes in a project_id and subscription_id as parameters. In the previous version of this code,
-        the message parser would do a ton of I/O operations. I refactored the code to only do I/O operations when the
-        processed_breadcrumbs DataFrame reaches a certain size. This should improve performance. I also added a timeout
-        to the streaming_pull_future.result method to prevent the program from hanging indefinitely. Once the timeout
-        is reached, the program will cancel the streaming_pull_future and exit. Main will then call the clean_up method
-        to make sure any remaining breadcrumbs are processed and sent to the database.
-        :param project_id:
-        :param subscription_id:
+        Callback for a single stop event message. It was a closure inside sub, it's a method now so the ingest daemon
+        can hand it to its own subscription.
+        :param message: the Pub/Sub message
         :return: None
         """
-        subscriber_client = pubsub_v1.SubscriberClient()
+        if message.data is None:
+            message.ack()
+            return
 
-        subscription_path = subscriber_client.subscription_path(project_id, subscription_id)
+        if self._backpressure_until and time.monotonic() < self._backpressure_until:
+            metrics.count("part3.nacked")
+            message.nack()
+            return
 
-        def message_parser(message: pubsub_v1.subscriber.message.Message) -> None:
-            if message.data is None:
-                message.ack()
-                return
+        decoded_message = message.data.decode("utf-8")
 
-            decoded_message = message.data.decode("utf-8")
+        # This is a little inefficient because I'm doing the processing once on the raw data and then again on the
+        # processed data. Currently, the publisher is the real bottleneck so I'm not too worried about this.
+        try:
+            json_message = json.loads(decoded_message)
+        except json.JSONDecodeError:
+            message.ack()
+            return
 
-            # This is a little inefficient because I'm doing the processing once on the raw data and then again on the
-            # processed data. Currently, the publisher is the real bottleneck so I'm not too worried about this.
-            try:
-                json_message = json.loads(decoded_message)
-            except json.JSONDecodeError:
-                message.ack()
-                return
+        try:
+            breadcrumb_df = BreadCrumbProcessor.process_individual_part3(json_message)
+        except Exception as e:
+            print(f"Error processing message: {e}")
+            message.ack()
+            return
+
+        if breadcrumb_df is None:
+            self._lock.acquire()
+            self._bad_breadcrumbs += 1
+            if self._bad_breadcrumbs > 1000:
+                print("Too many bad breadcrumbs")
+            self._lock.release()
+            message.ack()
+            return
 
+        if breadcrumb_df is not None:
             try:
-                breadcrumb_df = BreadCrumbProcessor.process_individual_part3(json_message)
+                self._lock.acquire()
+                buffered = self._processed_breadcrumbs
+                if self._processed_breadcrumbs is None:
+                    self._processed_breadcrumbs = breadcrumb_df
+                else:
+                    self._processed_breadcrumbs = pd.concat([self._processed_breadcrumbs, breadcrumb_df])
+                if self._flush_controller.add(breadcrumb_df.shape[0], len(message.data)):
+                    self._timed_flush()
+            except SpillLogFull as e:
+                # same as the breadcrumb subscriber: the stop events already acked stay buffered for the next try, this
+                # message's rows come back out and it is nacked so Pub/Sub redelivers it once the back pressure is over
+                self._processed_breadcrumbs = buffered
+                print(f"{e}, not taking messages for {SPILL_RETRY_SECONDS:.0f}s")
+                self._backpressure_until = time.monotonic() + SPILL_RETRY_SECONDS
+                metrics.count("part3.nacked")
+                message.nack()
+                return
             except Exception as e:
-                print(f"Error processing message: {e}")
+                print(f"Error processing message: {str(e)}")
                 message.ack()
                 return
-
-            if breadcrumb_df is None:
-                self._lock.acquire()
-                self._bad_breadcrumbs += 1
-                if self._bad_breadcrumbs > 1000:
-                    print("Too many bad breadcrumbs")
+            finally:
                 self._lock.release()
-                message.ack()
+
+        message.ack()
+
+    def on_message(self, message: pubsub_v1.subscriber.message.Message) -> None:
+        self._idle.started()
+        try:
+            self.message_parser(message)
+        finally:
+            self._idle.finished()
+
+    def flush_if_due(self) -> None:
+        """
+        Flush the stop events if the oldest one has waited as long as the latency target allows.
+        """
+        with self._lock:
+            if self._backpressure_until and time.monotonic() < self._backpressure_until:
                 return
+            try:
+                if self._flush_controller.due():
+                    self._timed_flush()
+            except SpillLogFull as e:
+                print(f"{e}, not taking messages for {SPILL_RETRY_SECONDS:.0f}s")
+                self._backpressure_until = time.monotonic() + SPILL_RETRY_SECONDS
+            except Exception as e:
+                print(f"Error flushing: {str(e)}")
 
-            if breadcrumb_df is not None:
-                try:
-                    self._lock.acquire()
-                    if self._processed_breadcrumbs is None:
-                        self._processed_breadcrumbs = breadcrumb_df
-                    else:
-                        self._processed_breadcrumbs = pd.concat([self._processed_breadcrumbs, breadcrumb_df])
-                    if self._processed_breadcrumbs.shape[0] > MAX_BREADCRUMB:
-                        self._finalize_and_send()
-                except Exception as e:
-                    print(f"Error processing message: {str(e)}")
-                    message.ack()
-                    return
-                finally:
-                    self._lock.release()
+    def stats(self) -> dict:
+        with self._lock:
+            return {"messages": self._idle.messages, "bad_breadcrumbs": self._bad_breadcrumbs}
 
-            message.ack()
+    def sub(self, project_id: str, subscription_id: str, source: MessageSource = None) -> None:
+        """
+        This method listens for messages on a Google Pub/Sub subscription. It calls the message_parser method to process
+        the messages. It takes in a project_id and subscription_id as parameters. In the previous version of this code,
+        the message parser would do a ton of I/O operations. I refactored the code to only do I/O operations when the
+        processed_breadcrumbs DataFrame reaches a certain size. This should improve performance. I also added a timeout
+        to the streaming_pull_future.result method to prevent the program from hanging indefinitely. Once the timeout
+        is reached, the program will cancel the streaming_pull_future and exit. Main will then call the clean_up method
+        to make sure any remaining breadcrumbs are processed and sent to the database. With idle shutdown on, the pull
+        ends once no stop events have come in for IDLE_SHUTDOWN_SECONDS instead of always taking MAX_TIMEOUT.
+        :param project_id:
+        :param subscription_id:
+        :param source: where the messages come from, defaults to the Pub/Sub subscription
+        :return: None
+        """
+        if source is None:
+            source = PubSubMessageSource(project_id, subscription_id)
 
-        streaming_pull_future = subscriber_client.subscribe(
-            subscription_path, callback=message_parser
-        )
+        streaming_pull_future = source.subscribe(self.on_message)
 
-        print(f"Listening for messages on {subscription_path}..\n")
+        print(f"Listening for messages on {getattr(source, 'subscription_path', type(source).__name__)}..\n")
 
-        with subscriber_client:
-            try:
-                streaming_pull_future.result(timeout=MAX_TIMEOUT)
-            except TimeoutError:
-                streaming_pull_future.cancel()
+        self._idle.reset()
+        with source:
+            while True:
+                try:
+                    streaming_pull_future.result(timeout=POLL_SECONDS)
+                    break
+                except TimeoutError:
+                    reason = self._idle.should_stop()
+                    if reason is not None:
+                        print(reason)
+                        streaming_pull_future.cancel()
+                        break
+                    self.flush_if_due()
 
 
 if __name__ == '__main__':
@@ -5,16 +5,45 @@ from concurrent.futures import TimeoutError
 from logger import Discord_logger
 import datetime as dt
 import json
+import multiprocessing
 import os
+import queue
+import signal
+import time
 import pytz
 from src.postgres_connector import PostgresConnector
 from src.breadcrumb_processor import BreadCrumbProcessor
+from src.instrumentation import metrics
+from src.date_cache import opd_date_cache
+from src.message_source import MessageSource, PubSubMessageSource
+from src.summaries import SummaryMaterializer
+from src.trip_state import BREADCRUMB_ROW_COLUMNS, TripStateStore
+from src.spill_log import SPILL_DIR, SPILL_RETRY_SECONDS, SpillingWriter, SpillLog, SpillLogFull
+from src.flush_controller import AdaptiveFlushController
+from src.idle_monitor import IDLE_SHUTDOWN_SECONDS, IdleMonitor
+from src.sharded_processing import RAW_TO_PROCESSED_SHARDS, process_shard, process_sharded
 from threading import Thread, Lock
 
 project_id = os.environ.get("PROJECT_ID")
 subscriber_id = os.environ.get("SUBSCRIBER_ID")
+# starting batch size, with ADAPTIVE_FLUSH=0 it stays at this (see src/flush_controller.py)
 MAX_BREADCRUMB = 1000
+# with idle shutdown (IDLE_SHUTDOWN_SECONDS, see src/idle_monitor.py) this is only how long we wait for the first
+# message, otherwise it's how long the pull runs
 MAX_TIMEOUT = 7200
+USE_FAST_PATH = os.environ.get("USE_FAST_PATH", "1") == "1"
+# set this to also keep every message in the day partitioned columnar archive (see src/columnar_archive.py)
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR")
+SUBSCRIBER_WORKERS = int(os.environ.get("SUBSCRIBER_WORKERS", "1"))
+# keep trip_summary and route_day_summary up to date after every raw_to_processed (see src/summaries.py)
+MATERIALIZE_SUMMARIES = os.environ.get("MATERIALIZE_SUMMARIES", "1") == "1"
+# compute speed as messages arrive and write straight to the breadcrumb table (see src/trip_state.py). Needs the fast
+# path. With STAGE_RAW=0 the raw table is skipped altogether, otherwise the raw rows are still written as a backup and
+# marked as in the final table once their breadcrumbs are in, whatever a crash left unmarked is caught up on start
+ONLINE_SPEED = os.environ.get("ONLINE_SPEED", "0") == "1"
+STAGE_RAW = os.environ.get("STAGE_RAW", "1") == "1"
+STOP_POLL_SECONDS = 1
+WORKER_SHUTDOWN_GRACE = 120
 
 
 class Subscriber:
@@ -27,54 +56,309 @@ class Subscriber:
     and send the logs to Discord.
     """
 
-    def __init__(self, logger: Discord_logger, file_path, postgres_connector: PostgresConnector = None):
+    def __init__(self, logger: Discord_logger, file_path, postgres_connector: PostgresConnector = None,
+                 fast_path: bool = USE_FAST_PATH, online_speed: bool = ONLINE_SPEED, stage_raw: bool = STAGE_RAW,
+                 spill_dir: str | None = SPILL_DIR, writer: SpillingWriter = None):
         self._logger = logger
         self._file = file_path
         self._postgres_connector = postgres_connector if postgres_connector is not None else PostgresConnector()
-        self._processed_breadcrumbs = pd.DataFrame()
+        # with the fast path this holds BreadcrumbRecords, otherwise the one row DataFrames from process_individual.
+        # Either way they are only turned into one DataFrame when we flush instead of concatenating on every message
+        self._processed_breadcrumbs = []
+        self._fast_path = fast_path
+        # the online speed path only works on BreadcrumbRecords, and without it the raw table is the only copy
+        self._trip_state = TripStateStore() if online_speed and fast_path else None
+        self.online_speed = self._trip_state is not None
+        self.stage_raw = stage_raw or not self.online_speed
+        self._breadcrumb_rows = []
+        self._new_trips = []
+        self._online_trip_ids = set()
+        self._archive = None
+        if ARCHIVE_DIR:
+            # pyarrow is only needed when archiving is turned on
+            from src.columnar_archive import ColumnarArchiveWriter
+            self._archive = ColumnarArchiveWriter(ARCHIVE_DIR)
+        # batches that can't be written while Postgres is down go to a log on disk and are replayed when it's back.
+        # The ingest daemon passes in the writer it shares between its streams and stops it itself
+        self._owns_writer = writer is None
+        self._writer = writer if writer is not None else SpillingWriter.from_env(self._postgres_connector, spill_dir)
+        self._writer.start()
+        # set when the spill log is full too, messages are nacked until then so Pub/Sub holds on to them
+        self._backpressure_until = 0.0
+        # sizes the batches from how long flushes take and how fast messages come in
+        self._flush_controller = AdaptiveFlushController("subscriber", MAX_BREADCRUMB)
+        self._idle = IdleMonitor(IDLE_SHUTDOWN_SECONDS, MAX_TIMEOUT)
         self._lock = Lock()
         self._bad_breadcrumbs = 0
+        self._rows_flushed = 0
+        self._breadcrumbs_written = 0
+
+    def _buffered(self) -> int:
+        return max(len(self._processed_breadcrumbs), len(self._breadcrumb_rows))
+
+    def _timed_flush(self):
+        rows = self._buffered()
+        start = time.perf_counter()
+        self._finalize_and_send()
+        self._backpressure_until = 0.0
+        self._flush_controller.flushed(rows, time.perf_counter() - start)
+
+    def flush_if_due(self) -> None:
+        """
+        Flush the buffer if the oldest message in it has waited as long as the latency target allows. Called from the
+        poll loop in sub so a batch doesn't sit there when messages slow down.
+        """
+        with self._lock:
+            if self._backpressure_until and time.monotonic() < self._backpressure_until:
+                return
+            try:
+                if self._flush_controller.due():
+                    self._timed_flush()
+            except SpillLogFull as e:
+                self._logger.info(f"{e}, not taking messages for {SPILL_RETRY_SECONDS:.0f}s")
+                self._backpressure_until = time.monotonic() + SPILL_RETRY_SECONDS
+            except Exception as e:
+                print(f"Error flushing: {str(e)}")
 
     def _finalize_and_send(self):
-        if self._processed_breadcrumbs is None:
-            return
+        # raw goes first, so the raw rows of the breadcrumbs written below are in before they are marked as final
+        if self._processed_breadcrumbs:
+            self._send_raw()
+        if self._breadcrumb_rows or self._new_trips:
+            self._send_breadcrumbs()
+        metrics.gauge("subscriber.buffered_rows", 0)
 
-        self._postgres_connector.append_to_raw(self._processed_breadcrumbs)
-        self._processed_breadcrumbs = None
-        self._postgres_connector.connection.commit()
+    def _send_raw(self):
+        with metrics.stage("subscriber.concat"):
+            if self._fast_path:
+                breadcrumb_df = BreadCrumbProcessor.records_to_dataframe(self._processed_breadcrumbs)
+            else:
+                breadcrumb_df = pd.concat(self._processed_breadcrumbs)
 
-    def raw_to_processed(self):
+        with metrics.stage("subscriber.finalize_and_send"):
+            self._writer.write("raw", breadcrumb_df, self._postgres_connector.append_to_raw)
+            self._rows_flushed += len(breadcrumb_df)
+            self._processed_breadcrumbs = []
+            self._postgres_connector.connection.commit()
+
+    def _send_breadcrumbs(self):
+        """
+        Write the rows the trip state store let out since the last flush to the breadcrumb table, and the trips it saw
+        for the first time to the trip table, the same way raw_to_processed does. With the raw table on, the raw rows
+        of those trips up to the newest breadcrumb written are then marked as in the final table. That goes through
+        the spill log like the rest, so it is never applied before the breadcrumbs are in, and a raw row that was
+        still in the reorder buffer when we crashed stays unmarked for catch_up.
+        """
+        with metrics.stage("subscriber.send_breadcrumbs"):
+            if self._new_trips:
+                trip_df = pd.DataFrame.from_records(self._new_trips, columns=["trip_id", "vehicle_id"])
+                trip_df["route_id"] = None
+                trip_df["direction"] = None
+                trip_df["service_key"] = None
+                self._online_trip_ids.update(self._writer.write("trip", trip_df,
+                                                                self._postgres_connector.append_to_trip) or [])
+                self._new_trips = []
+            if self._breadcrumb_rows:
+                breadcrumb_df = pd.DataFrame.from_records(self._breadcrumb_rows, columns=BREADCRUMB_ROW_COLUMNS)
+                self._writer.write("breadcrumb", breadcrumb_df, self._postgres_connector.append_to_breadcrumb)
+                self._breadcrumbs_written += len(breadcrumb_df)
+                self._online_trip_ids.update(breadcrumb_df["trip_id"].unique().tolist())
+                self._breadcrumb_rows = []
+                if self.stage_raw:
+                    final_df = breadcrumb_df.groupby("trip_id", as_index=False)["tstamp"].max()
+                    self._writer.write("raw_final", final_df, self._postgres_connector.mark_raw_final)
+        metrics.gauge("subscriber.trip_state_trips", len(self._trip_state))
+
+    def raw_to_processed(self, quiet_seconds: float = 0):
         """
         This method reads the raw data from the file path and processes it using the BreadCrumbProcessor. You have to
         have a raw table I realized because what if the first breadcrumb is from trip 'a' and then we don't get any more
         breadcrumbs from trip 'a' until 300,000 breadcrumbs later? We need to make sure we have every breadcrumb from every
-        trip prior to calculating the speed.
+        trip prior to calculating the speed. With RAW_TO_PROCESSED_SHARDS > 1 the trips are split into shards that are
+        processed in worker processes side by side (see src/sharded_processing.py), otherwise it all happens here. Only
+        the rows that were read get marked as in the final table, so this can run while the subscriber is still
+        appending to raw (the ingest daemon does that).
+        :param quiet_seconds: only process the trips that look finished, see PostgresConnector.unprocessed_raw. 0
+        processes everything
         :return: None
         """
-
-        try:
-            raw_df = self._postgres_connector.get_raw()
-            raw_df = raw_df[~raw_df['is_in_final_table']]
-            raw_df = raw_df.drop_duplicates()
-            trip_df, breadcrumb_df = BreadCrumbProcessor.raw_table_to_processed_tables(raw_df)
-            self._postgres_connector.append_to_breadcrumb(breadcrumb_df)
-            self._postgres_connector.append_to_trip(trip_df)
-            self._postgres_connector.set_is_in_final_table()
-            self._logger.info(f"Processed {len(breadcrumb_df)} breadcrumbs and {len(trip_df)} trips")
-        except Exception as e:
-            self._logger.info(f"Error processing raw data: {str(e)}")
-        finally:
-            self._logger.send()
+        raw_to_processed(self._postgres_connector, self._logger, quiet_seconds)
 
     def clean_up(self):
         """
         Right now this method just calls the finalize_and_send method. I made it a separate method in case I need to add
-        more clean up steps in the future.
+        more clean up steps in the future. It also writes out whatever is left in the columnar archive buffer, replays
+        the spill log if the database is up, and with the online speed path writes out whatever is left in the reorder
+        buffers and refreshes the summaries of those trips since raw_to_processed doesn't see them.
         :return: None
         """
+        if self.online_speed:
+            # nothing else is coming, let out what is still waiting in the reorder buffers
+            with self._lock:
+                self._breadcrumb_rows.extend(self._trip_state.flush())
         self._finalize_and_send()
+        self._logger.info(self._flush_controller.report())
+        if self._archive is not None:
+            try:
+                self._archive.close()
+            except Exception as e:
+                self._logger.error(f"Error writing the columnar archive, {self._archive.pending_rows} rows were not "
+                                   f"archived: {str(e)}")
+        if self._owns_writer:
+            self._writer.stop()
+        if self._owns_writer and self._writer.log is not None and self._writer.log.pending():
+            self._logger.info(f"{self._writer.log.size()} bytes are still in the spill log "
+                              f"{self._writer.log.directory}, they will be replayed on the next start or with "
+                              f"replay_spill.py")
+        if self.online_speed:
+            self._logger.info(f"Online speed: {self._breadcrumbs_written} breadcrumbs written, "
+                              f"{self._trip_state.stats}")
+            if MATERIALIZE_SUMMARIES and self._online_trip_ids:
+                refreshed = SummaryMaterializer(self._postgres_connector).refresh(self._online_trip_ids)
+                self._logger.info(f"Refreshed the summaries of {refreshed} trips")
+
+    def catch_up(self) -> None:
+        """
+        With the online speed path and the raw table on, a raw row is only marked as in the final table once its
+        breadcrumb is committed. The unmarked ones a crashed run left behind never made it out of the trip state store,
+        so they go through raw_to_processed before we start pulling. The spill log is replayed first since it can hold
+        breadcrumbs and marks for them. This mustn't run while another subscriber is writing online (those rows are
+        still in its buffers), so it's only called on start.
+        :return: None
+        """
+        if not (self.online_speed and self.stage_raw):
+            return
+        try:
+            self._writer.replay()
+        except Exception as e:
+            self._logger.error(f"Couldn't replay the spill log, skipping the catch up: {str(e)}")
+            return
+        self.raw_to_processed()
+
+    def stats(self) -> dict:
+        """
+        Counts for this subscriber, the supervisor adds these up across worker processes.
+        :return: dict of messages seen, bad breadcrumbs, rows written to the raw table, rows written to the
+        breadcrumb table by the online speed path, and rows that went through the spill log
+        """
+        with self._lock:
+            return {"messages": self._idle.messages, "bad_breadcrumbs": self._bad_breadcrumbs,
+                    "rows_flushed": self._rows_flushed, "breadcrumbs_written": self._breadcrumbs_written,
+                    "spilled_rows": self._writer.log.stats["rows"] if self._writer.log is not None else 0}
+
+    def message_parser(self, message: pubsub_v1.subscriber.message.Message) -> None:
+        """
+        Callback for a single Pub/Sub message. It decodes and validates the breadcrumb, adds it to the buffer and
+        flushes the buffer to the raw table once it is big enough. With the online speed path the breadcrumb also goes
+        through the trip state store and whatever comes out is buffered for the breadcrumb table. This used to be a
+        closure inside sub, I pulled it out so the benchmark (and anything else that doesn't have a real subscription)
+        can drive it directly. Anything with a data attribute and an ack method works as the message.
+        :param message: the Pub/Sub message
+        :return: None
+        """
+        metrics.count("subscriber.messages")
+        if message.data is None:
+            message.ack()
+            return
+
+        if self._backpressure_until and time.monotonic() < self._backpressure_until:
+            metrics.count("subscriber.nacked")
+            message.nack()
+            return
+
+        decoded_message = message.data.decode("utf-8")
+
+        # This is a little inefficient because I'm doing the processing once on the raw data and then again on the
+        # processed data. Currently, the publisher is the real bottleneck so I'm not too worried about this.
+        try:
+            with metrics.stage("subscriber.json_decode"):
+                json_message = json.loads(decoded_message)
+        except json.JSONDecodeError:
+            self._logger.info(f"Error decoding message: {decoded_message}")
+            self._logger.send()
+            message.ack()
+            return
+
+        if self._archive is not None and isinstance(json_message, dict):
+            try:
+                with metrics.stage("subscriber.archive"):
+                    self._archive.append(json_message)
+            except Exception as e:
+                # the rows stay in the archive's buffer for the next flush, the database write shouldn't wait on it
+                metrics.count("subscriber.archive_errors")
+                self._logger.error(f"Error writing the columnar archive: {str(e)}")
+
+        try:
+            with metrics.stage("subscriber.process_individual"):
+                if self._fast_path:
+                    breadcrumb = BreadCrumbProcessor.process_individual_fast(json_message)
+                else:
+                    breadcrumb = BreadCrumbProcessor.process_individual(json_message)
+        except Exception as e:
+            self._logger.info(f"Error processing message: {str(e)}")
+            self._logger.send()
+            message.ack()
+            return
+
+        if breadcrumb is None:
+            metrics.count("subscriber.bad_breadcrumbs")
+            self._lock.acquire()
+            self._bad_breadcrumbs += 1
+            if self._bad_breadcrumbs > 1000:
+                print("Too many bad breadcrumbs")
+            self._lock.release()
+            message.ack()
+            return
+
+        if breadcrumb is not None:
+            rows = new_trips = None
+            if self.online_speed:
+                with metrics.stage("subscriber.trip_state"):
+                    rows, new_trips = self._trip_state.add(breadcrumb)
+            try:
+                self._lock.acquire()
+                if self.stage_raw:
+                    self._processed_breadcrumbs.append(breadcrumb)
+                if rows:
+                    self._breadcrumb_rows.extend(rows)
+                if new_trips:
+                    self._new_trips.extend(new_trips)
+                metrics.gauge("subscriber.buffered_rows", self._buffered())
+                if self._flush_controller.add(nbytes=len(message.data)):
+                    self._timed_flush()
+            except SpillLogFull as e:
+                # the rows already acked stay in the buffer and are tried again once the back pressure is over. This
+                # message's row comes back out and the message is nacked, so until the batch is written Pub/Sub still
+                # has it, like the messages after it that are nacked until then
+                if self._processed_breadcrumbs and self._processed_breadcrumbs[-1] is breadcrumb:
+                    self._processed_breadcrumbs.pop()
+                self._logger.info(f"{e}, not taking messages for {SPILL_RETRY_SECONDS:.0f}s")
+                self._backpressure_until = time.monotonic() + SPILL_RETRY_SECONDS
+                metrics.count("subscriber.nacked")
+                message.nack()
+                return
+            except Exception as e:
+                print(f"Error processing message: {str(e)}")
+                message.ack()
+                return
+            finally:
+                self._lock.release()
+
+        message.ack()
 
-    def sub(self, project_id: str, subscription_id: str) -> None:
+    def on_message(self, message: pubsub_v1.subscriber.message.Message) -> None:
+        # the idle monitor counts the messages and the callbacks currently running on the Pub/Sub thread pool under a
+        # lock of its own, self._lock is held for the whole database write while flushing
+        self._idle.started()
+        if metrics.mode != "off":
+            metrics.gauge("subscriber.in_flight", self._idle.outstanding)
+        try:
+            with metrics.stage("subscriber.message_parser"):
+                self.message_parser(message)
+        finally:
+            self._idle.finished()
+
+    def sub(self, project_id: str, subscription_id: str, source: MessageSource = None, stop_event=None) -> None:
         """
         This method listens for messages on a Google Pub/Sub subscription. It calls the message_parser method to process
         the messages. It takes in a project_id and subscription_id as parameters. In the previous version of this code,
@@ -82,80 +366,225 @@ class Subscriber:
         processed_breadcrumbs DataFrame reaches a certain size. This should improve performance. I also added a timeout
         to the streaming_pull_future.result method to prevent the program from hanging indefinitely. Once the timeout
         is reached, the program will cancel the streaming_pull_future and exit. Main will then call the clean_up method
-        to make sure any remaining breadcrumbs are processed and sent to the database.
+        to make sure any remaining breadcrumbs are processed and sent to the database. With idle shutdown on, the pull
+        also ends once the subscription has been quiet for IDLE_SHUTDOWN_SECONDS with nothing outstanding, so main gets
+        to raw_to_processed as soon as the backlog is drained instead of waiting out the whole window.
         :param project_id:
         :param subscription_id:
+        :param source: where the messages come from, defaults to the Pub/Sub subscription. Pass a
+        ReplayMessageSource to load test against local data instead.
+        :param stop_event: optional threading/multiprocessing Event, setting it ends the pull early. This is how the
+        supervisor shuts its workers down.
         :return: None
         """
-        subscriber_client = pubsub_v1.SubscriberClient()
+        if source is None:
+            source = PubSubMessageSource(project_id, subscription_id)
 
-        subscription_path = subscriber_client.subscription_path(project_id, subscription_id)
+        streaming_pull_future = source.subscribe(self.on_message)
 
-        def message_parser(message: pubsub_v1.subscriber.message.Message) -> None:
-            if message.data is None:
-                message.ack()
-                return
+        print(f"Listening for messages on {getattr(source, 'subscription_path', type(source).__name__)}..\n")
 
-            decoded_message = message.data.decode("utf-8")
+        self._idle.reset()
+        with source:
+            while True:
+                try:
+                    streaming_pull_future.result(timeout=STOP_POLL_SECONDS)
+                    break
+                except TimeoutError:
+                    reason = self._idle.should_stop()
+                    if reason is not None:
+                        self._logger.info(reason)
+                        self._logger.send()
+                        streaming_pull_future.cancel()
+                        break
+                    if stop_event is not None and stop_event.is_set():
+                        self._logger.info("Stop requested")
+                        streaming_pull_future.cancel()
+                        break
+                    self.flush_if_due()
 
-            # This is a little inefficient because I'm doing the processing once on the raw data and then again on the
-            # processed data. Currently, the publisher is the real bottleneck so I'm not too worried about this.
-            try:
-                json_message = json.loads(decoded_message)
-            except json.JSONDecodeError:
-                self._logger.info(f"Error decoding message: {decoded_message}")
-                self._logger.send()
-                message.ack()
-                return
 
-            try:
-                breadcrumb_df = BreadCrumbProcessor.process_individual(json_message)
-            except Exception as e:
-                self._logger.info(f"Error processing message: {str(e)}")
-                self._logger.send()
-                message.ack()
-                return
+class _WorkerLogger:
+    """
+    Stand in for the Discord logger inside worker processes. Messages are kept and handed back to the supervisor with
+    the worker's stats so we get one Discord message for the whole run instead of one per worker.
+    """
 
-            if breadcrumb_df is None:
-                self._lock.acquire()
-                self._bad_breadcrumbs += 1
-                if self._bad_breadcrumbs > 1000:
-                    print("Too many bad breadcrumbs")
-                self._lock.release()
-                message.ack()
-                return
+    def __init__(self):
+        self.messages = []
 
-            if breadcrumb_df is not None:
-                try:
-                    self._lock.acquire()
-                    if self._processed_breadcrumbs is None:
-                        self._processed_breadcrumbs = breadcrumb_df
-                    else:
-                        self._processed_breadcrumbs = pd.concat([self._processed_breadcrumbs, breadcrumb_df])
-                    if self._processed_breadcrumbs.shape[0] > MAX_BREADCRUMB:
-                        self._finalize_and_send()
-                except Exception as e:
-                    print(f"Error processing message: {str(e)}")
-                    message.ack()
-                    return
-                finally:
-                    self._lock.release()
+    def info(self, message):
+        self.messages.append(message)
 
-            message.ack()
+    def error(self, message):
+        self.messages.append(message)
 
-        streaming_pull_future = subscriber_client.subscribe(
-            subscription_path, callback=message_parser
-        )
+    def send(self):
+        pass
 
-        print(f"Listening for messages on {subscription_path}..\n")
 
-        with subscriber_client:
+def raw_to_processed(connector: PostgresConnector, logger, quiet_seconds: float = 0) -> None:
+    """
+    Subscriber.raw_to_processed without a Subscriber, for the supervisor's process which doesn't pull anything itself.
+    :param connector: the PostgresConnector to process in (and to refresh the summaries with)
+    :param logger: where the counts and errors go, it's sent at the end
+    :param quiet_seconds: see Subscriber.raw_to_processed
+    :return: None
+    """
+    try:
+        if RAW_TO_PROCESSED_SHARDS > 1:
+            with metrics.stage("raw_to_processed.sharded"):
+                result = process_sharded(quiet_seconds=quiet_seconds)
+            for shard, error in sorted(result["failed"].items()):
+                logger.error(f"raw_to_processed shard {shard}/{result['shards']} failed, its rows are left for the "
+                             f"next run: {error}")
+        else:
+            result = process_shard(0, 1, connector, quiet_seconds)
+        logger.info(f"Processed {result['breadcrumbs']} breadcrumbs and {result['trips']} trips")
+        if MATERIALIZE_SUMMARIES:
+            refreshed = SummaryMaterializer(connector).refresh(result["trip_ids"])
+            logger.info(f"Refreshed the summaries of {refreshed} trips")
+    except Exception as e:
+        logger.info(f"Error processing raw data: {str(e)}")
+    finally:
+        if metrics.mode != "off":
+            logger.info(metrics.report())
+            logger.info(f"OPD_DATE cache: {opd_date_cache.info()}")
+        logger.send()
+
+
+def run_worker(worker_id: int, project_id: str, subscription_id: str, stop_event, results) -> None:
+    """
+    Body of one worker process. Each worker has its own streaming pull and its own PostgresConnector (and therefore its
+    own engine and connections), so nothing is shared with the other workers except the subscription itself, which
+    Pub/Sub load balances between them.
+    """
+    # ctrl-c goes to the whole process group, let the supervisor decide how to shut down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logger = _WorkerLogger()
+    stats = {"worker": worker_id, "pid": os.getpid(), "error": None}
+    try:
+        # a spill log can only have one writer. Migrating is left to the supervisor's process
+        subscriber = Subscriber(logger, None, PostgresConnector(migrate=False),
+                                spill_dir=os.path.join(SPILL_DIR, f"worker-{worker_id}") if SPILL_DIR else None)
+        try:
+            subscriber.sub(project_id, subscription_id, stop_event=stop_event)
+        finally:
+            subscriber.clean_up()
+        stats.update(subscriber.stats())
+    except Exception as e:
+        stats["error"] = str(e)
+    stats["log"] = logger.messages
+    stats["metrics"] = metrics.snapshot()["counters"]
+    results.put(stats)
+
+
+class SubscriberSupervisor:
+    """
+    Runs the breadcrumb subscriber in several processes. All of the cleaning is pandas code running on the Pub/Sub
+    callback threads, so inside one process it is serialized by the GIL no matter how many callback threads there are.
+    Separate processes each get their own GIL, so throughput scales with cores instead.
+
+    The supervisor starts the workers, turns SIGINT/SIGTERM into a coordinated stop (every worker stops pulling, flushes
+    its buffer and reports back), and adds up the workers' stats. Workers are started with spawn because the gRPC
+    channel inside the Pub/Sub client doesn't survive a fork.
+
+    Every worker has a spill log of its own under SPILL_DIR. Whatever a worker couldn't drain before it exited (or was
+    terminated) is replayed by the supervisor once they are all gone, so it's in before the last raw_to_processed.
+    """
+
+    def __init__(self, logger: Discord_logger, project_id: str, subscription_id: str, workers: int,
+                 connector: PostgresConnector = None):
+        self._logger = logger
+        # only for replaying the workers' spill logs, the workers have their own
+        self._connector = connector if connector is not None else PostgresConnector()
+        self._project_id = project_id
+        self._subscription_id = subscription_id
+        self._workers = workers
+        self._context = multiprocessing.get_context("spawn")
+        self._stop_event = self._context.Event()
+
+    def stop(self, signum=None, frame=None) -> None:
+        self._stop_event.set()
+
+    def run(self) -> dict:
+        """
+        Start the workers and wait for all of them to finish.
+        :return: dict with the summed stats and the per worker stats
+        """
+        results = self._context.Queue()
+        processes = [self._context.Process(target=run_worker, name=f"subscriber-{i}",
+                                           args=(i, self._project_id, self._subscription_id, self._stop_event, results))
+                     for i in range(self._workers)]
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        for process in processes:
+            process.start()
+
+        # results have to be drained while waiting, a child can't exit while its queue item is still unread
+        worker_stats = []
+        stop_deadline = None
+        while len(worker_stats) < len(processes):
             try:
-                streaming_pull_future.result(timeout=MAX_TIMEOUT)
-            except TimeoutError:
-                self._logger.info("Timeout")
-                self._logger.send()
-                streaming_pull_future.cancel()
+                worker_stats.append(results.get(timeout=STOP_POLL_SECONDS))
+            except queue.Empty:
+                if not any(process.is_alive() for process in processes):
+                    break
+                if self._stop_event.is_set() and stop_deadline is None:
+                    stop_deadline = time.monotonic() + WORKER_SHUTDOWN_GRACE
+                if stop_deadline is not None and time.monotonic() > stop_deadline:
+                    break
+
+        for process in processes:
+            process.join(timeout=STOP_POLL_SECONDS)
+            if process.is_alive():
+                self._logger.error(f"{process.name} did not shut down, terminating it")
+                process.terminate()
+                process.join()
+
+        self.replay_spill_logs()
+        return self._aggregate(worker_stats)
+
+    def replay_spill_logs(self) -> int:
+        """
+        Replay the worker-* spill logs under SPILL_DIR, which is only safe while no worker is running. run does it
+        after the workers exit, and it should be done before the catch up on start for the logs of a run that crashed.
+        :return: how many batches were replayed
+        """
+        if not SPILL_DIR or not os.path.isdir(SPILL_DIR):
+            return 0
+        replayed = 0
+        for name in sorted(os.listdir(SPILL_DIR)):
+            directory = os.path.join(SPILL_DIR, name)
+            if not name.startswith("worker-") or not os.path.isdir(directory):
+                continue
+            log = SpillLog(directory)
+            try:
+                if log.pending():
+                    replayed += SpillingWriter(self._connector, log).replay()
+            except Exception as e:
+                self._logger.error(f"Couldn't replay the spill log {directory}, {log.size()} bytes are left for "
+                                   f"replay_spill.py: {str(e)}")
+            finally:
+                log.close()
+        return replayed
+
+    def _aggregate(self, worker_stats: list[dict]) -> dict:
+        totals = {"workers": self._workers, "reported": len(worker_stats), "messages": 0, "bad_breadcrumbs": 0,
+                  "rows_flushed": 0, "breadcrumbs_written": 0, "spilled_rows": 0, "errors": []}
+        counters = {}
+        for stats in worker_stats:
+            for key in ("messages", "bad_breadcrumbs", "rows_flushed", "breadcrumbs_written", "spilled_rows"):
+                totals[key] += stats.get(key, 0)
+            if stats["error"] is not None:
+                totals["errors"].append(f"worker {stats['worker']}: {stats['error']}")
+            for message in stats["log"]:
+                self._logger.info(f"worker {stats['worker']}: {message}")
+            for name, counter in stats["metrics"].items():
+                counters[name] = counters.get(name, 0) + counter["total"]
+        totals["metrics"] = counters
+        totals["per_worker"] = worker_stats
+        return totals
 
 
 if __name__ == '__main__':
@@ -166,15 +595,38 @@ if __name__ == '__main__':
     today_str = today.strftime("%Y%m%d")
     file_path = f"/home/sarah/breadcrumb_data/{today_str}.ndjson"
 
-    subscriber = Subscriber(logger, f"/home/sarah/breadcrumb_data/{today_str}.ndjson")
-    subscriber._logger.info("Starting subscriber")
-    subscriber._logger.send()
-
-    subscriber.sub(project_id, subscriber_id)
+    metrics.install_signal_handlers()
+    logger.info("Starting subscriber")
+    logger.send()
 
-    print("We exited the subscriber loop")
+    if SUBSCRIBER_WORKERS > 1:
+        # the workers pull and write, all this process does is start them and, like the single process subscriber,
+        # catch up before and run raw_to_processed after. It has no buffers or spill log of its own
+        connector = PostgresConnector()
+        online_speed = ONLINE_SPEED and USE_FAST_PATH
+        supervisor = SubscriberSupervisor(logger, project_id, subscriber_id, SUBSCRIBER_WORKERS, connector)
+        supervisor.replay_spill_logs()
+        if online_speed and STAGE_RAW:
+            raw_to_processed(connector, logger)
+        totals = supervisor.run()
+        logger.info(f"{totals['reported']}/{totals['workers']} workers reported: {totals['messages']} messages, "
+                    f"{totals['bad_breadcrumbs']} bad breadcrumbs, {totals['rows_flushed']} rows written, "
+                    f"{totals['breadcrumbs_written']} breadcrumbs written online")
+        for error in totals["errors"]:
+            logger.error(error)
+        logger.send()
+        print("We exited the subscriber loop")
+        if not online_speed:
+            raw_to_processed(connector, logger)
+    else:
+        subscriber = Subscriber(logger, file_path)
+        subscriber.catch_up()
+        subscriber.sub(project_id, subscriber_id)
 
-    subscriber.clean_up()
+        print("We exited the subscriber loop")
 
-    subscriber.raw_to_processed()
+        subscriber.clean_up()
 
+        # with the online speed path the breadcrumbs are already in the breadcrumb table
+        if not subscriber.online_speed:
+            subscriber.raw_to_processed()
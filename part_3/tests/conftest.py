@@ -0,0 +1,14 @@
+"""
+The tests run from the part_3 directory like everything else, python -m pytest tests. They don't need Postgres or
+Pub/Sub, part_1 is only on the path for logger.py.
+"""
+import os
+import sys
+
+PART_3 = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# part_1 has a subscriber.py and a publisher.py too, it goes after part_3 so the packages here win
+if PART_3 not in sys.path:
+    sys.path.insert(0, PART_3)
+PART_1 = os.path.join(os.path.dirname(PART_3), "part_1")
+if PART_1 not in sys.path:
+    sys.path.append(PART_1)
@@ -0,0 +1,27 @@
+import pandas as pd
+from benchmark.synthetic import BAD_ROW_KINDS, corrupt_breadcrumb, generate_breadcrumbs
+from src.breadcrumb_processor import BreadCrumbProcessor
+
+COLUMNS = ["EVENT_NO_TRIP", "VEHICLE_ID", "METERS", "GPS_LONGITUDE", "GPS_LATITUDE", "timestamp"]
+
+
+def _slow(breadcrumb: dict):
+    try:
+        return BreadCrumbProcessor.process_individual(dict(breadcrumb))
+    except Exception:
+        # the subscriber counts an exception as a bad breadcrumb too
+        return None
+
+
+def test_fast_path_matches_process_individual():
+    breadcrumbs = list(generate_breadcrumbs(500, bad_row_rate=0.2, seed=3))
+    breadcrumbs += [corrupt_breadcrumb(dict(breadcrumbs[0]), kind) for kind in BAD_ROW_KINDS]
+
+    slow = [_slow(breadcrumb) for breadcrumb in breadcrumbs]
+    fast = [BreadCrumbProcessor.process_individual_fast(dict(breadcrumb)) for breadcrumb in breadcrumbs]
+
+    assert [result is None for result in fast] == [result is None for result in slow]
+    assert sum(result is None for result in fast) >= len(BAD_ROW_KINDS)
+    slow_df = pd.concat([result for result in slow if result is not None], ignore_index=True)
+    fast_df = BreadCrumbProcessor.records_to_dataframe([record for record in fast if record is not None])
+    pd.testing.assert_frame_equal(fast_df[COLUMNS], slow_df[COLUMNS].astype(fast_df[COLUMNS].dtypes.to_dict()))
@@ -0,0 +1,58 @@
+import datetime as dt
+import pytest
+from src import columnar_archive
+from src.breadcrumb_processor import BreadCrumbProcessor
+from src.columnar_archive import ColumnarArchiveWriter, read_archive
+
+
+def _breadcrumb(day: dt.date, trip: int = 1) -> dict:
+    return {"EVENT_NO_TRIP": trip, "EVENT_NO_STOP": 2, "OPD_DATE": day.strftime("%d%b%Y:00:00:00").upper(),
+            "VEHICLE_ID": 3908, "METERS": 100, "ACT_TIME": 3600, "GPS_LONGITUDE": -122.6, "GPS_LATITUDE": 45.5,
+            "GPS_HDOP": 1.0, "GPS_SATELLITES": 9}
+
+
+def test_more_than_127_service_days_in_one_flush(tmp_path):
+    writer = ColumnarArchiveWriter(str(tmp_path), flush_rows=10_000)
+    first = dt.date(2024, 1, 1)
+    for day in range(200):
+        writer.append(_breadcrumb(first + dt.timedelta(days=day)))
+    writer.close()
+
+    assert writer.rows_written == 200
+    df = read_archive(str(tmp_path), columns=["OPD_DATE", "service_date"])
+    assert df["service_date"].nunique() == 200
+
+
+def test_failed_write_keeps_the_rows(tmp_path, monkeypatch):
+    writer = ColumnarArchiveWriter(str(tmp_path), flush_rows=10_000)
+    writer.append([_breadcrumb(dt.date(2024, 4, 15), trip) for trip in range(5)])
+
+    def broken(*args, **kwargs):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(columnar_archive.ds, "write_dataset", broken)
+    with pytest.raises(OSError):
+        writer.flush()
+    writer.append(_breadcrumb(dt.date(2024, 4, 15), 5))
+    assert writer.pending_rows == 6
+    assert writer.rows_written == 0
+
+    monkeypatch.undo()
+    writer.close()
+    assert writer.rows_written == 6
+    assert sorted(read_archive(str(tmp_path))["EVENT_NO_TRIP"]) == list(range(6))
+
+
+def test_process_archive_skips_rows_with_bad_dates(tmp_path):
+    good = [_breadcrumb(dt.date(2024, 4, 15), trip) for trip in range(3)]
+    bad_date = dict(_breadcrumb(dt.date(2024, 4, 15), 10), OPD_DATE="not a date")
+    no_date = dict(_breadcrumb(dt.date(2024, 4, 15), 11), OPD_DATE=None)
+    writer = ColumnarArchiveWriter(str(tmp_path))
+    writer.append(good + [bad_date, no_date])
+    writer.close()
+
+    df = BreadCrumbProcessor.process_archive(str(tmp_path))
+
+    assert df is not None
+    assert sorted(df["EVENT_NO_TRIP"]) == [0, 1, 2]
+    assert (df["timestamp"] == dt.datetime(2024, 4, 15, 1)).all()
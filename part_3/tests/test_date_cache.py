@@ -0,0 +1,47 @@
+import datetime as dt
+import pytest
+from src.date_cache import OPD_DATE_FORMAT, OpdDateCache, parse_opd_date
+
+
+def test_parse_opd_date_matches_strptime():
+    # a single digit day isn't the 18 character form, strptime takes it
+    for value in ["08DEC2022:00:00:00", "29FEB2024:23:59:59", "01jan2023:12:30:05", "8DEC2022:00:00:00"]:
+        assert parse_opd_date(value) == dt.datetime.strptime(value, OPD_DATE_FORMAT)
+
+
+@pytest.mark.parametrize("value", ["32DEC2022:00:00:00", "08XYZ2022:00:00:00", "08DEC2022:24:00:00",
+                                   "08DEC2022 00:00:00", "０8DEC2022:00:00:00", ""])
+def test_parse_opd_date_rejects_what_strptime_rejects(value):
+    with pytest.raises(ValueError):
+        dt.datetime.strptime(value, OPD_DATE_FORMAT)
+    with pytest.raises(ValueError):
+        parse_opd_date(value)
+
+
+def test_parse_opd_date_type_error():
+    with pytest.raises(TypeError):
+        parse_opd_date(None)
+
+
+def test_cache_counts_and_remembers_failures():
+    calls = []
+
+    def parser(value):
+        calls.append(value)
+        return parse_opd_date(value)
+
+    cache = OpdDateCache(maxsize=2, parser=parser)
+    assert cache.try_parse("08DEC2022:00:00:00") == dt.datetime(2022, 12, 8)
+    assert cache.try_parse("08DEC2022:00:00:00") == dt.datetime(2022, 12, 8)
+    assert cache.try_parse("bad") is None
+    assert cache.try_parse("bad") is None
+    assert cache.try_parse(["unhashable"]) is None
+    assert calls == ["08DEC2022:00:00:00", "bad"]
+    assert cache.info() == {"hits": 2, "misses": 3, "size": 2, "maxsize": 2}
+    with pytest.raises(ValueError):
+        cache.parse("bad")
+
+    # the oldest entry goes once there are more than maxsize
+    cache.try_parse("09DEC2022:00:00:00")
+    cache.try_parse("08DEC2022:00:00:00")
+    assert calls[-1] == "08DEC2022:00:00:00"
@@ -0,0 +1,50 @@
+from src.flush_controller import AdaptiveFlushController
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_fixed_batch_size_without_adaptive():
+    clock = _Clock()
+    controller = AdaptiveFlushController("test", 3, adaptive=False, clock=clock)
+    assert [controller.add() for _ in range(3)] == [False, False, True]
+    clock.now += 3600
+    controller.flushed(3, 1.0)
+    controller.add()
+    assert not controller.due()
+    assert controller.batch_size == 3
+
+
+def test_batch_size_converges_on_the_latency_target():
+    clock = _Clock()
+    controller = AdaptiveFlushController("test", 100, target_latency=10, min_rows=10, max_rows=20000, clock=clock)
+    # 100 messages a second, a flush costs 0.5s plus 1ms a row
+    for _ in range(20000):
+        clock.now += 0.01
+        if controller.add(nbytes=500):
+            rows = controller._rows
+            # messages keep coming while the flush runs, so the clock doesn't jump here
+            controller.flushed(rows, 0.5 + 0.001 * rows)
+
+    fixed, per_row = controller._model()
+    assert abs(fixed - 0.5) < 0.01 and abs(per_row - 0.001) < 1e-5
+    # (10 - 0.5) / (1 / 100 + 0.001)
+    assert abs(controller.batch_size - 863) < 20
+    assert controller.predicted_latency() <= 10.2
+
+
+def test_flushes_for_age_and_memory():
+    clock = _Clock()
+    controller = AdaptiveFlushController("test", 1000, target_latency=5, memory_budget=1000, clock=clock)
+    assert not controller.add(nbytes=100)
+    clock.now += 5
+    assert controller.due() and controller.last_reason == "age"
+
+    controller.flushed(1, 0.01)
+    assert not controller.add(nbytes=600)
+    assert controller.add(nbytes=600) and controller.last_reason == "memory"
@@ -0,0 +1,27 @@
+import io
+import json
+import math
+from src.geojson_export import _number, write_feature_collection
+
+
+def test_number_rounds_to_the_precision():
+    assert _number(-122.6754321, 5) == "-122.67543"
+    assert _number(8.0, 1) == "8.0"
+    assert _number(12.6, 0) == "13"
+    assert _number(1234.5, -2) == "1200"
+
+
+def test_number_writes_null_for_values_json_cant_hold():
+    for value in (None, math.nan, math.inf, -math.inf):
+        assert _number(value, 5) == "null"
+        assert _number(value, 0) == "null"
+
+
+def test_feature_collection_is_valid_json():
+    out = io.BytesIO()
+    written = write_feature_collection([[(-122.6, 45.5, 8.25), (-122.7, 45.6, math.inf)], []], out)
+
+    collection = json.loads(out.getvalue())
+    assert written == 2
+    assert [feature["properties"]["speed"] for feature in collection["features"]] == [8.2, None]
+    assert collection["features"][0]["geometry"]["coordinates"] == [-122.6, 45.5]
@@ -0,0 +1,60 @@
+from src.idle_monitor import IdleMonitor
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_waits_for_the_first_message_then_for_quiet():
+    clock = _Clock()
+    monitor = IdleMonitor(quiet_seconds=30, first_message_timeout=600, max_run_seconds=3600, clock=clock)
+    clock.now = 599
+    assert monitor.should_stop() is None
+
+    monitor.started()
+    clock.now += 100
+    # still working on it, however long it takes
+    assert monitor.should_stop() is None
+    monitor.finished()
+    clock.now += 29
+    assert monitor.should_stop() is None
+    clock.now += 1
+    assert monitor.should_stop().startswith("Idle for 30s after 1 messages")
+    assert (monitor.outstanding, monitor.messages) == (0, 1)
+
+
+def test_no_messages_at_all():
+    clock = _Clock()
+    monitor = IdleMonitor(quiet_seconds=30, first_message_timeout=600, clock=clock)
+    clock.now = 600
+    assert monitor.should_stop() == "Timeout, no messages in 600s"
+
+
+def test_messages_that_never_stop():
+    clock = _Clock()
+    monitor = IdleMonitor(quiet_seconds=30, first_message_timeout=600, max_run_seconds=3600, clock=clock)
+    while clock.now < 3600:
+        monitor.started()
+        monitor.finished()
+        assert monitor.should_stop() is None
+        clock.now += 10
+    assert monitor.should_stop() == "Timeout, still getting messages after 3600s"
+
+
+def test_fixed_window_when_turned_off():
+    clock = _Clock()
+    monitor = IdleMonitor(quiet_seconds=0, first_message_timeout=7200, clock=clock)
+    monitor.started()
+    monitor.finished()
+    clock.now = 7199
+    assert monitor.should_stop() is None
+    # reset starts the window over, sub calls it when the pull starts
+    monitor.reset()
+    clock.now = 7199 + 7199
+    assert monitor.should_stop() is None
+    clock.now += 1
+    assert monitor.should_stop() == "Timeout"
@@ -0,0 +1,20 @@
+import pstats
+from src.instrumentation import FULL, PipelineMetrics
+
+
+def _after_the_inner_stage():
+    return sum(range(10))
+
+
+def test_nested_stages_keep_profiling_until_the_outer_one_ends(tmp_path):
+    metrics = PipelineMetrics(FULL)
+    metrics.start_profiling()
+    with metrics.stage("outer"):
+        with metrics.stage("inner"):
+            pass
+        _after_the_inner_stage()
+    path = metrics.stop_profiling(str(tmp_path / "profile.prof"))
+
+    functions = {name for _, _, name in pstats.Stats(path).stats}
+    assert "_after_the_inner_stage" in functions
+    assert metrics.snapshot()["stages"]["inner"]["count"] == 1
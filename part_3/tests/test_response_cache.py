@@ -0,0 +1,79 @@
+import os
+import requests
+from src.response_cache import ResponseCache
+
+URL = "https://busdata.cs.pdx.edu/api/getBreadCrumbs"
+
+
+class _Response:
+    def __init__(self, status_code: int, content: bytes = b"", headers: dict = None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+
+class _Session:
+    """
+    The busdata API for one vehicle: a body with an ETag, and a 304 when the client already has it.
+    """
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.requests = []
+        self.fail = False
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        self.requests.append(dict(headers or {}))
+        if self.fail:
+            raise requests.ConnectionError("down")
+        etag = f'"{hash(self.body)}"'
+        if (headers or {}).get("If-None-Match") == etag:
+            return _Response(304)
+        return _Response(200, self.body, {"ETag": etag})
+
+
+def test_unchanged_vehicle_is_a_304_and_skipped_once_published(tmp_path):
+    session = _Session(b'[{"EVENT_NO_TRIP": 1}]')
+    cache = ResponseCache(str(tmp_path), day="2024-04-15", session=session)
+
+    first = cache.fetch(URL, "getBreadCrumbs", 3908)
+    assert first.ok and first.changed and not first.from_cache
+    assert first.json() == [{"EVENT_NO_TRIP": 1}]
+    # not published yet, so a second run still publishes it, from the cached body
+    second = cache.fetch(URL, "getBreadCrumbs", 3908)
+    assert second.changed and second.from_cache and second.content == first.content
+    assert "If-None-Match" in session.requests[-1]
+
+    cache.mark_published("getBreadCrumbs", 3908, second)
+    assert not cache.fetch(URL, "getBreadCrumbs", 3908).changed
+
+    session.body = b'[{"EVENT_NO_TRIP": 2}]'
+    changed = cache.fetch(URL, "getBreadCrumbs", 3908)
+    assert changed.changed and not changed.from_cache
+    assert cache.stats["not_modified"] == 2 and cache.stats["changed"] == 3 and cache.stats["unchanged"] == 1
+
+
+def test_offline_replays_what_was_stored(tmp_path):
+    session = _Session(b"[]")
+    cache = ResponseCache(str(tmp_path), day="2024-04-15", session=session)
+    cache.mark_published("getBreadCrumbs", 3908, cache.fetch(URL, "getBreadCrumbs", 3908))
+    session.fail = True
+    assert not cache.fetch(URL, "getBreadCrumbs", 3909).ok
+
+    replay = ResponseCache(str(tmp_path), day="2024-04-15", offline=True, session=session)
+    requests_before = len(session.requests)
+    replayed = replay.fetch(URL, "getBreadCrumbs", 3908)
+    assert replayed.ok and replayed.changed and replayed.content == b"[]"
+    assert not replay.fetch(URL, "getBreadCrumbs", 3909).ok
+    assert len(session.requests) == requests_before
+
+
+def test_old_days_are_pruned(tmp_path):
+    for day in ("2024-03-01", "2024-04-10"):
+        os.makedirs(tmp_path / day)
+    ResponseCache(str(tmp_path), day="2024-04-15", session=_Session(b""), keep_days=14)
+    assert os.listdir(tmp_path) == ["2024-04-10"]
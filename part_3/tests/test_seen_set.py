@@ -0,0 +1,58 @@
+import os
+import pytest
+from src.seen_set import BloomFilter, SeenSet
+
+
+def _breadcrumb(trip: int, act_time: int, opd_date: str = "08DEC2022:00:00:00") -> dict:
+    return {"EVENT_NO_TRIP": trip, "VEHICLE_ID": 3908, "OPD_DATE": opd_date, "ACT_TIME": act_time}
+
+
+def test_bloom_filter_has_no_false_negatives_and_few_false_positives():
+    bloom = BloomFilter(10_000, 0.001)
+    keys = [f"key-{i}".encode() for i in range(10_000)]
+    added = sum(bloom.add(key) for key in keys)
+    # a key whose bits were all set already looks like it was added before, that's the false positive rate at work
+    assert 9_990 <= added == bloom.count
+    assert all(key in bloom for key in keys)
+    assert not bloom.add(keys[0])
+
+    false_positives = sum(f"other-{i}".encode() in bloom for i in range(10_000))
+    assert false_positives < 50
+
+
+def test_bloom_filter_round_trip(tmp_path):
+    bloom = BloomFilter(1000, 0.01)
+    for i in range(100):
+        bloom.add(str(i).encode())
+    path = str(tmp_path / "day.bloom")
+    bloom.save(path)
+
+    loaded = BloomFilter.load(path)
+    assert (loaded.bits, loaded.hashes, loaded.count, loaded.data) == (bloom.bits, bloom.hashes, 100, bloom.data)
+    assert all(str(i).encode() in loaded for i in range(100))
+
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 1)
+    with pytest.raises(ValueError):
+        BloomFilter.load(path)
+
+
+def test_seen_set_remembers_across_runs(tmp_path):
+    seen = SeenSet(str(tmp_path), capacity=1000, error_rate=0.001)
+    assert [seen.add(_breadcrumb(1, t)) for t in (0, 5, 5)] == [True, True, False]
+    # a date that doesn't parse is always published
+    assert seen.add(_breadcrumb(1, 0, "not a date")) and seen.add(_breadcrumb(1, 0, "not a date"))
+    assert seen.save() == 1
+    assert seen.stats == {"new": 2, "seen": 1, "unkeyed": 2}
+
+    again = SeenSet(str(tmp_path), capacity=1000, error_rate=0.001)
+    assert [again.add(_breadcrumb(1, t)) for t in (0, 5, 10)] == [False, False, True]
+
+
+def test_seen_set_drops_old_days(tmp_path):
+    seen = SeenSet(str(tmp_path), capacity=1000, error_rate=0.001, keep_days=3)
+    seen.add(_breadcrumb(1, 0, "01DEC2022:00:00:00"))
+    seen.add(_breadcrumb(1, 0, "07DEC2022:00:00:00"))
+    seen.add(_breadcrumb(1, 0, "08DEC2022:00:00:00"))
+    assert seen.save() == 3
+    assert sorted(os.listdir(tmp_path)) == ["2022-12-07.bloom", "2022-12-08.bloom"]
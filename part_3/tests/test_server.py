@@ -0,0 +1,23 @@
+from server import parse_range
+
+
+def test_parse_range():
+    assert parse_range("bytes=0-99", 1000) == (0, 99)
+    assert parse_range("bytes=900-", 1000) == (900, 999)
+    assert parse_range("bytes=-100", 1000) == (900, 999)
+    # past the end is cut to the end, a suffix longer than the file is the whole file
+    assert parse_range("bytes=990-2000", 1000) == (990, 999)
+    assert parse_range("bytes=-5000", 1000) == (0, 999)
+
+
+def test_parse_range_ignores_what_it_cant_parse():
+    assert parse_range("bytes=10-5", 1000) is None
+    assert parse_range("bytes=0-1,5-9", 1000) is None
+    assert parse_range("items=0-1", 1000) is None
+    assert parse_range("bytes=-", 1000) is None
+
+
+def test_parse_range_past_the_end_is_unsatisfiable():
+    assert parse_range("bytes=1000-", 1000) == (None, None)
+    assert parse_range("bytes=2000-3000", 1000) == (None, None)
+    assert parse_range("bytes=-0", 1000) == (None, None)
@@ -0,0 +1,117 @@
+import os
+import pandas as pd
+import pytest
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from src.spill_log import CORRUPT_SUFFIX, RECORD_HEADER, SpillLog, SpillLogCorrupt, SpillingWriter, is_outage
+
+
+class _Connector:
+    raw_table = "raw"
+
+    def __init__(self):
+        self.batches = []
+
+    def bulk_append(self, table, data, schema):
+        self.batches.append(data)
+        return data.count(b"\n") - 1
+
+
+def _raw(trip: int) -> pd.DataFrame:
+    return pd.DataFrame({"EVENT_NO_TRIP": [trip], "VEHICLE_ID": [3908], "METERS": [100], "GPS_LONGITUDE": [-122.6],
+                         "GPS_LATITUDE": [45.5], "processed_date": [pd.Timestamp("2024-04-15")],
+                         "is_in_final_table": [False], "timestamp": [pd.Timestamp("2024-04-15 08:00:00")]})
+
+
+def _trips(batches: list[bytes]) -> list[int]:
+    return [int(batch.split(b"\n")[1].split(b",")[0]) for batch in batches]
+
+
+def _log_with(directory, trips: list[int]) -> tuple[SpillLog, list[int]]:
+    log = SpillLog(str(directory), fsync=False)
+    sizes = [log.append("raw", _raw(trip)) for trip in trips]
+    log.seal()
+    return log, sizes
+
+
+def test_append_and_replay_round_trip(tmp_path):
+    log, _ = _log_with(tmp_path, [1, 2, 3])
+    connector = _Connector()
+
+    assert SpillingWriter(connector, log).replay() == 3
+    assert _trips(connector.batches) == [1, 2, 3]
+    assert not log.pending()
+    assert log.segments() == []
+
+
+def test_record_cut_short_at_the_end_is_skipped(tmp_path):
+    log, sizes = _log_with(tmp_path, [1, 2])
+    path = log._segment_path(log.segments()[0])
+    with open(path, "r+b") as f:
+        f.truncate(sizes[0] + RECORD_HEADER.size + 5)
+    connector = _Connector()
+
+    assert SpillingWriter(connector, SpillLog(str(tmp_path))).replay() == 1
+    assert _trips(connector.batches) == [1]
+
+
+def test_damaged_record_keeps_the_segment(tmp_path):
+    log, sizes = _log_with(tmp_path, [1, 2, 3])
+    path = log._segment_path(log.segments()[0])
+    with open(path, "r+b") as f:
+        # flip a byte in the body of the second record
+        f.seek(sizes[0] + RECORD_HEADER.size + 10)
+        byte = f.read(1)
+        f.seek(-1, os.SEEK_CUR)
+        f.write(bytes([byte[0] ^ 0xFF]))
+    log = SpillLog(str(tmp_path))
+    with pytest.raises(SpillLogCorrupt):
+        list(log.read(log.segments()[0]))
+    connector = _Connector()
+
+    assert SpillingWriter(connector, log).replay() == 1
+    assert _trips(connector.batches) == [1]
+    assert os.path.exists(path + CORRUPT_SUFFIX)
+    assert not log.pending()
+
+
+def test_only_outages_are_spilled(tmp_path):
+    log = SpillLog(str(tmp_path), fsync=False)
+    writer = SpillingWriter(_Connector(), log)
+
+    def down(df):
+        raise OperationalError("INSERT", {}, ConnectionRefusedError("connection refused"))
+
+    def bad_query(df):
+        raise ProgrammingError("INSERT", {}, Exception("column does not exist"))
+
+    with pytest.raises(ProgrammingError):
+        writer.write("raw", _raw(1), bad_query)
+    assert not log.pending()
+    assert writer.write("raw", _raw(2), down) is None
+    assert log.pending()
+    assert is_outage(OperationalError("SELECT 1", {}, Exception()))
+    assert not is_outage(ValueError("bad value"))
+
+
+def test_spill_replay_and_spill_again_in_a_new_process(tmp_path):
+    log, _ = _log_with(tmp_path, [1, 2, 3])
+    assert SpillingWriter(_Connector(), log).replay() == 3
+    log.close()
+
+    # a new run starts with no segments, its first one must not be read from the last run's checkpoint
+    log, _ = _log_with(tmp_path, [4, 5])
+    connector = _Connector()
+    assert SpillingWriter(connector, log).replay() == 2
+    assert _trips(connector.batches) == [4, 5]
+    assert not log.pending()
+
+
+def test_set_aside_segments_keep_their_numbers(tmp_path):
+    log, _ = _log_with(tmp_path, [1])
+    first = log.set_aside(log.segments()[0])
+    log.close()
+
+    log, _ = _log_with(tmp_path, [2])
+    second = log.set_aside(log.segments()[0])
+    assert first != second
+    assert os.path.exists(first) and os.path.exists(second)
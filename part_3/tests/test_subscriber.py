@@ -0,0 +1,115 @@
+import json
+import pandas as pd
+from sqlalchemy.exc import OperationalError
+from benchmark.synthetic import generate_breadcrumbs, generate_stop_events
+from src.flush_controller import AdaptiveFlushController
+from src.spill_log import SpillLog, SpillingWriter
+from subscriber import part3_subscriber, subscriber as subscriber_module
+from subscriber.subscriber import Subscriber, SubscriberSupervisor
+
+
+class _Logger:
+    def __init__(self):
+        self.messages = []
+
+    def info(self, message):
+        self.messages.append(message)
+
+    error = info
+
+    def send(self):
+        pass
+
+
+class _Connection:
+    def commit(self):
+        pass
+
+
+class _DownConnector:
+    """
+    A PostgresConnector for a database that is down.
+    """
+
+    def __init__(self):
+        self.connection = _Connection()
+
+    def append_to_raw(self, df):
+        raise OperationalError("INSERT INTO raw", {}, ConnectionRefusedError("database is down"))
+
+    def upsert_to_trip(self, df):
+        raise OperationalError("INSERT INTO trip_metadata", {}, ConnectionRefusedError("database is down"))
+
+
+class _Connector:
+    raw_table = "raw"
+
+    def __init__(self):
+        self.batches = []
+
+    def bulk_append(self, table, data, schema):
+        self.batches.append(data)
+        return data.count(b"\n") - 1
+
+
+class _Message:
+    def __init__(self, breadcrumb: dict):
+        self.data = json.dumps(breadcrumb).encode("utf-8")
+        self.acked = self.nacked = False
+
+    def ack(self):
+        self.acked = True
+
+    def nack(self):
+        self.nacked = True
+
+
+def test_message_is_nacked_when_the_spill_log_is_full(tmp_path):
+    connector = _DownConnector()
+    writer = SpillingWriter(connector, SpillLog(str(tmp_path), max_bytes=10))
+    subscriber = Subscriber(_Logger(), None, connector, fast_path=True, online_speed=False, writer=writer)
+    subscriber._flush_controller = AdaptiveFlushController("test", 3, adaptive=False)
+    messages = [_Message(breadcrumb) for breadcrumb in generate_breadcrumbs(4, bad_row_rate=0, seed=1)]
+
+    for message in messages:
+        subscriber.on_message(message)
+
+    # the third message fills the batch, the flush can't go anywhere, and the fourth comes in under back pressure
+    assert [message.acked for message in messages] == [True, True, False, False]
+    assert [message.nacked for message in messages] == [False, False, True, True]
+    assert len(subscriber._processed_breadcrumbs) == 2
+
+
+def test_stop_event_is_nacked_when_the_spill_log_is_full(tmp_path):
+    connector = _DownConnector()
+    writer = SpillingWriter(connector, SpillLog(str(tmp_path), max_bytes=10))
+    subscriber = part3_subscriber.Subscriber(connector, writer=writer)
+    subscriber._flush_controller = AdaptiveFlushController("test", 3, adaptive=False)
+    messages = [_Message(stop_event) for stop_event in generate_stop_events(4, seed=1)]
+
+    for message in messages:
+        subscriber.message_parser(message)
+
+    assert [message.acked for message in messages] == [True, True, False, False]
+    assert [message.nacked for message in messages] == [False, False, True, True]
+    assert len(subscriber._processed_breadcrumbs) == 2
+
+
+def test_supervisor_replays_what_the_workers_left(tmp_path, monkeypatch):
+    raw = pd.DataFrame({"EVENT_NO_TRIP": [1], "VEHICLE_ID": [3908], "METERS": [100], "GPS_LONGITUDE": [-122.6],
+                        "GPS_LATITUDE": [45.5], "processed_date": [pd.Timestamp("2024-04-15")],
+                        "is_in_final_table": [False], "timestamp": [pd.Timestamp("2024-04-15 08:00:00")]})
+    for directory in ("worker-0", "worker-1", "stop_events"):
+        log = SpillLog(str(tmp_path / directory), fsync=False)
+        log.append("raw", raw)
+        log.close()
+    monkeypatch.setattr(subscriber_module, "SPILL_DIR", str(tmp_path))
+    connector = _Connector()
+
+    supervisor = SubscriberSupervisor(_Logger(), None, None, 2, connector)
+
+    # only the workers' logs, the stop event subscriber replays its own
+    assert supervisor.replay_spill_logs() == 2
+    assert len(connector.batches) == 2
+    assert not SpillLog(str(tmp_path / "worker-0")).pending()
+    assert SpillLog(str(tmp_path / "stop_events")).pending()
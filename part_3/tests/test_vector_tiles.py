@@ -0,0 +1,18 @@
+import pandas as pd
+from src.spatial_index import GridIndex
+from src.vector_tiles import SpeedTiles, TileCache
+
+
+def _breadcrumbs(speed: float) -> pd.DataFrame:
+    return pd.DataFrame({"latitude": [45.5112, 45.5114], "longitude": [-122.6830, -122.6832], "speed": [speed] * 2})
+
+
+def test_only_cached_tiles_count_as_invalidated(tmp_path):
+    tiles = SpeedTiles(GridIndex(), TileCache(str(tmp_path)), min_zoom=10, max_zoom=16, precompute_zoom=13)
+    # nothing is cached yet, the precomputed zooms 10 to 13 get rendered afterwards
+    assert tiles.add_breadcrumbs(_breadcrumbs(5.0)) == 0
+    assert len(tiles.cache) == 4
+
+    # the same spot again drops those four (and renders them again), the zooms that were never rendered don't count
+    assert tiles.add_breadcrumbs(_breadcrumbs(7.0)) == 4
+    assert len(tiles.cache) == 4